@@ -1,12 +1,54 @@
-import os
+import time
 import importlib
+from importlib.metadata import entry_points
 
-# Get the current directory of the package
-package_dir = os.path.dirname(__file__)
+import logging
+logger = logging.getLogger("retcon")
 
-# Loop through all files in the directory
-for filename in os.listdir(package_dir):
-    # Check if the file is a Python file and not __init__.py
-    if filename.endswith(".py") and filename != "__init__.py":
-        module_name = filename[:-3]  # Remove the .py extension
-        importlib.import_module(f".{module_name}", package=__name__)
\ No newline at end of file
+# plugin name -> "module:Class"
+# Only plugins named in a profile's [retcon_plugins] get imported, so a node that
+# only runs wifi_mesh never pays for importing the meshtastic stack (and vice versa)
+PLUGIN_MANIFEST = {
+    "wifi_mesh": "plugins.wifi_mesh:WifiMeshPlugin",
+    "usb_autodetect": "plugins.usb_autodetect:UsbAutodetectPlugin",
+    "qos": "plugins.qos:QosPlugin",
+    "timeseries": "plugins.timeseries:TimeseriesPlugin",
+    "thermal": "plugins.thermal:ThermalPlugin",
+}
+
+# out of tree plugins can register themselves under this entry point group
+ENTRY_POINT_GROUP = "retcon.plugins"
+
+# plugin name -> seconds it took to import the plugin module (and everything it pulls in)
+import_times = {}
+
+
+def plugin_registry() -> dict:
+    """ All known plugins. plugin name -> 'module:Class'"""
+    registry = dict(PLUGIN_MANIFEST)
+    for ep in entry_points(group=ENTRY_POINT_GROUP):
+        registry.setdefault(ep.name, ep.value)
+    return registry
+
+
+def load_plugin_class(plugin_name: str):
+    """ Import just the module for plugin_name and return its RetconPlugin class"""
+    from .base_plugin import RetconPlugin
+
+    # anything not registered can still be dropped in as plugins/<plugin_name>.py
+    target = plugin_registry().get(plugin_name, f"{__name__}.{plugin_name}")
+    module_path, _, class_name = target.partition(":")
+
+    start = time.perf_counter()
+    module = importlib.import_module(module_path)
+    import_times[plugin_name] = time.perf_counter() - start
+    logger.info(f"Imported plugin {plugin_name} from {module_path} in {import_times[plugin_name]:.3f}s")
+
+    if class_name:
+        return getattr(module, class_name)
+
+    for obj in vars(module).values():
+        if isinstance(obj, type) and issubclass(obj, RetconPlugin) and obj.PLUGIN_NAME == plugin_name:
+            return obj
+
+    raise ImportError(f"No RetconPlugin named {plugin_name} in {module_path}")
@@ -1,14 +1,31 @@
 import typing
+import asyncio
 
 class RetconPlugin:
     
     PLUGIN_NAME = "BASE"
     
+    # How the plugin runtime (plugins/runtime.py) drives loop()
+    #   LOOP_INTERVAL = None -> loop() is a long running task. It's called once and supervised
+    #   LOOP_INTERVAL = 60   -> loop() is called every 60 seconds
+    LOOP_INTERVAL = 60
+    # seconds a single periodic loop() call gets before it's cancelled. None = no deadline
+    LOOP_TIMEOUT = 30
+    # what to do when loop() crashes or a long running loop() returns:
+    #   "always" = restart either way, "on-failure" = restart only if it crashed, "never" = leave it dead
+    RESTART_POLICY = "on-failure"
+    # seconds to wait before a restart. Doubled for each failure in a row
+    RESTART_BACKOFF = 5
+    # seconds get_config()/init() may block before we stop waiting on them
+    INIT_TIMEOUT = 120
+    
     def __init__(self, node_ssid: str, plugin_config : dict, retcon_config: dict, restart_rnsd:typing.Callable):
         self.node_ssid = node_ssid.encode()
         self.config = plugin_config
         self.retcon_config = retcon_config
         self.restart_rnsd = restart_rnsd
+        self._children = set()
+        self._on_child_error = None  # set by the runtime while loop() runs
         
     # plugin code. Take the config object, the template string
     # and return any Jinja vars in reticulum.config template
@@ -22,6 +39,21 @@ class RetconPlugin:
     async def loop(self):
         pass
     
+    def spawn(self, coro: typing.Coroutine, name: str = None) -> asyncio.Task:
+        """
+        Start a task that belongs to loop(). The runtime cancels these when loop() ends and
+        treats one that crashes as loop() crashing. Use it instead of a bare create_task
+        """
+        task = asyncio.create_task(coro, name=name)
+        self._children.add(task)
+        task.add_done_callback(self._child_done)
+        return task
+    
+    def _child_done(self, task: asyncio.Task):
+        self._children.discard(task)
+        if not task.cancelled() and task.exception() is not None and self._on_child_error is not None:
+            self._on_child_error(task)
+    
     # An init function that will get called on RETCON startup for init/bootstrapping
     def init(self) -> typing.Union[None, typing.Coroutine]:
         pass
\ No newline at end of file
@@ -0,0 +1,236 @@
+"""
+Traffic shaping and per-client fairness on the access point.
+
+In client mode retcon_ap shares its radio with the mesh uplink. A few people pulling firmware off the
+file explorer can eat all the airtime and starve the backbone to retcon.gateway:4242. This puts an HTB
+tree with fq_codel leaves on the AP iface:
+
+    1:1   everything, capped at rate
+      1:10  mesh backbone (tcp 4242, link probes on udp 4243). Guaranteed backbone_rate, can borrow all of rate
+      1:20  clients. Whatever's left
+        1:100+  one class per client, ceil client_rate, so one client can't take it all
+        1:30    anything we can't put on a client (default)
+
+Only egress is shaped, which on the AP is the client download direction, the one that hurts.
+Optionally the same backbone priority on the uplink iface if you know its rate (uplink_rate).
+It also caps associated stations on the client AP and writes live class stats to ~/.retcon/qos_stats.json.
+
+    [[qos]]
+      rate = 20mbit
+      backbone_rate = 5mbit
+      client_rate = 4mbit
+      max_clients = 30
+      #iface = uap0          # default: the AP iface
+      #uplink_rate = 20mbit  # also shape the uplink
+      #leaf_qdisc = fq_codel  # qdisc on every leaf class
+      #netns = qos-test      # run every tc/iw command inside a network namespace (testing)
+"""
+import os
+import re
+import json
+import time
+
+from .base_plugin import RetconPlugin
+from utils.batman_mesh import run_cmd
+from utils.link_probe import dhcp_lease_ips, PROBE_PORT
+from utils.state import atomic_write
+from utils.wifi_radios import get_radios, main_ap_radio
+
+import logging
+logger = logging.getLogger("retcon")
+
+BACKBONE_PORT = 4242
+QOS_STATS_PATH = os.path.expanduser("~/.retcon/qos_stats.json")
+
+CLASS_BACKBONE = "1:10"
+CLASS_CLIENTS = "1:20"
+CLASS_DEFAULT = "1:30"
+FIRST_CLIENT_MINOR = 0x100
+PRIO_BACKBONE = 1
+PRIO_CLIENTS = 2
+
+# tc prints backlog with iproute2's sprint_size: 1514b, 3Kb, 2Mb
+_SIZE = re.compile(r"^(\d+(?:\.\d+)?)([KMG]?)b$")
+
+
+def tc_size(text: str) -> int:
+    m = _SIZE.match(text)
+    if m is None:
+        raise ValueError(f"not a tc size: {text}")
+    return int(float(m.group(1)) * 1024 ** " KMG".index(m.group(2) or " "))
+
+
+class QosPlugin(RetconPlugin):
+
+    PLUGIN_NAME = "qos"
+
+    # re-sync client classes, enforce the station cap and refresh stats
+    LOOP_INTERVAL = 10
+    LOOP_TIMEOUT = 30
+
+    def init(self):
+        is_transport = self.retcon_config["retcon"].get("mode", "client") == "transport"
+        radios = get_radios(self.retcon_config)
+        ap = main_ap_radio(radios, is_transport)
+        self.iface = self.config.get("iface", ap.iface if ap is not None else None)
+        self.uplink_iface = self.retcon_config["retcon"]["wifi"].get("client_iface", None)
+        self.netns = self.config.get("netns", None)
+        self.rate = self.config.get("rate", "20mbit")
+        self.backbone_rate = self.config.get("backbone_rate", "5mbit")
+        self.client_rate = self.config.get("client_rate", "4mbit")
+        self.uplink_rate = self.config.get("uplink_rate", None)
+        self.leaf_qdisc = self.config.get("leaf_qdisc", "fq_codel")
+        # mesh children associate to a transport's AP too. Only cap stations in client mode
+        self.max_clients = int(self.config["max_clients"]) if "max_clients" in self.config and not is_transport else None
+        self.client_classes = {}  # client ip -> class minor
+        if self.iface is None:
+            raise ValueError("qos: no AP iface to shape")
+        return self.setup()
+
+    async def tc(self, *args, check=True) -> str:
+        cmd = ("tc",) + args
+        if self.netns is not None:
+            cmd = ("ip", "netns", "exec", self.netns) + cmd
+        return await run_cmd(*cmd, check=check)
+
+    async def iw(self, *args, check=True) -> str:
+        cmd = ("iw",) + args
+        if self.netns is not None:
+            cmd = ("ip", "netns", "exec", self.netns) + cmd
+        return await run_cmd(*cmd, check=check)
+
+    async def _backbone_filters(self, dev: str):
+        for match in (["ip", "protocol", "6", "0xff", "match", "ip", "dport", str(BACKBONE_PORT), "0xffff"],
+                      ["ip", "protocol", "6", "0xff", "match", "ip", "sport", str(BACKBONE_PORT), "0xffff"],
+                      ["ip", "protocol", "17", "0xff", "match", "ip", "dport", str(PROBE_PORT), "0xffff"],
+                      ["ip", "protocol", "17", "0xff", "match", "ip", "sport", str(PROBE_PORT), "0xffff"]):
+            await self.tc("filter", "add", "dev", dev, "parent", "1:", "protocol", "ip", "prio", str(PRIO_BACKBONE),
+                          "u32", "match", *match, "flowid", CLASS_BACKBONE)
+
+    async def _leaf(self, dev: str, classid: str, parent: str, rate: str, ceil: str, prio: int):
+        await self.tc("class", "replace", "dev", dev, "parent", parent, "classid", classid, "htb",
+                      "rate", rate, "ceil", ceil, "prio", str(prio))
+        await self.tc("qdisc", "replace", "dev", dev, "parent", classid, self.leaf_qdisc)
+
+    async def setup(self):
+        """ (re)build the whole tree. Starts from scratch so a restart never stacks filters"""
+        logger.info(f"qos: shaping {self.iface} to {self.rate}, backbone {self.backbone_rate}, clients {self.client_rate} each")
+        await self.tc("qdisc", "del", "dev", self.iface, "root", check=False)
+        await self.tc("qdisc", "add", "dev", self.iface, "root", "handle", "1:", "htb", "default", CLASS_DEFAULT.split(":")[1])
+        await self.tc("class", "add", "dev", self.iface, "parent", "1:", "classid", "1:1", "htb", "rate", self.rate)
+        await self._leaf(self.iface, CLASS_BACKBONE, "1:1", self.backbone_rate, self.rate, 0)
+        await self.tc("class", "add", "dev", self.iface, "parent", "1:1", "classid", CLASS_CLIENTS, "htb",
+                      "rate", "1kbit", "ceil", self.rate, "prio", "1")
+        await self._leaf(self.iface, CLASS_DEFAULT, CLASS_CLIENTS, "1kbit", self.client_rate, 2)
+        await self._backbone_filters(self.iface)
+        self.client_classes = {}
+
+        if self.uplink_rate is not None and self.uplink_iface is not None and self.uplink_iface != self.iface:
+            dev = self.uplink_iface
+            await self.tc("qdisc", "del", "dev", dev, "root", check=False)
+            await self.tc("qdisc", "add", "dev", dev, "root", "handle", "1:", "htb", "default", CLASS_DEFAULT.split(":")[1])
+            await self.tc("class", "add", "dev", dev, "parent", "1:", "classid", "1:1", "htb", "rate", self.uplink_rate)
+            await self._leaf(dev, CLASS_BACKBONE, "1:1", self.backbone_rate, self.uplink_rate, 0)
+            await self._leaf(dev, CLASS_DEFAULT, "1:1", "1kbit", self.uplink_rate, 2)
+            await self._backbone_filters(dev)
+
+    async def sync_clients(self, ips: list):
+        """ one class per client. Filters are rebuilt as a batch whenever the set of clients changes"""
+        if set(ips) == set(self.client_classes):
+            return
+        used = set()
+        classes = {}
+        for ip in sorted(ips):
+            minor = self.client_classes.get(ip)
+            if minor is None:
+                minor = FIRST_CLIENT_MINOR
+                while minor in used or minor in self.client_classes.values():
+                    minor += 1
+            classes[ip] = minor
+            used.add(minor)
+
+        await self.tc("filter", "del", "dev", self.iface, "parent", "1:", "prio", str(PRIO_CLIENTS), check=False)
+        for ip, minor in self.client_classes.items():
+            if ip not in classes:
+                await self.tc("class", "del", "dev", self.iface, "classid", f"1:{minor:x}", check=False)
+        for ip, minor in classes.items():
+            classid = f"1:{minor:x}"
+            if ip not in self.client_classes:
+                await self._leaf(self.iface, classid, CLASS_CLIENTS, "1kbit", self.client_rate, 2)
+            await self.tc("filter", "add", "dev", self.iface, "parent", "1:", "protocol", "ip", "prio", str(PRIO_CLIENTS),
+                          "u32", "match", "ip", "dst", f"{ip}/32", "flowid", classid)
+        self.client_classes = classes
+
+    async def enforce_max_clients(self) -> list:
+        """ drop the most recently connected stations past max_clients. Returns the macs we dropped"""
+        if self.max_clients is None:
+            return []
+        stations = []
+        mac = None
+        for line in (await self.iw("dev", self.iface, "station", "dump", check=False)).splitlines():
+            line = line.strip()
+            if line.startswith("Station "):
+                mac = line.split()[1]
+            elif line.startswith("connected time:") and mac is not None:
+                stations.append((int(line.split()[2]), mac))
+        stations.sort(reverse=True)  # longest connected first, they keep their spot
+        dropped = [mac for _, mac in stations[self.max_clients:]]
+        for mac in dropped:
+            logger.info(f"qos: {len(stations)} stations, over max_clients={self.max_clients}. Dropping {mac}")
+            await self.iw("dev", self.iface, "station", "del", mac, check=False)
+        return dropped
+
+    async def stats(self) -> dict:
+        """ per class counters from tc, labelled by what they're for"""
+        names = {CLASS_BACKBONE: "backbone", CLASS_CLIENTS: "clients", CLASS_DEFAULT: "default", "1:1": "total"}
+        names.update({f"1:{minor:x}": ip for ip, minor in self.client_classes.items()})
+        classes = {}
+        handle = None
+        # plain text, older iproute2 ignores -j for classes
+        for line in (await self.tc("-s", "class", "show", "dev", self.iface)).splitlines():
+            words = line.replace("(", " ").replace(")", " ").replace(",", " ").split()
+            if line.startswith("class ") and len(words) > 2:
+                handle = words[2]
+                classes[names.get(handle, handle)] = {"handle": handle, "bytes": 0, "packets": 0,
+                                                      "drops": 0, "overlimits": 0, "backlog": 0}
+            elif handle is not None and words[:1] == ["Sent"]:
+                c = classes[names.get(handle, handle)]
+                c["bytes"], c["packets"] = int(words[1]), int(words[3])
+                c["drops"], c["overlimits"] = int(words[words.index("dropped") + 1]), int(words[words.index("overlimits") + 1])
+            elif handle is not None and words[:1] == ["backlog"]:
+                classes[names.get(handle, handle)]["backlog"] = tc_size(words[1])
+        return {"time": time.time(), "iface": self.iface, "clients": len(self.client_classes), "classes": classes}
+
+    async def loop(self):
+        await self.sync_clients(dhcp_lease_ips(self.iface))
+        await self.enforce_max_clients()
+        stats = await self.stats()
+        os.makedirs(os.path.dirname(QOS_STATS_PATH), exist_ok=True)
+        atomic_write(QOS_STATS_PATH, json.dumps(stats, indent=2).encode())
+
+
+if __name__ == "__main__":
+    # self check in a throwaway network namespace: sudo python -m plugins.qos [leaf qdisc]
+    import sys
+    import asyncio
+    import subprocess
+
+    async def self_check():
+        ns = "retcon-qos-check"
+        subprocess.run(["ip", "netns", "add", ns], check=True)
+        try:
+            subprocess.run(["ip", "-n", ns, "link", "add", "ap0", "type", "veth", "peer", "name", "cl0"], check=True)
+            subprocess.run(["ip", "-n", ns, "link", "set", "ap0", "up"], check=True)
+            config = {"retcon": {"mode": "client", "wifi": {"prefix": "RT-", "psk": "x", "freq": 2462,
+                                                            "client_iface": "wlan0", "ap_iface": "ap0"}}}
+            plugin = QosPlugin("RT-CHECK", {"iface": "ap0", "netns": ns, "rate": "10mbit",
+                                                   "leaf_qdisc": sys.argv[1] if len(sys.argv) > 1 else "fq_codel"}, config, None)
+            await plugin.init()
+            await plugin.sync_clients(["10.42.0.10", "10.42.0.11"])
+            await plugin.sync_clients(["10.42.0.11", "10.42.0.12"])
+            print(json.dumps(await plugin.stats(), indent=2))
+            print(await plugin.tc("filter", "show", "dev", "ap0"))
+        finally:
+            subprocess.run(["ip", "netns", "del", ns])
+
+    asyncio.run(self_check())
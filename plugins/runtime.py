@@ -0,0 +1,170 @@
+import time
+import asyncio
+import typing
+import logging
+
+from .base_plugin import RetconPlugin
+
+logger = logging.getLogger("retcon")
+
+# never wait longer than this between restarts, no matter how many failures in a row
+MAX_RESTART_BACKOFF = 300
+
+
+class PluginRuntime:
+    """
+    Runs the loaded plugins.
+    Blocking get_config/init calls go to the default executor, and every plugin's loop()
+    runs in its own supervised task so one slow or crashing plugin can't stall the others.
+    How a loop is scheduled comes from the LOOP_* / RESTART_* attributes on the plugin class.
+
+    Tasks a loop() starts with plugin.spawn() are its children: they're cancelled when it
+    returns or is cancelled, and one crashing counts as loop() crashing.
+
+    Note this can only isolate plugins that actually yield to the event loop.
+    A loop() that blocks without awaiting will still stall everyone.
+    """
+
+    def __init__(self, plugins: dict):
+        self.plugins = plugins  # plugin name -> RetconPlugin, shared with retcon.py
+        self._tasks = {}
+        self._status = {}
+
+    async def run_blocking(self, func: typing.Callable, *args, timeout: typing.Optional[float] = None):
+        """ Run a blocking call in the executor so the event loop keeps going"""
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(None, func, *args), timeout)
+
+    async def get_configs(self) -> dict:
+        """ Call get_config on every plugin in parallel. plugin name -> template vars"""
+        names = list(self.plugins.keys())
+        results = await asyncio.gather(
+            *[self.run_blocking(self.plugins[n].get_config, timeout=self.plugins[n].INIT_TIMEOUT) for n in names],
+            return_exceptions=True)
+
+        plugin_vars = {}
+        for name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                # the thread may still be running, but we're not waiting on it anymore
+                logger.error(f"Plugin {name} get_config failed: {result!r}. Leaving its interfaces out")
+                plugin_vars[name] = {}
+            else:
+                plugin_vars[name] = result
+        return plugin_vars
+
+    async def init_all(self):
+        """ Call init() on every plugin. init may block or hand back a coroutine, we handle both"""
+        async def _init(name, plugin):
+            try:
+                maybe_awaitable = await self.run_blocking(plugin.init, timeout=plugin.INIT_TIMEOUT)
+                if maybe_awaitable is not None:
+                    await asyncio.wait_for(maybe_awaitable, plugin.INIT_TIMEOUT)
+            except Exception as e:
+                logger.exception(f"Plugin {name} init failed")
+                self._set_status(name, state="init-failed", last_error=repr(e))
+
+        await asyncio.gather(*[_init(n, p) for n, p in self.plugins.items()])
+
+    def start(self):
+        """ Start a supervised task for each plugin that has a loop()"""
+        for name, plugin in self.plugins.items():
+            if name in self._tasks:
+                continue
+            if type(plugin).loop is RetconPlugin.loop:
+                continue  # nothing to run
+            if self._status.get(name, {}).get("state") == "init-failed":
+                continue
+            self._tasks[name] = asyncio.create_task(self._supervise(name, plugin), name=f"plugin-{name}")
+
+    async def run(self):
+        """ Start all the plugin loops and keep going until stopped"""
+        self.start()
+        while True:
+            await asyncio.sleep(60)
+
+    async def stop(self):
+        """ Cancel all plugin tasks and wait for them to wind down"""
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def status(self) -> dict:
+        """ Copy of the per-plugin runtime state. Handy for admin status reporting"""
+        return {name: dict(s) for name, s in self._status.items()}
+
+    def _set_status(self, name, **kwargs):
+        self._status.setdefault(name, {"state": "loaded", "runs": 0, "failures": 0, "restarts": 0, "last_error": None})
+        self._status[name].update(kwargs)
+
+    async def _run_loop(self, plugin: RetconPlugin, timeout: typing.Optional[float]):
+        """ One loop() call. Tasks it spawned don't outlive it, and one of them crashing fails it"""
+        loop_task = asyncio.create_task(plugin.loop())
+        crashed = []
+
+        def on_child_error(task):
+            crashed.append(task)
+            loop_task.cancel()
+
+        plugin._on_child_error = on_child_error
+        try:
+            await asyncio.wait_for(loop_task, timeout)
+        except asyncio.CancelledError:
+            # cancelled by a crashed child rather than by stop()? Then that child's error is the loop's
+            if crashed and not asyncio.current_task().cancelling():
+                raise crashed[0].exception() from None
+            raise
+        finally:
+            plugin._on_child_error = None
+            children = list(plugin._children)
+            for t in children:
+                t.cancel()
+            await asyncio.gather(*children, return_exceptions=True)
+
+    async def _supervise(self, name: str, plugin: RetconPlugin):
+        interval = plugin.LOOP_INTERVAL
+        long_running = interval is None
+        failures = 0
+
+        while True:
+            self._set_status(name, state="running", last_start=time.time())
+            started = time.monotonic()
+            error = None
+            try:
+                await self._run_loop(plugin, None if long_running else plugin.LOOP_TIMEOUT)
+            except asyncio.CancelledError:
+                self._set_status(name, state="stopped")
+                raise
+            except asyncio.TimeoutError:
+                error = f"loop() missed its {plugin.LOOP_TIMEOUT}s deadline"
+                logger.error(f"Plugin {name} {error}. Cancelled it")
+            except Exception as e:
+                error = repr(e)
+                logger.exception(f"Plugin {name} loop crashed")
+
+            s = self._status[name]
+            self._set_status(name, runs=s["runs"] + 1, last_end=time.time())
+
+            if error is None:
+                failures = 0
+                if not long_running:
+                    self._set_status(name, state="waiting")
+                    await asyncio.sleep(max(0, interval - (time.monotonic() - started)))
+                    continue
+
+                # a long running loop returned on its own
+                if plugin.RESTART_POLICY != "always":
+                    self._set_status(name, state="finished")
+                    return
+                logger.info(f"Plugin {name} loop returned. Restarting it")
+            else:
+                failures += 1
+                self._set_status(name, failures=s["failures"] + 1, last_error=error)
+                if plugin.RESTART_POLICY == "never":
+                    self._set_status(name, state="failed")
+                    return
+
+            delay = min(MAX_RESTART_BACKOFF, plugin.RESTART_BACKOFF * 2 ** max(0, failures - 1))
+            self._set_status(name, state="backoff", restarts=s["restarts"] + 1)
+            await asyncio.sleep(delay)
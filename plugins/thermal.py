@@ -0,0 +1,244 @@
+"""
+Thermal headroom management for nodes in hot enclosures.
+
+A Pi at its soft temperature limit caps its clock without telling anyone, and transport throughput
+drops for no visible reason. Every LOOP_INTERVAL this reads the SoC temperature, the firmware's
+throttle flags and the load, and sorts the node into a state by headroom to throttle_temp:
+
+    cool  headroom >= warm_margin   governor ondemand (Pi OS default), everything at normal priority
+    warm  headroom >= hot_margin    governor conservative/schedutil, UI processes niced
+    hot   less, or throttling now   governor powersave, UI niced harder, transportd ahead of everyone
+
+Priorities are set on every thread of a process. renice -p only changes the thread it's given, and
+transportd's interface and job threads are the ones doing the work.
+
+so it backs off before the firmware does and the backbone keeps its CPU while it's short. States
+only get cooler once the headroom is hysteresis degrees past the threshold. What it sees and did
+goes to ~/.retcon/thermal.json for the admin status.
+
+    [[thermal]]
+      #throttle_temp = 80      # where the firmware starts capping the clock, C
+      #warm_margin = 15
+      #hot_margin = 5
+      #hysteresis = 2
+      #sysfs_root = /sys       # point both at a fake tree to try it out
+      #proc_root = /proc
+      #manage_governor = true
+      #manage_priority = true
+"""
+import os
+import json
+import time
+import asyncio
+
+from .base_plugin import RetconPlugin
+from utils.batman_mesh import run_cmd
+from utils.memstat import classify
+from utils.state import atomic_write
+from utils.thermal import THERMAL_PATH, throttle_flags
+
+import logging
+logger = logging.getLogger("retcon")
+
+COOL, WARM, HOT = "cool", "warm", "hot"
+# governors to use per state, first one the kernel has wins
+# cool is the stock governor, not performance. A node in a hot enclosure shouldn't run flat out to start with
+GOVERNORS = {COOL: ["ondemand", "schedutil"],
+             WARM: ["conservative", "schedutil", "ondemand"],
+             HOT: ["powersave", "conservative"]}
+# nice per component and state. Only processes we know are touched. retcon.py itself (and the UI in compact mode) is left alone
+NICE = {"transportd": {COOL: 0, WARM: -5, HOT: -10},
+        "homepage": {COOL: 0, WARM: 5, HOT: 10},
+        "meshchat": {COOL: 0, WARM: 5, HOT: 10},
+        "tls_proxy": {COOL: 0, WARM: 5, HOT: 10}}
+
+# get_throttled bits that mean the clock is being held back right now, see utils.thermal.THROTTLE_BITS
+THROTTLING_NOW = 0b1110  # capped, throttled or at the soft limit. Under-voltage alone isn't a heat problem
+
+
+class ThermalPlugin(RetconPlugin):
+
+    PLUGIN_NAME = "thermal"
+
+    LOOP_INTERVAL = 15
+    LOOP_TIMEOUT = 10
+
+    def init(self):
+        self.throttle_temp = float(self.config.get("throttle_temp", 80))
+        self.warm_margin = float(self.config.get("warm_margin", 15))
+        self.hot_margin = float(self.config.get("hot_margin", 5))
+        self.hysteresis = float(self.config.get("hysteresis", 2))
+        self.sysfs_root = self.config.get("sysfs_root", "/sys")
+        self.proc_root = self.config.get("proc_root", "/proc")
+        self.manage_governor = str(self.config.get("manage_governor", "true")).lower() in ("true", "yes", "1")
+        self.manage_priority = str(self.config.get("manage_priority", "true")).lower() in ("true", "yes", "1")
+        self.state = None
+        self.since = time.time()
+        self.changes = 0
+
+    # readings
+
+    def _read(self, *parts) -> str:
+        with open(os.path.join(*parts)) as fin:
+            return fin.read().strip()
+
+    def temperature(self):
+        try:
+            return int(self._read(self.sysfs_root, "class/thermal/thermal_zone0/temp")) / 1000
+        except (FileNotFoundError, ValueError):
+            return None
+
+    async def throttled(self):
+        """ the firmware's get_throttled word, None off a Pi"""
+        try:
+            return int(self._read(self.sysfs_root, "devices/platform/soc/soc:firmware/get_throttled"), 16)
+        except (FileNotFoundError, ValueError):
+            pass
+        if self.sysfs_root != "/sys":
+            return None  # a fake tree without the file means no flags, not ask the real firmware
+        try:
+            out = await run_cmd("vcgencmd", "get_throttled", check=False, sudo=False)
+            return int(out.strip().split("=")[1], 16)
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def load(self) -> list:
+        try:
+            return [float(v) for v in self._read(self.proc_root, "loadavg").split()[:3]]
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def policies(self) -> dict:
+        """ cpufreq policy dir -> (current governor, available governors)"""
+        base = os.path.join(self.sysfs_root, "devices/system/cpu/cpufreq")
+        found = {}
+        try:
+            names = sorted(n for n in os.listdir(base) if n.startswith("policy"))
+        except FileNotFoundError:
+            return found
+        for name in names:
+            try:
+                found[os.path.join(base, name)] = (self._read(base, name, "scaling_governor"),
+                                                   self._read(base, name, "scaling_available_governors").split())
+            except FileNotFoundError:
+                continue
+        return found
+
+    def processes(self) -> dict:
+        """ pid -> component, for the components in NICE"""
+        found = {}
+        for pid in os.listdir(self.proc_root):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.proc_root, pid, "cmdline"), "rb") as fin:
+                    cmdline = fin.read().replace(b"\0", b" ").decode(errors="replace").strip()
+            except (FileNotFoundError, ProcessLookupError, PermissionError):
+                continue
+            component = classify(cmdline)
+            # the restart wrappers are sh loops around the app. Renicing the shell does nothing for it
+            if component in NICE and os.path.basename(cmdline.split()[0]) not in ("sh", "bash", "dash"):
+                found[int(pid)] = component
+        return found
+
+    def threads(self, pid: int) -> list:
+        try:
+            return sorted(int(t) for t in os.listdir(os.path.join(self.proc_root, str(pid), "task")) if t.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def nice_of(self, pid: int, tid: int = None):
+        try:
+            # the fields after the ")" of the comm. nice is field 19 overall
+            stat = self._read(self.proc_root, str(pid), "task", str(tid if tid is not None else pid), "stat")
+            return int(stat.rsplit(")", 1)[1].split()[16])
+        except (FileNotFoundError, IndexError, ValueError):
+            return None
+
+    # decisions
+
+    def next_state(self, temp, flags: int) -> str:
+        if flags is not None and flags & THROTTLING_NOW:
+            return HOT
+        if temp is None:
+            return self.state or COOL  # nothing to go on. Don't move
+        headroom = self.throttle_temp - temp
+        # getting cooler needs the extra hysteresis, getting hotter doesn't
+        warm_at = self.warm_margin + (self.hysteresis if self.state in (WARM, HOT) else 0)
+        hot_at = self.hot_margin + (self.hysteresis if self.state == HOT else 0)
+        if headroom >= warm_at:
+            return COOL
+        if headroom >= hot_at:
+            return WARM
+        return HOT
+
+    # actions
+
+    async def _write(self, path: str, value: str):
+        if os.access(path, os.W_OK):
+            with open(path, "w") as fout:
+                fout.write(value)
+            return
+        # sysfs needs root. sudoers allows tee on the governor files only
+        proc = await asyncio.create_subprocess_exec("sudo", "-n", "tee", path, stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        _, err = await proc.communicate(value.encode())
+        if proc.returncode != 0:
+            raise RuntimeError(f"writing {path} failed: {err.decode().strip()}")
+
+    async def apply_governor(self, state: str) -> dict:
+        governors = {}
+        for policy, (current, available) in self.policies().items():
+            wanted = next((g for g in GOVERNORS[state] if g in available), current)
+            wanted = self.config.get(f"governor_{state}", wanted)
+            if wanted != current and self.manage_governor:
+                try:
+                    await self._write(os.path.join(policy, "scaling_governor"), wanted)
+                    logger.info(f"thermal: {os.path.basename(policy)} governor {current} -> {wanted}")
+                    current = wanted
+                except (OSError, RuntimeError) as e:
+                    logger.warning(f"thermal: couldn't set {wanted} on {os.path.basename(policy)}: {e}")
+            governors[os.path.basename(policy)] = current
+        return governors
+
+    async def apply_priority(self, state: str) -> dict:
+        nice = {}
+        for pid, component in self.processes().items():
+            wanted = NICE[component][state]
+            nices = {tid: self.nice_of(pid, tid) for tid in self.threads(pid)}
+            stale = [tid for tid, n in nices.items() if n is not None and n != wanted]
+            if stale and self.manage_priority:
+                try:
+                    # one setpriority per thread, in one call
+                    await run_cmd("renice", "-n", str(wanted), "-p", *[str(tid) for tid in stale])
+                    nices.update(dict.fromkeys(stale, wanted))
+                except (OSError, RuntimeError) as e:
+                    # a thread may have exited since we listed them. The next loop catches the rest
+                    logger.warning(f"thermal: couldn't renice {component} ({pid}) to {wanted}: {e}")
+            nice[component] = nices.get(pid)
+        return nice
+
+    async def loop(self):
+        temp = self.temperature()
+        flags = await self.throttled()
+        state = self.next_state(temp, flags)
+        if state != self.state:
+            log = logger.warning if state == HOT else logger.info
+            log(f"thermal: {self.state or 'start'} -> {state} at {temp}C, throttle flags {flags if flags is None else hex(flags)}")
+            self.state, self.since = state, time.time()
+            self.changes += 1
+
+        report = {
+            "time": time.time(),
+            "state": state,
+            "since": self.since,
+            "changes": self.changes,
+            "temp_c": temp,
+            "headroom_c": None if temp is None else round(self.throttle_temp - temp, 1),
+            "throttled": None if flags is None else dict(throttle_flags(flags), raw=hex(flags)),
+            "load": self.load(),
+            "governors": await self.apply_governor(state),
+            "nice": await self.apply_priority(state),
+        }
+        atomic_write(THERMAL_PATH, json.dumps(report, indent=2).encode())
+        return report
@@ -0,0 +1,156 @@
+"""
+Interface and mesh history for the homepage graphs.
+
+Every 10 seconds this samples:
+
+    net.<iface>.rx / .tx      bytes/s of every kernel iface (not lo)
+    rns.<iface>.rx / .tx      bytes/s of every RNS interface, from transportd. The ones a server spawns per
+                              connected client are left out, their traffic is in the server's series
+    mesh.peers                peers in the link table
+    mesh.clients              DHCP leases on our APs
+    mesh.rssi                 signal to our parent, dBm, on a mesh client
+    sys.cpu                   percent busy
+    sys.mem_available         MB
+    sys.temp                  degrees C
+
+into a utils.timeseries store (10s for an hour, 1m for a day, 15m for a week, fixed size).
+The live copy goes to tmpfs every sample, the persistent one to ~/.retcon every persist_every
+seconds, so the SD card sees a write every 15 minutes, not every 10 seconds. A series that stops
+reporting (an adapter unplugged, an interface removed) is dropped after expire_after seconds.
+
+    [[timeseries]]
+      #persist_every = 900
+      #max_series = 64
+      #expire_after = 86400
+"""
+import os
+import re
+import time
+import asyncio
+
+from .base_plugin import RetconPlugin
+from utils.batman_mesh import run_cmd
+from utils.link_probe import load_link_table, dhcp_lease_ips
+from utils.memstat import meminfo
+from utils.timeseries import TimeSeriesStore, LIVE_PATH, PERSIST_PATH, MAX_SERIES
+from utils.transportd import command_async
+from utils.wifi_radios import get_radios
+from utils.scan_policy import iface_counters
+
+import logging
+logger = logging.getLogger("retcon")
+
+PERSIST_EVERY = 900
+EXPIRE_AFTER = 24 * 3600
+THERMAL_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+
+def _series_name(name: str) -> str:
+    # "AutoInterface[Default Interface]" -> "AutoInterface_Default_Interface"
+    return re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")
+
+
+def cpu_times() -> tuple:
+    """ (busy, total) jiffies since boot"""
+    with open("/proc/stat") as fin:
+        values = [int(v) for v in fin.readline().split()[1:]]
+    idle = values[3] + (values[4] if len(values) > 4 else 0)  # idle + iowait
+    return sum(values) - idle, sum(values)
+
+
+def temperature():
+    try:
+        with open(THERMAL_PATH) as fin:
+            return int(fin.read()) / 1000
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class TimeseriesPlugin(RetconPlugin):
+
+    PLUGIN_NAME = "timeseries"
+
+    LOOP_INTERVAL = 10
+    LOOP_TIMEOUT = 8
+
+    def init(self):
+        self.persist_every = float(self.config.get("persist_every", PERSIST_EVERY))
+        self.expire_after = float(self.config.get("expire_after", EXPIRE_AFTER))
+        self.store = TimeSeriesStore.load(PERSIST_PATH, max_series=int(self.config.get("max_series", MAX_SERIES)))
+        self.client_iface = self.retcon_config["retcon"]["wifi"].get("client_iface", None)
+        self.ap_ifaces = [r.iface for r in get_radios(self.retcon_config) if r.iface != self.client_iface]
+        self.last_persist = time.time()
+        self.counters = {}  # series -> (time, counter) of the last sample, to turn counters into rates
+        self.cpu = cpu_times()
+        self.warned = set()
+        logger.info(f"timeseries: {len(self.store.names)} series restored, ceiling {self.store.memory_ceiling // 1024}KB")
+
+    def _rate(self, samples: dict, name: str, now: float, counter: int):
+        last = self.counters.get(name)
+        self.counters[name] = (now, counter)
+        if last is not None and now > last[0] and counter >= last[1]:  # a reset counter skips a sample
+            samples[name] = (counter - last[1]) / (now - last[0])
+
+    async def _rssi(self):
+        if self.client_iface is None:
+            return None
+        try:
+            out = await run_cmd("iw", "dev", self.client_iface, "link", check=False, sudo=False)
+        except OSError:
+            return None
+        for line in out.splitlines():
+            line = line.strip()
+            if line.startswith("signal:"):
+                return int(line.split()[1])
+        return None  # not connected
+
+    async def _rns(self, samples: dict, now: float):
+        try:
+            status = await command_async("status", timeout=3)
+        except (OSError, ValueError, asyncio.TimeoutError):
+            return  # transportd down or restarting. Gaps in the graph say so
+        for iface in status.get("interfaces", []):
+            if iface.get("parent"):
+                continue  # a client's connection. Each would be a new series, and the parent counts it already
+            name = _series_name(iface["name"])
+            self._rate(samples, f"rns.{name}.rx", now, iface["rxb"])
+            self._rate(samples, f"rns.{name}.tx", now, iface["txb"])
+
+    async def sample(self) -> dict:
+        now = time.time()
+        samples = {}
+
+        for iface in sorted(os.listdir("/sys/class/net")):
+            if iface == "lo":
+                continue
+            counters = iface_counters([iface])
+            self._rate(samples, f"net.{iface}.rx", now, counters["rx_bytes"])
+            self._rate(samples, f"net.{iface}.tx", now, counters["tx_bytes"])
+
+        await self._rns(samples, now)
+
+        samples["mesh.peers"] = len(load_link_table())
+        samples["mesh.clients"] = sum(len(dhcp_lease_ips(iface)) for iface in self.ap_ifaces)
+        samples["mesh.rssi"] = await self._rssi()
+
+        busy, total = cpu_times()
+        if total > self.cpu[1]:
+            samples["sys.cpu"] = (busy - self.cpu[0]) / (total - self.cpu[1]) * 100
+        self.cpu = (busy, total)
+        samples["sys.mem_available"] = meminfo()["available"] / 1024
+        samples["sys.temp"] = temperature()
+        return samples
+
+    async def loop(self):
+        self.store.add(await self.sample())
+        for name in self.store.expire(self.expire_after):
+            self.counters.pop(name, None)
+            self.warned.discard(name)
+            logger.info(f"timeseries: {name} stopped reporting, dropped it")
+        if self.store.dropped - self.warned:
+            logger.warning(f"timeseries: max_series reached, not recording {sorted(self.store.dropped - self.warned)}")
+            self.warned |= self.store.dropped
+        self.store.save(LIVE_PATH)
+        if time.time() - self.last_persist >= self.persist_every:
+            self.store.save(PERSIST_PATH)
+            self.last_persist = time.time()
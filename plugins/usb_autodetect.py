@@ -35,6 +35,10 @@ rnode_config_template = """
 
 """
 
+# compile once at import instead of on every get_config
+_meshtastic_template = Template(meshtastic_config_template)
+_rnode_template = Template(rnode_config_template)
+
 
 class UsbAutodetectPlugin(RetconPlugin):
 
@@ -72,7 +76,7 @@ class UsbAutodetectPlugin(RetconPlugin):
                 interface_str += "\n\n  # Could not include Meshtastic device. "\
                     f"No verified port among {ports} \n"
             else:
-                interface_str += "\n\n" + Template(meshtastic_config_template).render(
+                interface_str += "\n\n" + _meshtastic_template.render(
                 port=meshtastic_port,
                 **meshtastic_interface_config
             )
@@ -92,7 +96,7 @@ class UsbAutodetectPlugin(RetconPlugin):
                     interface_str += "\n  # Warning, more than one possible RNode port. "\
                         f"Trying first in list: {ports}"
                     
-                interface_str += "\n\n" + Template(rnode_config_template).render(
+                interface_str += "\n\n" + _rnode_template.render(
                     port=ports[0],
                     **rnode_interface_config
                 )
@@ -5,6 +5,7 @@ import sys
 import os
 import time
 import re 
+import json
 from jinja2 import Template
 import sdbus
 import netifaces as ni
@@ -15,6 +16,22 @@ from sdbus_async.networkmanager import (
     AccessPoint,
 )
 from .base_plugin import RetconPlugin
+from utils.access_point import bring_up_ap
+from utils.batman_mesh import BatmanMesh, run_cmd
+from utils.link_probe import LinkProber, load_link_table, link_penalty, dhcp_lease_ips, PROBE_INTERVAL, PROBE_BUDGET
+from utils.state import atomic_write
+from utils.scan_policy import ScanPolicy, SCAN_BACKOFF_MAX, SCAN_BUSY_KBPS, SCAN_MAX_DEFER, FULL_SCAN_EVERY
+from utils.wifi_radios import (
+    ROLE_UPLINK,
+    ROLE_DOWNLINK,
+    get_radios,
+    radios_with_role,
+    gateway_host,
+    main_ap_radio,
+    node_suffix,
+    ap_subnet,
+    wifi_freq_to_channel,
+)
 import logging
 logger = logging.getLogger("retcon")
 
@@ -32,7 +49,7 @@ auto_iface_template = """
   """
   
 tcp_server_iface_template = """
-  [[Wifi Mesh Server Interface]]
+  [[Wifi Mesh Server Interface{{suffix}}]]
   type = BackboneInterface
   enabled = yes
   mode= {{mode}}
@@ -43,58 +60,166 @@ tcp_server_iface_template = """
   """
   
 tcp_client_iface_template = """
-  [[WifiMesh Client Interface]]
+  [[WifiMesh Client Interface{{suffix}}]]
   type = BackboneInterface
   enabled = yes
   mode= {{mode}}
   name = retcon_tcp_client_iface_{{iface}}
-  remote = retcon.gateway
+  remote = {{remote}}
   target_port = 4242
   """
 
+# flat L2 mesh backend. batman-adv takes care of routing so reticulum just needs to find peers on bat0
+batman_iface_template = """
+  [[Wifi Mesh batman-adv Interface]]
+  type = AutoInterface
+  enabled = yes
+  mode= {{mode}}
+  devices = {{iface}}
+  group_id = {{group_id}}
+  name = retcon_batman_iface_{{iface}}
+  
+  """
+
+# compile once at import instead of on every get_config
+_tcp_server_template = Template(tcp_server_iface_template)
+_tcp_client_template = Template(tcp_client_iface_template)
+_batman_template = Template(batman_iface_template)
+
+# last good parent per uplink iface, for a scan free rejoin at boot
+MESH_STATE_PATH = os.path.expanduser("~/.retcon/mesh_state.json")
+REJOIN_DEADLINE = 20          # seconds for the direct rejoin attempts before we fall back to scanning
+REJOIN_MAX_AGE = 7 * 24 * 3600  # older than this and the venue has probably been rebuilt
+REJOIN_FALLBACKS = 3
+
+
+def load_mesh_state() -> dict:
+    try:
+        with open(MESH_STATE_PATH) as fin:
+            return json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+BACKEND_TREE = "tree"      # AP/STA tree with a BackboneInterface per hop (default)
+BACKEND_BATMAN = "batman"  # 802.11s mesh point + batman-adv, one flat L2 segment
+
 class WifiMeshPlugin(RetconPlugin):
 
     PLUGIN_NAME = "wifi_mesh"
     
+    # mesh_up never returns, so run it as a long running task and bring it back if it dies
+    LOOP_INTERVAL = None
+    RESTART_POLICY = "always"
+    
     mesh = None
+    meshes = []
+    prober = None
+    _ap_ifaces = []
     
         
     # plugin config code. Take the config object, the template string
     # and return any Jinja vars in reticulum.config template
     # (for example) plugin_interfaces
     def get_config(self) -> dict:
-        wifi = self.retcon_config["retcon"]["wifi"]
+        radios = get_radios(self.retcon_config)
         
         # Auto interface is too flaky with changing topologies 
         #interface_str =  Template(auto_iface_template).render(iface=wifi['client_iface'], mode="full")
         #interface_str += Template(auto_iface_template).render(iface=wifi['ap_iface'], mode="gateway")
         
-        # tcp interfaces
-        interface_str =  Template(tcp_client_iface_template).render(iface=wifi['client_iface'], mode="full")
-        interface_str += Template(tcp_server_iface_template).render(iface=wifi['ap_iface'], mode="gateway")
+        # tcp interfaces. Each radio gets its own so traffic can use every radio's airtime
+        # extra radios get the iface appended to the section name since those must be unique
+        interface_str = ""
+        if self.backend == BACKEND_BATMAN:
+            wifi = self.retcon_config["retcon"]["wifi"]
+            interface_str += _batman_template.render(iface=wifi.get("bat_iface", "bat0"), mode="full",
+                                                     group_id=wifi.get("mesh_id", wifi["prefix"]))
+        for radio in radios_with_role(radios, ROLE_UPLINK) if self.backend == BACKEND_TREE else []:
+            interface_str += _tcp_client_template.render(iface=radio.iface, mode="full", remote=gateway_host(radio),
+                                                         suffix="" if radio.primary else " " + radio.iface)
+        for radio in radios:
+            if radio.role != ROLE_UPLINK:
+                interface_str += _tcp_server_template.render(iface=radio.iface, mode="gateway",
+                                                             suffix="" if radio.primary else " " + radio.iface)
         return {
             "plugin_interfaces" : interface_str
         }
         
     # An init function that will get called on RETCON startup for init/bootstrapping
-    def init(self) -> None:
+    def init(self):
         logger.info("Init RETCON wifimesh plugin")
 
-        # use multiprocessing for this
-        current_env = os.environ.copy()
-        script_path = os.path.realpath(__file__)
         wifi = self.retcon_config["retcon"]["wifi"]
-        ap_iface = wifi['ap_iface'] if self.retcon_config["retcon"]["mode"] == 'transport' else None
+        is_transport = self.retcon_config["retcon"]["mode"] == 'transport'
+        radios = get_radios(self.retcon_config)
+        main_ap = main_ap_radio(radios, is_transport)
+        ap_iface = main_ap.iface if is_transport and main_ap is not None else None
         if ap_iface:
             self.transport_update_dnsmasq(ap_iface)
-            
-        mesh = RetconMesh(wifi['prefix'].encode(), wifi['psk'], int(wifi['freq']), wifi['client_iface'], ap_iface)
-        self.mesh = mesh
-        #return mesh.mesh_up(self)
-        # process = subprocess.Popen(
-        #     f"python {script_path} '{wifi['prefix']}' '{wifi['psk']}' {wifi['freq']} '{wifi['client_iface']}' '{ap_iface}' ", 
-        #     shell=True, env=current_env)
-
+        
+        # retcon.py already brought up the main AP. Any other AP radios are ours to bring up
+        self._extra_aps = [r for r in radios if r.role != ROLE_UPLINK and r is not main_ap]
+        
+        if self.backend == BACKEND_BATMAN:
+            # one mesh point joins everyone, no parents to pick
+            self.meshes = [BatmanMesh(wifi.get("mesh_id", wifi["prefix"]), wifi["psk"], int(wifi["freq"]),
+                                      wifi.get("batman_iface", wifi["client_iface"]),
+                                      bat_iface=wifi.get("bat_iface", "bat0"))]
+        else:
+            # one mesh client per uplink radio, each with its own scan and parent selection.
+            # Scans wait for the APs to go quiet. We can't tell which APs share a radio with the uplink, so watch them all
+            ap_ifaces = [r.iface for r in radios if r.role != ROLE_UPLINK]
+            self.meshes = [
+                RetconMesh(wifi['prefix'].encode(), wifi['psk'], radio.freq, radio.iface, ap_iface,
+                           gateway_host=gateway_host(radio), exclude_ssids=self.excluded_parents,
+                           scan_policy=ScanPolicy(radio.iface, ap_ifaces,
+                                                  backoff_max=float(self.config.get("scan_backoff_max", SCAN_BACKOFF_MAX)),
+                                                  busy_kbps=float(self.config.get("scan_busy_kbps", SCAN_BUSY_KBPS)),
+                                                  max_defer=float(self.config.get("scan_max_defer", SCAN_MAX_DEFER)),
+                                                  full_scan_every=int(self.config.get("full_scan_every", FULL_SCAN_EVERY))))
+                for radio in radios_with_role(radios, ROLE_UPLINK)
+            ]
+            # init runs before rnsd starts, so the gateway it resolves is the one we expect to rejoin
+            for mesh in self.meshes:
+                mesh.prepare_rejoin()
+        self.mesh = self.meshes[0] if len(self.meshes) > 0 else None
+        
+        # measure the links to our parent(s) and children, not just their RSSI. batman does its own
+        if self.backend == BACKEND_TREE and str(self.config.get("probe", True)).lower() not in ("false", "no", "0"):
+            self._ap_ifaces = [r.iface for r in radios if r.role != ROLE_UPLINK] if is_transport else []
+            self.prober = LinkProber(self.probe_peers, interval=float(self.config.get("probe_interval", PROBE_INTERVAL)),
+                                     budget=int(self.config.get("probe_budget", PROBE_BUDGET)))
+        
+        if len(self._extra_aps) > 0:
+            return self.bring_up_extra_aps()
+        
+    async def bring_up_extra_aps(self):
+        wifi = self.retcon_config["retcon"]["wifi"]
+        node_id = uuid.getnode()
+        for i, radio in enumerate(self._extra_aps):
+            # one radio failing (missing key, driver refusing AP mode) shouldn't keep the others down
+            try:
+                if radio.role == ROLE_DOWNLINK:
+                    ssid, psk = wifi["prefix"] + node_suffix(node_id), wifi["psk"]
+                else:
+                    ssid = wifi.get("client_ap_prefix", wifi["prefix"]) + node_suffix(node_id)
+                    psk = wifi.get("client_ap_psk", wifi["psk"])
+                await bring_up_ap(radio.iface, ssid, psk, radio.channel, ap_subnet(node_id, i + 1),
+                                  connection_id=f"retcon_ap_{radio.iface}")
+            except Exception as e:
+                logger.error(f"Could not bring up {radio.role} AP on {radio.iface}: {e!r}")
+    
+    @property
+    def backend(self) -> str:
+        backend = self.retcon_config["retcon"]["wifi"].get("backend", BACKEND_TREE)
+        if backend not in (BACKEND_TREE, BACKEND_BATMAN):
+            raise ValueError(f"Unknown wifi mesh backend '{backend}'. Must be {BACKEND_TREE} or {BACKEND_BATMAN}")
+        return backend
+        
+    def excluded_parents(self, mesh) -> set:
+        """ SSIDs a mesh client shouldn't pick as parent. Our own APs and the parents our other radios already use"""
+        own_ssids = {self.node_ssid, (self.retcon_config["retcon"]["wifi"]["prefix"] + node_suffix(uuid.getnode())).encode()}
+        return own_ssids | {m.parent_ssid for m in self.meshes if m is not mesh and m.parent_ssid is not None}
 
     def transport_update_dnsmasq(self, ap_iface):
         # update the DNS masd file so retcon stuff points to us
@@ -107,15 +232,30 @@ class WifiMeshPlugin(RetconPlugin):
             fout.write(redirect_str)
         
         
+    def probe_peers(self) -> list:
+        """ (ip, role, label) for every hop we should be probing right now"""
+        peers = [(m.gateway_ip, "parent", m.parent_ssid.decode(errors="replace"))
+                 for m in self.meshes if getattr(m, "gateway_ip", None) and m.parent_ssid is not None]
+        for iface in self._ap_ifaces:
+            peers += [(ip, "child", iface) for ip in dhcp_lease_ips(iface)]
+        return peers
+        
     async def loop(self):
-        await self.mesh.mesh_up(self)
+        # if one mesh client or the prober dies, take the rest down with it so the restart starts clean
+        # (a leftover prober would still hold its UDP port)
+        async with asyncio.TaskGroup() as group:
+            for m in self.meshes:
+                group.create_task(m.mesh_up(self))
+            if self.prober is not None:
+                group.create_task(self.prober.run())
     
 
 class RetconMesh:
     
     MIN_STREN = 33  # below this we won't try to connect
     
-    def __init__(self, ssid_prefix: bytes, password:str, freq: int, client_iface: str, ap_iface=None):
+    def __init__(self, ssid_prefix: bytes, password:str, freq: int, client_iface: str, ap_iface=None,
+                 gateway_host="retcon.gateway", exclude_ssids=None, scan_policy=None):
         
         # explicit type check since it's so easy to mess up
         if type(ssid_prefix) == str:
@@ -135,6 +275,13 @@ class RetconMesh:
         self._dynamic_auto_iface = None
         self._last_client_connection_time = None
         #client state
+        self.gateway_host = gateway_host # name we put in /etc/hosts for our parent
+        self._exclude_ssids = exclude_ssids # callable(mesh) -> set of ssids we must not pick as parent
+        self.parent_ssid = None
+        self.gateway_ip = None # parent's address on its AP, what the link prober measures
+        self.lease_ip = None
+        self._hosts_gateway = None # what /etc/hosts says gateway_host is, reticulum already uses that
+        self.scan_policy = scan_policy or ScanPolicy(client_iface, [ap_iface] if ap_iface else [])
         
     async def mesh_up(self, plugin=None) -> None:
         # Init devices  
@@ -167,18 +314,27 @@ class RetconMesh:
             raise ConnectionError("Could not find ap iface " + self.ap_iface)
         
         
-        self._scan_task = asyncio.create_task(self._scan_loop())
+        await self.fast_rejoin()
+        # under the plugin runtime the scan loop is a child of loop(), so a crash in it restarts the mesh
+        spawn = plugin.spawn if plugin is not None else asyncio.create_task
+        self._scan_task = spawn(self._scan_loop(), name=f"scan-{self.client_iface}")
         
         # busy loop here to keep control
-        while self._active:
-            await asyncio.sleep(5)
+        try:
+            while self._active:
+                await asyncio.sleep(5)
+        finally:
+            self._scan_task.cancel()
                     
         
     async def _scan_loop(self):
         while self._active:
-            if await self._should_scan():
-                logger.info("Scanning...")
-                await self.client.request_scan({})
+            connected = await self.active_client_ap is not None
+            if self.scan_policy.ready(connected, wanted=await self._should_scan()):
+                plan = self.scan_policy.plan()
+                scan = self.scan_policy.begin(plan)
+                logger.info(f"Scanning {self.freq} ({plan['kind']}, {len(plan['ssids'])} ssids)...")
+                await self._trigger_scan(plan["ssids"])
                 logger.info("Sleeping...")
                 await asyncio.sleep(3)
                 ap_paths = await self.client.access_points
@@ -198,6 +354,7 @@ class RetconMesh:
                             logger.warning(f"Expected {self.freq} but ap with ssid={ssid} had {freq}")
                 
                 self._client_ap_choices = valid_aps
+                self.scan_policy.end(scan, [await ap.ssid for ap in valid_aps], self.freq)
                 if len(self._client_ap_choices) > 0:
                     try:
                         await self.connect_client()
@@ -205,13 +362,34 @@ class RetconMesh:
                         logger.error("ERROR! " + str(e))
                         logger.error("re-looping")
             
-            # wait before next scan
+            # wait before next check. The policy decides when a scan actually goes out
             await asyncio.sleep(5)
+
+    async def _trigger_scan(self, ssids: list):
+        """ scan just our freq, probing for ssids (all of them if empty). Falls back to a NetworkManager scan"""
+        cmd = ["iw", "dev", self.client_iface, "scan", "trigger", "freq", str(self.freq)]
+        for ssid in ssids:
+            cmd += ["ssid", ssid.decode(errors="replace")]
+        try:
+            await run_cmd(*cmd)
+            return
+        except Exception as e:
+            logger.info(f"iw scan trigger failed ({e}), asking NetworkManager")
+        try:
+            # NM can't limit the freq, but it can at least direct the probes
+            await self.client.request_scan({"ssids": ("aay", ssids)} if ssids else {})
+        except Exception as e:
+            logger.warning(f"scan request failed: {e}")
             
     async def connect_client(self):
         # Go through all the valid APs and pick one to connect to
         aps = [(x, await x.ssid, await x.strength) for x in self._client_ap_choices]
-        aps.sort(key=lambda y: y[2], reverse=True) # sort by strength DESC
+        if self._exclude_ssids is not None:
+            excluded = self._exclude_ssids(self)
+            aps = [x for x in aps if x[1] not in excluded]
+        # sort by strength DESC, less whatever the link prober measured against parents we've used before
+        links = {e.get("label"): e for e in load_link_table().values() if e.get("role") == "parent"}
+        aps.sort(key=lambda y: y[2] - link_penalty(links.get(y[1].decode(errors="replace"))), reverse=True)
         logger.info("APs :", aps)
         if len(aps) == 0:
             return
@@ -229,22 +407,44 @@ class RetconMesh:
                 cand_ap, cand_ssid, cand_str = aps[i]
                 i+=1
         
+        cand_bssid = await cand_ap.hw_address
+        if await self._join(cand_ssid, cand_bssid):
+            # remember it, plus the next best, for a scan free rejoin after a reboot
+            fallbacks = [{"ssid": ssid.decode(errors="replace"), "bssid": await ap.hw_address}
+                         for ap, ssid, _ in aps if ssid != cand_ssid][:REJOIN_FALLBACKS]
+            self.save_state(cand_bssid, fallbacks)
+        
+    async def _join(self, ssid: bytes, bssid: str = None, ip_poll: float = 5, ip_tries: int = 10) -> bool:
+        """ associate to ssid (that exact AP if bssid is given), wait for a lease and point reticulum at it"""
         active_ap = await self.active_client_ap
         if active_ap is not None:
-            if await active_ap.ssid != cand_ssid:
+            if await active_ap.ssid != ssid:
                 await self.client.disconnect()
 
-        logger.info("connecting to ", cand_ssid)
-        connection = await NetworkManagerSettings().add_connection_unsaved(
+        logger.info("connecting to ", ssid)
+        wireless = {"ssid": ("ay", ssid), "mode": ("s", "infrastructure")}
+        if bssid is not None:
+            # pinning the AP and its channel lets the supplicant go straight there instead of scanning around
+            wireless.update({"bssid": ("ay", bytes.fromhex(bssid.replace(":", ""))), "band": ("s", "bg"),
+                             "channel": ("u", wifi_freq_to_channel[self.freq])})
+        # same uuid for the same parent every time. NM's dhcp client keeps its lease per connection uuid,
+        # so a rejoin asks the parent for the address we had instead of starting from discover
+        connection_uuid = str(uuid.uuid5(uuid.NAMESPACE_DNS, f"retcon-mesh.{self.client_iface}.{ssid.hex()}"))
+        settings = NetworkManagerSettings()
+        try:
+            await settings.delete_connection_by_uuid(connection_uuid)
+        except sdbus.SdBusBaseError:
+            pass # first time on this parent
+        connection = await settings.add_connection_unsaved(
             {
                 "connection": {
                     "type": ("s", "802-11-wireless"),
-                    "uuid": ("s", str(uuid.uuid4())),
-                    "id": ("s", "RETCON_WIFI_MESH"),
+                    "uuid": ("s", connection_uuid),
+                    "id": ("s", "RETCON_WIFI_MESH" if self.gateway_host == "retcon.gateway" else f"RETCON_WIFI_MESH_{self.client_iface}"),
                     "interface-name": ("s", self.client_iface),
                     "autoconnect": ("b", False),
                 },
-                "802-11-wireless": {"ssid": ("ay", cand_ssid), "mode": ("s", "infrastructure")},
+                "802-11-wireless": wireless,
                 "802-11-wireless-security" : {"key-mgmt": ("s", "wpa-psk"), "auth-alg": ("s", "open"), "psk": ("s", self.password)},
                 "ipv4": {"method": ("s", "auto")},
                 "ipv6": {"method": ("s", "auto")},
@@ -260,13 +460,13 @@ class RetconMesh:
         self._last_client_connection_time = time.time()
         
         # After we have dchp, change /etc/hosts so retcon.gateway goes to our gateway
-        retry = 10
+        retry = ip_tries
         ip = None
         
         while ip is None and retry > 0:
             try:
                 logger.info("Attemping to get IP for TCP client")
-                await asyncio.sleep(5)
+                await asyncio.sleep(ip_poll)
                 retry-=1
                 ip = ni.ifaddresses(self.client_iface)[ni.AF_INET][0]['addr']
                 logger.info(f"Got IP {ip}")
@@ -275,21 +475,111 @@ class RetconMesh:
             
         if ip is None:
             await self.client.disconnect()
-            
+            self.parent_ssid = None
+            self.gateway_ip = None
+            return False
+        
+        if self.lease_ip is not None:
+            logger.info(f"Got {'our previous' if ip == self.lease_ip else 'a new'} lease {ip}")
+        self.parent_ssid = ssid
+        self.lease_ip = ip
+        self.gateway_ip = '.'.join(ip.split(".")[0:3] + ['1'])
+
+        if self.gateway_ip == self._hosts_gateway:
+            # hosts was already right when reticulum started. Its tcp client reconnects by itself
+            logger.info(f"{self.gateway_host} is still {self.gateway_ip}, not restarting reticulum")
+            return True
+        self._write_gateway_host(self.gateway_ip)
+
+        logger.info("Dynamically rebooting reticulum")
+        await self.plugin.restart_rnsd()
+        await asyncio.sleep(10)
+        logger.info("done")
+        return True
+
+    def _write_gateway_host(self, gateway_ip: str):
+        """ point gateway_host at gateway_ip in /etc/hosts"""
         with open("/etc/hosts", 'r') as fin:
             logger.info("Reading hosts file")
             hosts = fin.read()
      
         with open("/etc/hosts", "w") as fout:
-            fout.write(re.sub(r'\d+\.\d+\.\d+\.\d+ retcon\.gateway','',hosts))
-            gateway_ip = '.'.join(ip.split(".")[0:3] + ['1'])
+            fout.write(re.sub(r'\d+\.\d+\.\d+\.\d+ ' + re.escape(self.gateway_host) + '$','',hosts, flags=re.M))
             logger.info(f"Writing gateway_ip = {gateway_ip} to hosts file")
-            fout.write(f"\n{gateway_ip} retcon.gateway")
-        
-        logger.info("Dynamically rebooting reticulum")
-        await self.plugin.restart_rnsd()
-        await asyncio.sleep(10)
-        logger.info("done")
+            fout.write(f"\n{gateway_ip} {self.gateway_host}")
+        self._hosts_gateway = gateway_ip
+
+    def save_state(self, bssid: str, fallbacks: list):
+        state = load_mesh_state()
+        state[self.client_iface] = {
+            "time": time.time(),
+            "freq": self.freq,
+            "parent": {"ssid": self.parent_ssid.decode(errors="replace"), "bssid": bssid},
+            "lease_ip": self.lease_ip,
+            "gateway_ip": self.gateway_ip,
+            "fallbacks": fallbacks,
+        }
+        try:
+            atomic_write(MESH_STATE_PATH, json.dumps(state, indent=2).encode())
+        except OSError as e:
+            logger.warning(f"Couldn't save mesh state: {e}")
+
+    def _saved_state(self):
+        """ what save_state left for this radio, None if it's too old or for another channel"""
+        state = load_mesh_state().get(self.client_iface)
+        if state is None or state.get("freq") != self.freq or time.time() - state.get("time", 0) > REJOIN_MAX_AGE:
+            return None
+        return state
+
+    def prepare_rejoin(self):
+        """
+        Point gateway_host at the last parent before reticulum starts. If fast_rejoin gets us back on
+        the same parent (the usual case) reticulum is already aimed at it and doesn't need a restart
+        """
+        state = self._saved_state()
+        if state is None or not state.get("gateway_ip"):
+            return
+        self.lease_ip = state.get("lease_ip")
+        try:
+            self._write_gateway_host(state["gateway_ip"])
+        except OSError as e:
+            logger.warning(f"Couldn't pre-write {self.gateway_host}: {e}")
+
+    async def fast_rejoin(self, deadline: float = REJOIN_DEADLINE) -> bool:
+        """
+        Straight to the last good parent (then its fallbacks) without a scan. After a power blip
+        the whole venue comes back at once and everyone's parent is usually still where it was.
+        Gives up after deadline seconds and leaves it to the scan loop
+        """
+        state = self._saved_state()
+        if state is None:
+            return False
+        excluded = self._exclude_ssids(self) if self._exclude_ssids is not None else set()
+        candidates = [state["parent"]] + state.get("fallbacks", [])
+        # a directed scan for them is the next best thing if none of them answer
+        self.scan_policy.known_ssids |= {c["ssid"].encode() for c in candidates}
+
+        start = time.time()
+        for cand in candidates:
+            ssid = cand["ssid"].encode()
+            remaining = deadline - (time.time() - start)
+            if remaining <= 0:
+                break
+            if ssid in excluded or not ssid.startswith(self.ssid_prefix):
+                continue
+            logger.info(f"Fast rejoin: trying {cand['ssid']} ({cand['bssid']}), {remaining:.0f}s left")
+            try:
+                if await asyncio.wait_for(self._join(ssid, cand["bssid"], ip_poll=0.5, ip_tries=int(remaining * 2)), remaining + 15):
+                    logger.info(f"Fast rejoin to {cand['ssid']} took {time.time() - start:.1f}s")
+                    return True
+            except asyncio.TimeoutError:
+                pass
+            except Exception as e:
+                logger.warning(f"Fast rejoin to {cand['ssid']} failed: {e!r}")
+        logger.info("Fast rejoin failed, scanning")
+        if await self.active_client_ap is not None:
+            await self.client.disconnect()
+        return False
 
             
     @property
@@ -323,6 +613,13 @@ class RetconMesh:
         if not valid_connection:
             return True
         
+        # strong signal but the prober says the link itself is bad (congested, broken backhaul). Look for another
+        # parent, once it's had a couple of minutes to settle
+        if self.gateway_ip is not None and time.time() - self._last_client_connection_time > 120:
+            if link_penalty(load_link_table().get(self.gateway_ip)) >= 30:
+                logger.info(f"Link to parent {ssid} is bad. Rescanning")
+                return True
+        
         # If we got this far, then it is valid, so if it's been longer than 10 minutes than we connected, we should scan
         return time.time() - self._last_client_connection_time > 600
             
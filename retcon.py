@@ -4,50 +4,38 @@ import os
 import sys
 import importlib.util
 import asyncio
-import time
 import subprocess
 import signal
 import uuid
-from base64 import a85encode
+import threading
+import netifaces as ni
     
 
-from utils.rns_config_gen import generate_rns_config, get_recton_config
+from utils.rns_config_gen import generate_rns_config, get_recton_config, write_rns_config
 from utils.meshchat_handler import MeshchatHandle
+from utils.access_point import bring_up_ap
+from utils.wifi_radios import get_radios, main_ap_radio, node_suffix, ap_subnet
+from utils.announce_scheduler import AnnounceScheduler
+from utils import transportd
+from utils.diagnostics import LOG_PATH, LOG_FORMAT, LOG_MAX_BYTES, LOG_BACKUPS
+from plugins.runtime import PluginRuntime
 
 import logging
 from logging.handlers import RotatingFileHandler
 logger = logging.getLogger("retcon")
 
-wifi_channel_to_freq = {
-    1: 2412,
-    2: 2417,
-    3: 2422,
-    4: 2427,
-    5:2432,
-    6: 2437,
-    7: 2442,
-    8: 2447,
-    9: 2452,
-    10: 2457,
-    11:2462,
-    12: 2467,
-    13: 2472,
-    14: 2484
-}
+RNSH_ANNOUNCE_EVERY = 3600
 
-wifi_freq_to_channel = {f:c for c,f in wifi_channel_to_freq.items()}
 
 
 # This script will be our entry point for RETCON
 if __name__ == "__main__":
     logger.setLevel(logging.DEBUG)
-    LOG_PATH = os.path.expanduser("~/retcon.log")
 
-    # Add the log message handler to the logger
-    handler = RotatingFileHandler(LOG_PATH, maxBytes=20*1024*1024, backupCount=4)
-
-    # uncomment below to enable log file storage for debugging
-    #logger.addHandler(handler)
+    # Add the log message handler to the logger. Admins fetch these over the mesh, see utils/diagnostics.py
+    handler = RotatingFileHandler(LOG_PATH, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
 
     # where are we now?
     dir_path = os.path.dirname(os.path.realpath(__file__)) 
@@ -64,6 +52,8 @@ if __name__ == "__main__":
     # are we just a transport? or should we launch ui?
     is_transport = r_config.get("mode", "client") == "transport"
     is_client = r_config.get("mode", "client") == "client"
+    # compact = admin console, homepage and plugins share this one interpreter. For 512MB boards
+    compact = r_config.get("run_mode", "standard") == "compact"
     
     wifi_config = r_config["wifi"]
     
@@ -71,52 +61,71 @@ if __name__ == "__main__":
         logger.info("ERROR!  'prefix', 'psk', and freq are required in [[wifi]] section of config")
         exit()
         
-    client_iface = wifi_config["client_iface"]
-    ap_iface = wifi_config["ap_iface"]
     node_id = uuid.getnode() 
     
+    # which radio hosts the AP we bring up at boot. Any extra radios are handled by the wifi_mesh plugin
+    ap_radio = main_ap_radio(get_radios(config), is_transport)
+    if ap_radio is None:
+        logger.info("ERROR! No wifi radio with a role to host the AP")
+        exit()
+    ap_iface = ap_radio.iface
+    
     if is_client:
-        ssid = wifi_config.get("client_ap_prefix", wifi_config["prefix"]) + a85encode(node_id.to_bytes(6, signed=False)).decode()
+        ssid = wifi_config.get("client_ap_prefix", wifi_config["prefix"]) + node_suffix(node_id)
         psk = wifi_config.get("client_ap_psk", wifi_config["psk"])
     else:
-        ssid = wifi_config["prefix"] + a85encode(node_id.to_bytes(6, signed=False)).decode()
+        ssid = wifi_config["prefix"] + node_suffix(node_id)
         psk = wifi_config['psk']
         
-    channel = wifi_freq_to_channel[int(wifi_config["freq"])]
+    channel = ap_radio.channel
     if is_transport:
-        # we can't have collisions so use the las bits of the node_id to generate an ipv4 subnet range 
-        ip_subnet_bytes = (node_id  & 0xFFFF).to_bytes(2)
-        # avoid collisions with client AP. That will girnd things to a hault for them
-        if ip_subnet_bytes[0] == 42 and ip_subnet_bytes[1] == 1:
-            ip_subnet_bytes = [42,2]
-        ip_subnet_str = f"10.{ip_subnet_bytes[0]}.{ip_subnet_bytes[1]}.1/24"
+        ip_subnet_str = ap_subnet(node_id)
     else:
         ip_subnet_str ="10.42.0.1/24" # need these to always be the same for DNS to work and this is the default
     
+    rnsd_tasks=[]
+    # set once the transport daemon owns the shared instance. Everything that uses reticulum waits on it
+    transportd_up = asyncio.Event()
     
-    # TODO: We should really use dbus directly for this, but nmcli is so much easier
-    # Setup wifi interfaces
-    commands = [
-        "nmcli connection delete preconfigured", # bring down and connection that user preconfiged to setup retcon
-        "nmcli connection delete RETCON_WIFI_MESH",
-        "nmcli connection delete retcon_ap",
-        f"nmcli con add con-name retcon_ap ifname {ap_iface} type wifi ssid '{ssid}'",
-        f"nmcli con modify retcon_ap wifi-sec.key-mgmt wpa-psk",
-        f"nmcli con modify retcon_ap wifi-sec.psk '{psk}' ",
-        f"nmcli con modify retcon_ap 802-11-wireless.mode ap 802-11-wireless.band bg 802-11-wireless.channel {channel} ipv4.method shared ipv4.addresses {ip_subnet_str}"
-    ]
-    for command in commands:
-        logger.info(command)
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-        process.wait()
+    async def run_transportd():
+        # the daemon owns the interfaces. Admin, meshchat and rnsh are all shared instance clients of it
+        # if it dies, start it again. A config reload re-execs in place, so that isn't an exit
+        while True:
+            proc = await asyncio.create_subprocess_exec("python", f"{dir_path}/utils/transportd.py", env=os.environ.copy())
+            if await transportd.wait_ready():
+                transportd_up.set()
+            else:
+                logger.error("transportd didn't come up")
+            code = await proc.wait()
+            transportd_up.clear()
+            logger.error(f"transportd exited with {code}. Restarting")
+            await asyncio.sleep(5)
     
-    logger.info("Brought up AP now letting it settle")
-    time.sleep(10)
+    def start_homepage(admin):
+        # same flask app retcon_client_ui.py runs standalone, sharing our RetconAdmin
+        from client_web_ui import retcon_client_ui
+        retcon_client_ui.admin = admin
+        ip = ni.ifaddresses(ap_iface)[ni.AF_INET][0]['addr']
+        logger.info(f"Serving retcon homepage on {ip} in process")
+        retcon_client_ui.start_artifact_server(ip)
+        threading.Thread(target=retcon_client_ui.app.run, kwargs={"host": ip, "port": 80, "use_reloader": False},
+                         daemon=True).start()
     
-    rnsd_tasks=[]
+    async def run_compact_console():
+        # admin.py and the UI import their siblings as top level modules
+        sys.path.append(f"{dir_path}/utils")
+        from admin import RetconAdmin, LXMFAdminConsole
+        admin = RetconAdmin(ssid)
+        if is_client:
+            start_homepage(admin)
+        # the console's RNS.Reticulum() is the only reticulum client in this process
+        await LXMFAdminConsole(admin).loop()
     
     async def run_admin_interfaces():
-        await asyncio.sleep(5) # give some time for wifimesh and other init before loading admin iface
+        await transportd_up.wait()
+        if compact:
+            await run_compact_console()
+            return
         env_copy = os.environ.copy()
         
         # admin interface
@@ -124,78 +133,79 @@ if __name__ == "__main__":
         rnsd_tasks.append(t)
     
     async def restart_rnsd():
-        logger.info("restarting rnsd")
-        old_tasks = [x for x in rnsd_tasks]
-        rnsd_tasks.clear()
-        for t in old_tasks:
-            t.terminate()
-        for t in old_tasks:
-            t.wait()
-            
-        await asyncio.sleep(1)
-        await run_admin_interfaces()
+        # ask the daemon to pick up config/network changes. Admin, meshchat and rnsh keep running
+        logger.info("reloading transportd")
+        try:
+            result = await transportd.command_async("reload")
+            logger.info(f"transportd reload: {result}")
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            logger.error(f"Couldn't reach transportd to reload it: {e!r}")
         
 
     # init any plugins defined in the retcon profile and run admin iface
     loaded_plugins = {}
+    plugin_runtime = PluginRuntime(loaded_plugins)
     async def load_plugins():
-        import plugins
-        from plugins.base_plugin import RetconPlugin
-        
-        subclses = RetconPlugin.__subclasses__()
-        plugin_classes = {cls.PLUGIN_NAME : cls for cls in subclses}
+        from plugins import load_plugin_class, import_times
         
-        #load all defined plugins
+        #load all defined plugins. Only these get imported
         for plugin_name, plugin_config in config.get("retcon_plugins",{}).items():
             logger.info("Loading plugin "+ plugin_name)
-            # spec = importlib.util.spec_from_file_location(plugin_name,f"{dir_path}/plugins/{plugin_name}.py")
-            # mod  = importlib.util.module_from_spec(spec)
-            # spec.loader.exec_module(mod)
-            # cls = mod.plugin
-            cls = plugin_classes[plugin_name]
+            cls = load_plugin_class(plugin_name)
             loaded_plugins[plugin_name] = cls(ssid, plugin_config, config, restart_rnsd)
         
+        logger.info(f"Plugin import times: {', '.join(f'{k}={v:.3f}s' for k, v in import_times.items())}")
+        
         # regenerate rns config based on hardware and plugins
-        rns_config = generate_rns_config(loaded_plugins, profile)
-        with open(os.path.expanduser("~/.reticulum/config"), "w") as fin:
-            fin.write(rns_config)
+        # get_config can block (e.g. probing serial ports) so the runtime runs them in the executor
+        plugin_vars = await plugin_runtime.get_configs()
+        rns_config = generate_rns_config(loaded_plugins, profile, plugin_vars=plugin_vars, validate=True)
+        if write_rns_config(rns_config):
+            logger.info("Reticulum config changed. Wrote new config")
+        else:
+            logger.info("Reticulum config unchanged. Skipping write")
             
         # init all the plugins and await any that return tasks
-        plugin_tasks = []
-        for plugin in loaded_plugins.values():
-            maybe_awaitable = plugin.init()
-            if maybe_awaitable is not None:
-                plugin_tasks.append(maybe_awaitable)
-                
-        await asyncio.gather(*plugin_tasks)
+        await plugin_runtime.init_all()
 
    
     #tasks to run if we're in ui mode
     # these wont be run if we're in transport mode
     async def run_ui_tasks():
+        await transportd_up.wait()
         await asyncio.sleep(3) # sleep for a few seconds to allow server to settle
         logger.info("Starting meshchat")
-        MeshchatHandle.start_meshchat(ap_iface, ssid, config)
+        MeshchatHandle.start_meshchat(ap_iface, ssid, config, homepage=not compact)
         await asyncio.sleep(2)
         
         
     async def run_rnsh():
-        await asyncio.sleep(15) # run absolutely last 
+        # rnsh announces on start and then on its own timer, so jitter both per node
+        announce_scheduler = AnnounceScheduler.from_config(node_id, config, RNSH_ANNOUNCE_EVERY)
+        await transportd_up.wait()
+        await asyncio.sleep(15 + announce_scheduler.startup_delay("rnsh")) # run absolutely last 
         # rnsh interface
         logger.info("Starting RNSH")
         rnsh_admins = r_config.get("rnsh_admins",[])
         if len(rnsh_admins) > 0 :
-            subprocess.Popen("rnsh -l -b 3600 " + " ".join([f"-a {x}" for x in rnsh_admins]), env=os.environ.copy(), shell=True)
+            period = int(announce_scheduler.period("rnsh", RNSH_ANNOUNCE_EVERY))
+            subprocess.Popen(f"rnsh -l -b {period} " + " ".join([f"-a {x}" for x in rnsh_admins]), env=os.environ.copy(), shell=True)
     
     async def run():
+        # startup the ap, this is the same  whether we're a transport or client
+        # only rewrites/re-activates the profile when something actually changed
+        try:
+            await bring_up_ap(ap_iface, ssid, psk, channel, ip_subnet_str)
+        except Exception as e:
+            logger.error(f"Could not bring up AP on {ap_iface}: {e!r}")
+        
         # busy loop so we don't exit
         async def busy_loop():
             await load_plugins()
             await asyncio.sleep(1)
-            while True:
-                plugin_loops = [x.loop() for x in loaded_plugins.values()]
-                await asyncio.gather(*plugin_loops)
-                await asyncio.sleep(60)
+            # the reticulum config is written now, so the daemon can start with it.
+            # each plugin loop runs on its own schedule, supervised by the runtime
+            await asyncio.gather(run_transportd(), plugin_runtime.run())
                 
         tasks = [busy_loop(), run_admin_interfaces(), run_rnsh()]
         if is_client:
@@ -15,5 +15,6 @@ nvm use default
 
 
 
-python retcon.py
+# authbind lets the compact run mode serve the homepage on port 80 from retcon.py itself
+authbind --deep python retcon.py
 
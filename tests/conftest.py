@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the code runs from the repo root with utils/ on the path too (admin.py and friends import bare)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "utils")]
@@ -0,0 +1,76 @@
+import gzip
+import http.client
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from utils import artifact_server as art
+
+JS = b"function retcon() { return 'mesh'; }\n" * 400
+FIRMWARE = b"\x00\x01\x02\x03" * 4096
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """ an ArtifactServer on a free port whose warm() waits for release.set()"""
+    root = tmp_path / "artifacts"
+    root.mkdir()
+    (root / "app.js").write_bytes(JS)
+    (root / "rnode.bin").write_bytes(FIRMWARE)
+    release = threading.Event()
+    warm = art.ArtifactStore.warm
+
+    def slow_warm(store):
+        release.wait(10)
+        return warm(store)
+
+    monkeypatch.setattr(art.ArtifactStore, "warm", slow_warm)
+    srv = art.ArtifactServer({"/artifacts/": str(root)}, host="127.0.0.1", port=0,
+                             cache_dir=str(tmp_path / "cache")).start()
+    srv.release = release
+    yield srv
+    release.set()
+    srv.shutdown()
+
+
+def _get(server, path, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", server.httpd.server_port, timeout=10)
+    conn.request("GET", path, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+    return response, body
+
+
+def test_serves_before_warm_is_done_then_compressed(server):
+    response, body = _get(server, "/artifacts/app.js", {"Accept-Encoding": "gzip"})
+    assert response.status == 200
+    assert response.getheader("Content-Encoding") is None and body == JS
+
+    server.release.set()
+    assert server.store.warmed.wait(10)
+    response, body = _get(server, "/artifacts/app.js", {"Accept-Encoding": "gzip"})
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert gzip.decompress(body) == JS
+
+
+def test_firmware_goes_out_raw(server):
+    server.release.set()
+    assert server.store.warmed.wait(10)
+
+    response, body = _get(server, "/artifacts/rnode.bin", {"Accept-Encoding": "gzip, br"})
+    assert response.getheader("Content-Encoding") is None and body == FIRMWARE
+
+    response, body = _get(server, "/artifacts/rnode.bin", {"Range": "bytes=100-"})
+    assert response.status == 206 and body == FIRMWARE[100:]
+
+
+def test_stats_add_up_across_threads(server):
+    server.release.set()
+    with ThreadPoolExecutor(8) as pool:
+        sizes = list(pool.map(lambda _: len(_get(server, "/artifacts/rnode.bin")[1]), range(40)))
+
+    assert server.stats["requests"] == 40
+    assert server.stats["bytes"] == sum(sizes) == 40 * len(FIRMWARE)
+    assert server.stats["active"] == 0
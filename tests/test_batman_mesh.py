@@ -0,0 +1,32 @@
+import asyncio
+import os
+
+import pytest
+
+from utils import batman_mesh
+from utils.batman_mesh import BatmanMesh
+
+
+@pytest.mark.parametrize("psk", ['pass"\nctrl_interface=/tmp/x', "line\nbreak", "tab\there"])
+def test_psk_that_would_break_out_of_the_conf_string_is_refused(psk):
+    with pytest.raises(ValueError):
+        BatmanMesh("RT-", psk, 2462, "wlan1")
+    with pytest.raises(ValueError):
+        BatmanMesh(psk, "secret", 2462, "wlan1")
+
+
+def test_supplicant_conf(tmp_path, monkeypatch):
+    started = []
+
+    async def create_subprocess_exec(*args):
+        started.append(args)
+
+    monkeypatch.setattr(batman_mesh.asyncio, "create_subprocess_exec", create_subprocess_exec)
+    mesh = BatmanMesh("RT-", "it's a secret \\ ok", 2462, "wlan1", state_dir=str(tmp_path))
+    asyncio.run(mesh._start_supplicant())
+
+    conf = (tmp_path / "wpa_mesh.conf").read_text()
+    assert '    psk="it\'s a secret \\ ok"\n' in conf
+    assert oct(os.stat(tmp_path / "wpa_mesh.conf").st_mode & 0o777) == "0o600"
+    # the exact form the sudoers rule allows
+    assert started[0][-6:] == ("-i", "mesh0", "-c", str(tmp_path / "wpa_mesh.conf"), "-D", "nl80211")
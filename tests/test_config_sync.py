@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+RNS = pytest.importorskip("RNS")
+pytest.importorskip("LXMF")
+
+from utils import config_sync as cs  # noqa: E402
+
+
+class FakeAdmin:
+    name = "node"
+    admins = []
+
+    def __init__(self, signers):
+        self.config = {"retcon": {"config_signers": ",".join(s.hash.hex() for s in signers), "announce_every": "600"}}
+        self.writes = 0
+
+    def write_config(self):
+        self.writes += 1
+
+
+class _Unregistered(RNS.Destination):
+    """ no running Reticulum to register the sync destination with"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class FakeSource:
+    hash = b"\x01" * 16
+
+
+@pytest.fixture
+def signers():
+    return RNS.Identity(create_keys=True), RNS.Identity(create_keys=True)
+
+
+@pytest.fixture
+def sync(signers, tmp_path, monkeypatch):
+    monkeypatch.setattr(cs.RNS.Transport, "hops_to", lambda h: 1)
+    with monkeypatch.context() as m:
+        m.setattr(cs.RNS, "Destination", _Unregistered)
+        instance = cs.ConfigSync(FakeAdmin(signers), None, None, FakeSource(), state_path=str(tmp_path / "state.json"))
+    instance._save = lambda: None
+    return instance
+
+
+def _reports(sync):
+    return [(title, cs.umsgpack.unpackb(payload)[3]) for _, _, title, payload, _, _ in sync._outbox
+            if title == cs.STATUS_TITLE]
+
+
+def test_deltas_chain_on_their_parent(sync, signers):
+    alice, _ = signers
+    v1 = cs.sign_delta(alice, 0, [[["retcon", "announce_every"], "900"]])
+    v2 = cs.sign_delta(alice, 1, [[["retcon", "announce_every"], "1200"]], parent=cs.delta_digest(v1))
+    sync.receive(v2)
+    sync.receive(v1)
+
+    assert sync.version == 2
+    assert sync.admin.config["retcon"]["announce_every"] == "1200"
+
+
+def test_two_deltas_for_one_version_are_reported_not_dropped(sync, signers):
+    alice, bob = signers
+    ours = cs.sign_delta(alice, 0, [[["retcon", "announce_every"], "900"]])
+    theirs = cs.sign_delta(bob, 0, [[["retcon", "announce_every"], "60"]])
+    sync.receive(ours)
+    sync.receive(theirs)
+    sync.receive(theirs)  # reported once
+
+    assert sync.version == 1
+    assert sync.admin.config["retcon"]["announce_every"] == "900"
+    assert sync.last_status["status"] == "conflict"
+    assert [s for _, s in _reports(sync)].count("conflict") == 2  # one to each signer
+
+
+def test_delta_built_on_the_other_branch_is_refused(sync, signers):
+    alice, bob = signers
+    ours = cs.sign_delta(alice, 0, [[["retcon", "announce_every"], "900"]])
+    theirs = cs.sign_delta(bob, 0, [[["retcon", "announce_every"], "60"]])
+    on_theirs = cs.sign_delta(bob, 1, [[["retcon", "announce_every"], "30"]], parent=cs.delta_digest(theirs))
+    sync.receive(ours)
+    sync.receive(on_theirs)
+
+    assert sync.version == 1
+    assert 2 not in sync.log
+    assert sync.last_status["status"] == "conflict"
+
+
+def test_announces_from_other_threads_dont_break_gossip(sync, signers):
+    alice, _ = signers
+    sync.receive(cs.sign_delta(alice, 0, [[["retcon", "announce_every"], "900"]]))
+    identity = RNS.Identity(create_keys=True)
+    stop = threading.Event()
+
+    def announcer():
+        i = 0
+        while not stop.is_set():
+            app_data = cs.umsgpack.packb([0, i.to_bytes(16, "big")])
+            sync.received_announce(b"\x00" * 16, identity, app_data)
+            i += 1
+
+    thread = threading.Thread(target=announcer)
+    thread.start()
+    try:
+        deadline = time.time() + 1
+        while time.time() < deadline:
+            sync.gossip()
+            with sync._lock:
+                sync._outbox.clear()
+                sync._sent.clear()
+    finally:
+        stop.set()
+        thread.join()
+    assert len(sync.peers) > 1
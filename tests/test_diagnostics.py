@@ -0,0 +1,81 @@
+import bz2
+import os
+import random
+
+import pytest
+
+from utils import diagnostics as diag
+
+
+def _fake_log(path):
+    """ records from a few modules and levels, some with multi line tracebacks"""
+    rng = random.Random(7)
+    lines = []
+    for i in range(120):
+        level = rng.choice(["DEBUG", "INFO", "INFO", "WARNING", "ERROR"])
+        module = rng.choice(["wifi_mesh", "qos", "retcon"])
+        lines.append(f"2026-10-19 10:{i // 60:02d}:{i % 60:02d},123 {level} {module}: message {i} {'x' * rng.randrange(80)}\n")
+        if level == "ERROR" or rng.random() < 0.1:
+            lines += ["Traceback (most recent call last):\n",
+                      f'  File "plugins/{module}.py", line {i}, in loop\n',
+                      f"RuntimeError: {'y' * rng.randrange(150)}\n"]
+    path.write_text("".join(lines))
+    return lines
+
+
+def _matching(lines, level=None, subsystems=None):
+    """ the records a filter selects, with their continuation lines, in one pass over the whole file"""
+    out, keep = [], False
+    for line in lines:
+        m = diag.RECORD.match(line.encode())
+        if m:
+            keep = (diag.LEVELS[m.group(2).decode()] >= diag.LEVELS[level or "DEBUG"] and
+                    (subsystems is None or m.group(3).decode() in subsystems))
+        if keep:
+            out.append(line)
+    return "".join(out).encode()
+
+
+def _fetch(path, length, **query):
+    segment = diag.log_segments(str(path))[0]
+    data, offset, keep = b"", None, None
+    while True:
+        chunk = diag.read_chunk(str(path), segment["id"], offset, length=length, keep=keep, **query)
+        data += bz2.decompress(chunk["data"])
+        offset, keep = chunk["next"], chunk["keep"]
+        if chunk["eof"]:
+            return data
+
+
+@pytest.mark.parametrize("length", [200, 333, 1000, diag.MAX_CHUNK])
+def test_unfiltered_fetch_is_the_whole_file(tmp_path, length):
+    log = tmp_path / "retcon.log"
+    _fake_log(log)
+
+    assert _fetch(log, length) == log.read_bytes()
+
+
+@pytest.mark.parametrize("length", [200, 333, 1000])
+def test_filtered_fetch_keeps_continuations_across_chunks(tmp_path, length):
+    log = tmp_path / "retcon.log"
+    lines = _fake_log(log)
+
+    assert _fetch(log, length, level="WARNING") == _matching(lines, level="WARNING")
+    assert _fetch(log, length, subsystems=["qos"]) == _matching(lines, subsystems={"qos"})
+
+
+def test_line_longer_than_a_chunk(tmp_path):
+    log = tmp_path / "retcon.log"
+    log.write_text("2026-10-19 10:00:00,123 ERROR qos: " + "z" * 500 + "\nmore of it\n"
+                   "2026-10-19 10:00:01,123 INFO qos: fine\n")
+
+    assert _fetch(log, 128) == log.read_bytes()
+    assert _fetch(log, 128, level="ERROR") == log.read_bytes().split(b"2026-10-19 10:00:01")[0]
+
+
+def test_rotated_out_segment(tmp_path):
+    log = tmp_path / "retcon.log"
+    _fake_log(log)
+    gone = os.stat(log).st_ino + 1
+
+    assert "error" in diag.read_chunk(str(log), gone)
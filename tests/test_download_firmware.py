@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from utils import download_firmware as df
+
+BODY = os.urandom(300 * 1024)
+ETAG = '"v1"'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ one asset with an ETag, conditional GETs and Range. server.short_once cuts the first reply short"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body, status = server.body, 200
+        range_ = self.headers.get("Range")
+        if range_ and self.headers.get("If-Range") == ETAG:
+            start = int(range_.split("=")[1].rstrip("-"))
+            body, status = body[start:], 206
+        if server.short_once:
+            server.short_once = False
+            body = body[:len(body) // 3]
+        self.send_response(status)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    httpd.body, httpd.short_once, httpd.requests = BODY, False, []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(df.time, "sleep", lambda s: None)
+
+
+def _url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/fw.zip"
+
+
+ASSET = {"name": "fw.zip", "id": 1, "updated_at": "2026-01-01T00:00:00Z", "size": len(BODY),
+         "digest": "sha256:" + hashlib.sha256(BODY).hexdigest()}
+
+
+def test_resumes_a_part_file(server, tmp_path):
+    part = tmp_path / "fw.zip.part"
+    part.write_bytes(BODY[:100 * 1024])
+    (tmp_path / "fw.zip.part.json").write_text(json.dumps({"etag": ETAG}))
+
+    entry = df._download_with_retry(requests.Session(), _url(server), str(tmp_path), ASSET, None)
+
+    assert server.requests[0]["Range"] == f"bytes={100 * 1024}-"
+    assert (tmp_path / "fw.zip").read_bytes() == BODY
+    assert entry["sha256"] == hashlib.sha256(BODY).hexdigest()
+    assert not part.exists()
+
+
+def test_short_read_is_retried_and_resumed(server, tmp_path):
+    server.short_once = True
+
+    df._download_with_retry(requests.Session(), _url(server), str(tmp_path), ASSET, None)
+
+    assert len(server.requests) == 2
+    assert server.requests[1]["Range"] == f"bytes={len(BODY) // 3}-"
+    assert (tmp_path / "fw.zip").read_bytes() == BODY
+
+
+def test_304_reuses_what_we_have(server, tmp_path):
+    session = requests.Session()
+    entry = df._download_with_retry(session, _url(server), str(tmp_path), ASSET, None)
+    newer = dict(ASSET, updated_at="2026-02-01T00:00:00Z")
+    assert not df.is_current(str(tmp_path), newer, entry)
+
+    again = df._download_with_retry(session, _url(server), str(tmp_path), newer, entry)
+
+    assert server.requests[-1]["If-None-Match"] == ETAG
+    assert again["sha256"] == entry["sha256"] and again["updated_at"] == newer["updated_at"]
+    assert df.is_current(str(tmp_path), newer, again)
+
+
+def test_local_corruption_is_repaired(server, tmp_path):
+    session = requests.Session()
+    entry = df._download_with_retry(session, _url(server), str(tmp_path), ASSET, None)
+    (tmp_path / "fw.zip").write_bytes(b"x" * len(BODY))
+    assert not df.is_current(str(tmp_path), ASSET, entry)
+
+    repaired = df._download_with_retry(session, _url(server), str(tmp_path), ASSET, entry)
+
+    # no conditional GET for a file that doesn't hash to what we recorded, so the server can't 304 it
+    assert "If-None-Match" not in server.requests[-1]
+    assert (tmp_path / "fw.zip").read_bytes() == BODY
+    assert df.is_current(str(tmp_path), ASSET, repaired)
+
+
+def test_hash_mismatch_is_retried_then_fails(server, tmp_path):
+    bad = dict(ASSET, digest="sha256:" + "0" * 64)
+
+    with pytest.raises(df.DownloadError, match="Hash mismatch"):
+        df._download_with_retry(requests.Session(), _url(server), str(tmp_path), bad, None)
+
+    assert len(server.requests) == df.RETRIES + 1
+    # nothing half verified is left behind or renamed into place
+    assert os.listdir(tmp_path) == []
+
+
+def test_error_status_is_retried(server, tmp_path, monkeypatch):
+    statuses = iter([503])
+    original = _Handler.do_GET
+
+    def flaky(self):
+        status = next(statuses, None)
+        if status is None:
+            return original(self)
+        self.server.requests.append(dict(self.headers))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    monkeypatch.setattr(_Handler, "do_GET", flaky)
+    df._download_with_retry(requests.Session(), _url(server), str(tmp_path), ASSET, None)
+
+    assert len(server.requests) == 2
+    assert (tmp_path / "fw.zip").read_bytes() == BODY
@@ -0,0 +1,107 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from utils import link_probe
+from utils.link_probe import LinkProber, LinkTable, link_penalty
+
+ECHO_COST = link_probe.ECHO_COUNT * link_probe.HEADER.size * 2
+GONE = "192.0.2.1"  # TEST-NET, nobody answers
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def prober(tmp_path, monkeypatch):
+    """ a prober whose peers are all answered by its own responder over loopback, or nobody"""
+    monkeypatch.setattr(link_probe, "ECHO_SPACING", 0.001)
+    monkeypatch.setattr(link_probe, "ECHO_TIMEOUT", 0.2)
+    peers = []
+    p = LinkProber(lambda: list(peers), port=_free_port(), table=LinkTable(str(tmp_path / "links.json")))
+    p.peer_list = peers
+    return p
+
+
+def _run(prober, *calls):
+    """ start the prober, await each call(prober) in turn, close the socket"""
+    async def go():
+        await prober.start()
+        try:
+            return [await call(prober) for call in calls]
+        finally:
+            prober._protocol.transport.close()
+    return asyncio.run(go())
+
+
+def test_probe_rtt_and_burst_over_loopback(prober):
+    (rtt_ms, loss), (gone_rtt, gone_loss), kbps = _run(prober, lambda p: p.probe_rtt("127.0.0.1"),
+                                                       lambda p: p.probe_rtt(GONE, count=3),
+                                                       lambda p: p.probe_burst("127.0.0.1"))
+    assert loss == 0 and 0 <= rtt_ms < 100
+    assert gone_rtt is None and gone_loss == 1
+    assert kbps is not None and kbps > 0
+    assert prober._protocol.pending == {}
+
+
+def test_cycle_stays_in_budget(prober):
+    sent = []
+
+    async def probe_burst(ip, nbytes=link_probe.BURST_BYTES):
+        sent.append(ip)
+        return 1000.0
+
+    prober.probe_burst = probe_burst
+    prober.peer_list[:] = [("127.0.0.2", "child", "RT-C"), ("127.0.0.1", "parent", "RT-P"), ("127.0.0.3", "child", "RT-D")]
+
+    # echoes for everyone come before any burst. Out of budget, the third peer isn't probed at all
+    prober.budget = 3 * ECHO_COST - 1
+    _run(prober, LinkProber.run_cycle)
+    links = LinkTable(prober.table.path).links
+    assert sorted(links) == ["127.0.0.1", "127.0.0.2"]
+    assert links["127.0.0.2"]["loss"] == 0 and links["127.0.0.2"]["kbps"] is None
+    assert sent == []
+
+    # one burst's worth left: the parent gets it, though the child is listed first
+    prober.budget = 3 * ECHO_COST + link_probe.BURST_BYTES
+    _run(prober, LinkProber.run_cycle)
+    links = LinkTable(prober.table.path).links
+    assert sorted(links) == ["127.0.0.1", "127.0.0.2", "127.0.0.3"]
+    assert links["127.0.0.1"]["kbps"] == 1000.0 and links["127.0.0.1"]["role"] == "parent"
+    assert sent == ["127.0.0.1"]
+
+
+def test_children_take_turns_at_the_burst(prober):
+    prober.budget = 3 * ECHO_COST + link_probe.BURST_BYTES
+    prober.peer_list[:] = [("127.0.0.2", "child", "RT-A"), ("127.0.0.3", "child", "RT-B"), (GONE, "child", "RT-GONE")]
+    sent = []
+
+    async def probe_burst(ip, nbytes=link_probe.BURST_BYTES):
+        sent.append(ip)
+        return 500.0
+
+    prober.probe_burst = probe_burst
+    _run(prober, LinkProber.run_cycle, LinkProber.run_cycle, LinkProber.run_cycle)
+    # one that didn't answer a single echo never costs a burst
+    assert sent == ["127.0.0.2", "127.0.0.3", "127.0.0.2"]
+    assert prober.table.links[GONE]["loss"] == 1 and prober.table.links[GONE]["kbps"] is None
+
+    # a peer that's gone from the tree is dropped from the table
+    prober.peer_list.pop()
+    _run(prober, LinkProber.run_cycle)
+    assert GONE not in LinkTable(prober.table.path).links
+
+
+def test_link_penalty():
+    now = time.time()
+    assert link_penalty(None) == 0
+    assert link_penalty({"updated": now, "loss": 0.05, "rtt_ms": 40, "kbps": 900}) == 0
+    assert link_penalty({"updated": now, "loss": 0.5, "rtt_ms": None, "kbps": None}) == 30
+    assert link_penalty({"updated": now, "loss": 0.5, "rtt_ms": 800, "kbps": 20}) == 60
+    # nothing recent enough to hold against it
+    assert link_penalty({"updated": now - 31 * 60, "loss": 1.0, "rtt_ms": 800, "kbps": 20}) == 0
@@ -0,0 +1,120 @@
+import json
+import os
+import sys
+import textwrap
+
+import pytest
+
+from utils import provision_rnodes as pr
+
+PARAMS = {"frequency": 868000000, "bandwidth": 125000, "txpower": 14, "spreadingfactor": 8, "codingrate": 5}
+TAG = "1.82"
+
+# stands in for rnodeconf: talks to the pty it's given and keeps each board's state in FAKE_RNODE_DIR
+FAKE_RNODECONF = textwrap.dedent("""\
+    import json, os, sys
+    port, args = sys.argv[1], sys.argv[2:]
+    with open(port, "wb", buffering=0) as tty:
+        tty.write(b"probe\\n")
+    path = os.path.join(os.environ["FAKE_RNODE_DIR"], os.path.basename(port) + ".json")
+    board = json.load(open(path))
+    board["calls"].append(args)
+    if "--info" in args:
+        if board["state"] == "blank":
+            print("Serial port opened, but RNode did not respond. Is a valid firmware installed?")
+        elif board["state"] == "unprovisioned":
+            print("This device contains a valid firmware, but EEPROM is invalid.")
+        else:
+            print("Firmware version : " + board["version"])
+    elif "--rom" in args:
+        board["state"] = "provisioned"
+    elif "--update" in args:
+        if board["state"] != "provisioned":
+            print("Device not provisioned. Cannot update device firmware.")
+            json.dump(board, open(path, "w"))
+            sys.exit(1)
+        board["version"] = args[args.index("--fw-version") + 1]
+    json.dump(board, open(path, "w"))
+""")
+
+
+@pytest.fixture
+def bench(tmp_path, monkeypatch):
+    """ make_radio(state) -> a pty port with a fake board behind it. Also returns the board's state file reader"""
+    script = tmp_path / "rnodeconf"
+    script.write_text(f"#!{sys.executable}\n" + FAKE_RNODECONF)
+    script.chmod(0o755)
+    monkeypatch.setenv("FAKE_RNODE_DIR", str(tmp_path))
+    masters = []
+
+    def make_radio(state):
+        master, slave = os.openpty()
+        masters.append(master)
+        port = os.ttyname(slave)
+        os.close(slave)
+        (tmp_path / (os.path.basename(port) + ".json")).write_text(json.dumps({"state": state, "version": "1.70", "calls": []}))
+        return port
+
+    def board(port):
+        return json.loads((tmp_path / (os.path.basename(port) + ".json")).read_text())
+
+    yield str(script), make_radio, board
+    for fd in masters:
+        os.close(fd)
+
+
+def test_batch_with_provisioned_unprovisioned_and_blank_boards(bench):
+    rnodeconf, make_radio, board = bench
+    ports = {state: make_radio(state) for state in ("provisioned", "unprovisioned", "blank")}
+    jobs = {state: pr.RadioJob(port) for state, port in ports.items()}
+    provisioner = pr.Provisioner(rnodeconf, PARAMS, TAG, board="t3s3", step_timeout=30)
+    for job in jobs.values():
+        provisioner.provision(job)
+
+    assert jobs["provisioned"].status == "ok"
+    assert jobs["provisioned"].firmware_version == TAG
+    assert [c[0] for c in board(ports["provisioned"])["calls"]] == ["--info", "--update", "--normal", "--info"]
+
+    # bootstrapped with the 868MHz t3s3 model before the update
+    assert jobs["unprovisioned"].status == "ok"
+    calls = board(ports["unprovisioned"])["calls"]
+    assert calls[1] == pr.bootstrap_args("t3s3", 868000000)
+    assert "a6" in calls[1] and "--update" in calls[3]
+
+    assert jobs["blank"].status == "failed"
+    assert "--autoinstall" in jobs["blank"].last_line
+    assert board(ports["blank"])["calls"] == [["--info"]]
+
+
+def test_unprovisioned_board_is_refused_without_board_type(bench):
+    rnodeconf, make_radio, board = bench
+    port = make_radio("unprovisioned")
+    job = pr.Provisioner(rnodeconf, PARAMS, TAG, step_timeout=30).provision(pr.RadioJob(port))
+
+    assert job.status == "failed"
+    assert "--board" in job.last_line
+    assert board(port)["calls"] == [["--info"]]
+    assert board(port)["state"] == "unprovisioned"
+
+
+def test_missing_port_fails_the_probe(bench, tmp_path):
+    rnodeconf, _, _ = bench
+    job = pr.Provisioner(rnodeconf, PARAMS, TAG, step_timeout=30).provision(pr.RadioJob(str(tmp_path / "ttyGONE")))
+
+    assert job.status == "failed"
+    assert job.steps["probe"]["ok"] is False
+
+
+def test_bootstrap_model_follows_the_band():
+    assert "a1" in pr.bootstrap_args("t3s3", 433000000)
+    assert "12" in pr.bootstrap_args("rak4631", 915000000)
+    with pytest.raises(ValueError):
+        pr.bootstrap_args("tbeam", 2400000000)
+    with pytest.raises(ValueError):
+        pr.bootstrap_args("not_a_board", 868000000)
+
+
+def test_board_state():
+    assert pr.board_state("Firmware version : 1.82") == pr.PROVISIONED
+    assert pr.board_state("EEPROM is invalid, no further information available") == pr.UNPROVISIONED
+    assert pr.board_state("Serial port opened, but RNode did not respond. Is a valid firmware installed?") == pr.BLANK
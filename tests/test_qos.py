@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from plugins import qos
+
+# a client mode profile without a mode line
+RETCON_CONFIG = {"retcon": {"wifi": {"prefix": "RT-", "psk": "x", "freq": 2462, "client_iface": "wlan0", "ap_iface": "uap0"}}}
+
+STATION_DUMP = """\
+Station 02:00:00:00:00:01 (on uap0)
+	inactive time:	100 ms
+	connected time:	3600 seconds
+Station 02:00:00:00:00:02 (on uap0)
+	inactive time:	20 ms
+	connected time:	5 seconds
+Station 02:00:00:00:00:03 (on uap0)
+	inactive time:	300 ms
+	connected time:	120 seconds
+"""
+
+# tc -s class show with queues built up, backlog through sprint_size
+CLASS_SHOW = """\
+class htb 1:1 root rate 20Mbit ceil 20Mbit burst 1600b cburst 1600b
+ Sent 9123456 bytes 7012 pkt (dropped 0, overlimits 310 requeues 0)
+ backlog 0b 0p requeues 0
+ lended: 0 borrowed: 0 giants: 0
+ tokens: 9375 ctokens: 9375
+
+class htb 1:10 parent 1:1 leaf 8010: prio 0 rate 5Mbit ceil 20Mbit burst 1600b cburst 1600b
+ Sent 812000 bytes 1200 pkt (dropped 2, overlimits 14 requeues 0)
+ backlog 1514b 1p requeues 0
+
+class htb 1:100 parent 1:20 leaf 8100: prio 2 rate 1Kbit ceil 4Mbit burst 1600b cburst 1600b
+ Sent 8000000 bytes 5500 pkt (dropped 41, overlimits 290 requeues 0)
+ backlog 3Kb 2p requeues 0
+
+class htb 1:101 parent 1:20 leaf 8101: prio 2 rate 1Kbit ceil 4Mbit burst 1600b cburst 1600b
+ Sent 311456 bytes 312 pkt (dropped 0, overlimits 6 requeues 0)
+ backlog 2Mb 1400p requeues 0
+"""
+
+
+@pytest.fixture
+def plugin(monkeypatch):
+    """ a QosPlugin whose tc/iw go to a recorder. outputs maps a command prefix to what it prints"""
+    calls, outputs = [], {}
+
+    async def run_cmd(*args, check=True, sudo=True):
+        calls.append(args)
+        for prefix, out in outputs.items():
+            if args[:len(prefix)] == prefix:
+                return out
+        return ""
+
+    monkeypatch.setattr(qos, "run_cmd", run_cmd)
+    p = qos.QosPlugin("RT-TEST", {"max_clients": "2"}, RETCON_CONFIG, None)
+    asyncio.run(p.init())
+    p.calls, p.outputs = calls, outputs
+    calls.clear()
+    return p
+
+
+def test_init_defaults_to_client_mode(plugin):
+    assert plugin.iface == "uap0"
+    assert plugin.max_clients == 2
+
+
+def test_sync_clients_keeps_classes_stable(plugin):
+    asyncio.run(plugin.sync_clients(["10.42.0.11", "10.42.0.10"]))
+    assert plugin.client_classes == {"10.42.0.10": 0x100, "10.42.0.11": 0x101}
+    filters = [c for c in plugin.calls if c[1:3] == ("filter", "add")]
+    assert [f[-3] for f in filters] == ["10.42.0.10/32", "10.42.0.11/32"]
+    assert [f[-1] for f in filters] == ["1:100", "1:101"]
+
+    plugin.calls.clear()
+    asyncio.run(plugin.sync_clients(["10.42.0.11", "10.42.0.12"]))
+    # .11 keeps its class, .10's goes, .12 gets a fresh one
+    assert plugin.client_classes == {"10.42.0.11": 0x101, "10.42.0.12": 0x102}
+    assert ("tc", "class", "del", "dev", "uap0", "classid", "1:100") in plugin.calls
+    assert not any(c[1:3] == ("class", "replace") and "1:101" in c for c in plugin.calls)
+
+    plugin.calls.clear()
+    asyncio.run(plugin.sync_clients(["10.42.0.12", "10.42.0.11"]))
+    assert plugin.calls == []
+
+
+def test_enforce_max_clients_drops_the_newest(plugin):
+    plugin.outputs[("iw", "dev", "uap0", "station", "dump")] = STATION_DUMP
+
+    assert asyncio.run(plugin.enforce_max_clients()) == ["02:00:00:00:00:02"]
+    assert plugin.calls[-1] == ("iw", "dev", "uap0", "station", "del", "02:00:00:00:00:02")
+
+
+def test_stats_with_backlog(plugin):
+    asyncio.run(plugin.sync_clients(["10.42.0.10", "10.42.0.11"]))
+    plugin.outputs[("tc", "-s", "class", "show")] = CLASS_SHOW
+
+    stats = asyncio.run(plugin.stats())
+
+    classes = stats["classes"]
+    assert classes["total"]["bytes"] == 9123456 and classes["total"]["overlimits"] == 310
+    assert classes["backbone"]["backlog"] == 1514 and classes["backbone"]["drops"] == 2
+    assert classes["10.42.0.10"]["backlog"] == 3 * 1024 and classes["10.42.0.10"]["packets"] == 5500
+    assert classes["10.42.0.11"]["backlog"] == 2 * 1024 * 1024
+    assert stats["clients"] == 2
+
+
+def test_tc_size():
+    assert [qos.tc_size(s) for s in ("0b", "1514b", "3Kb", "2Mb")] == [0, 1514, 3072, 2 * 1024 * 1024]
+    with pytest.raises(ValueError):
+        qos.tc_size("3 Kb")
@@ -0,0 +1,68 @@
+import glob
+import os
+
+import pytest
+from configobj import ConfigObj
+
+from utils import lora_planner
+from utils import rns_config_gen as gen
+
+PROFILES = sorted(os.path.basename(p)[:-len(".config")] for p in glob.glob(gen.dir_path + "/retcon_profiles/*.config"))
+
+# meshtastic modem presets by data_speed: (sf, bw, cr)
+PRESETS = {0: (11, 250000, 5), 1: (12, 125000, 8), 2: (12, 62500, 8), 3: (10, 250000, 5), 4: (9, 250000, 5),
+           5: (8, 250000, 5), 6: (7, 250000, 5), 7: (11, 125000, 8), 8: (7, 500000, 5)}
+
+
+def test_meshtastic_bitrates_match_the_presets():
+    for speed, (sf, bw, cr) in PRESETS.items():
+        assert gen.MESHTASTIC_BITRATE[speed] == pytest.approx(lora_planner.bitrate(sf, bw, cr), rel=0.02), speed
+
+
+def _plugins():
+    # rendering goes through the plugins' own templates, and importing them needs these
+    for module in ("sdbus_async.networkmanager", "netifaces", "meshtastic"):
+        pytest.importorskip(module)
+
+
+def _interfaces(rendered):
+    return ConfigObj(rendered.splitlines(), interpolation=False)["interfaces"]
+
+
+@pytest.mark.parametrize("profile", PROFILES)
+def test_shipped_profile_renders_tuned(profile):
+    _plugins()
+    rendered, problems, _ = gen.check_profile(profile)
+    assert problems == []
+
+    config = gen.get_recton_config(profile)
+    is_transport = config["retcon"]["mode"] == "transport"
+    interfaces = _interfaces(rendered)
+    for name, section in interfaces.items():
+        link = gen.classify_interface(section)
+        if link == gen.LINK_WIFI:
+            assert int(section["bitrate"]) == gen.WIFI_BITRATE
+            assert section["mode"] == ("gateway" if "Server" in name else "full")
+        elif link == gen.LINK_LORA:
+            params = lora_planner.params_from_config(section)
+            assert int(section["bitrate"]) == int(lora_planner.bitrate(params.sf, params.bw, params.cr))
+            assert section["mode"] == ("full" if is_transport else "roaming")
+        else:
+            assert link == gen.LINK_INTERNET, name
+            assert "bitrate" not in section
+    # every shipped profile has the wifi mesh and an rnode
+    assert {gen.classify_interface(s) for s in interfaces.values()} >= {gen.LINK_WIFI, gen.LINK_LORA}
+
+
+@pytest.mark.parametrize("data_speed", [3, 6])
+def test_meshtastic_interface_gets_its_preset_bitrate(data_speed):
+    _plugins()
+    config = gen.get_recton_config("default")
+    config["retcon_plugins"]["usb_autodetect"]["meshtastic"] = {"mode": "ap", "data_speed": data_speed, "hop_limit": 5}
+
+    rendered = gen.render_rns_config(config, gen._check_plugin_vars(config))
+
+    section = _interfaces(rendered)["Meshtastic Interface"]
+    assert int(section["bitrate"]) == gen.MESHTASTIC_BITRATE[data_speed]
+    assert section["mode"] == "full"
+    assert section["announce_cap"] == "1"
@@ -0,0 +1,60 @@
+import asyncio
+
+from plugins.base_plugin import RetconPlugin
+from plugins.runtime import PluginRuntime
+
+
+class ChildPlugin(RetconPlugin):
+    LOOP_INTERVAL = None
+    RESTART_POLICY = "always"
+    RESTART_BACKOFF = 0.05
+
+    def init(self):
+        self.events = []
+
+    async def loop(self):
+        self.events.append("start")
+        self.spawn(self.child("crasher", 0.1))
+        self.spawn(self.child("sleeper", 100))
+        await asyncio.sleep(100)
+
+    async def child(self, name, delay):
+        try:
+            await asyncio.sleep(delay)
+            raise RuntimeError(f"{name} crashed")
+        except asyncio.CancelledError:
+            self.events.append(f"{name} cancelled")
+            raise
+
+
+def _run(plugin, seconds):
+    async def main():
+        runtime = PluginRuntime({"p": plugin})
+        runtime.start()
+        await asyncio.sleep(seconds)
+        status = runtime.status()["p"]
+        await runtime.stop()
+        return status
+    return asyncio.run(main())
+
+
+def test_crashed_child_fails_the_loop_and_takes_its_siblings_down():
+    plugin = ChildPlugin("node", {}, {}, None)
+    plugin.init()
+    status = _run(plugin, 0.3)
+
+    assert status["failures"] >= 1
+    assert "crasher crashed" in status["last_error"]
+    # the first run's sleeper didn't outlive it, and the runtime restarted the loop
+    assert plugin.events[:3] == ["start", "sleeper cancelled", "start"]
+
+
+def test_stop_cancels_children():
+    plugin = ChildPlugin("node", {}, {}, None)
+    plugin.init()
+    plugin.child = lambda name, delay: ChildPlugin.child(plugin, name, 100)
+    status = _run(plugin, 0.1)
+
+    assert status["failures"] == 0
+    assert sorted(plugin.events) == ["crasher cancelled", "sleeper cancelled", "start"]
+    assert not plugin._children
@@ -0,0 +1,134 @@
+import json
+
+import pytest
+
+from utils import scan_policy
+from utils.scan_policy import ScanPolicy
+
+
+class AP:
+    """ uap0's counters in a fake sysfs, and the clock the policy reads"""
+
+    def __init__(self, tmp_path, monkeypatch):
+        self.root = tmp_path / "net"
+        self.stats = self.root / "uap0" / "statistics"
+        self.stats.mkdir(parents=True)
+        for counter in scan_policy.COUNTERS:
+            (self.stats / counter).write_text("0\n")
+        self.now = 1000.0
+        monkeypatch.setattr(scan_policy.time, "time", lambda: self.now)
+        monkeypatch.setattr(scan_policy, "STATS_DIR", str(tmp_path))
+        self.stats_path = tmp_path / "scan_stats_wlan0.json"
+
+    def policy(self, **config):
+        return ScanPolicy("wlan0", ["uap0"], sysfs_root=str(self.root), **config)
+
+    def traffic(self, nbytes, dropped=0):
+        for counter, n in (("tx_bytes", nbytes), ("tx_dropped", dropped)):
+            path = self.stats / counter
+            path.write_text(f"{int(path.read_text()) + n}\n")
+
+
+@pytest.fixture
+def ap(tmp_path, monkeypatch):
+    return AP(tmp_path, monkeypatch)
+
+
+def _scan(policy, found):
+    scan = policy.begin(policy.plan())
+    policy.end(scan, found, 2462)
+    return scan
+
+
+def test_backoff_without_parents(ap):
+    policy = ap.policy(base=8, backoff_max=60)
+    assert policy.ready(connected=False)
+    intervals = []
+    for _ in range(5):
+        _scan(policy, [])
+        intervals.append(policy.next_scan - ap.now)
+        assert not policy.ready(connected=False)
+        ap.now = policy.next_scan
+        assert policy.ready(connected=False)
+    # 16, 32, 60 (capped), 60, 60, each jittered by 20%
+    for interval, expected in zip(intervals, (16, 32, 60, 60, 60)):
+        assert expected * 0.8 <= interval <= expected * 1.2
+    assert policy.misses == 5
+
+    # finding a parent goes back to the base interval
+    _scan(policy, [b"RT-A"])
+    assert policy.misses == 0 and 8 * 0.8 <= policy.next_scan - ap.now <= 8 * 1.2
+
+
+def test_losing_the_parent_scans_straight_away(ap):
+    policy = ap.policy()
+    _scan(policy, [])
+    _scan(policy, [])
+    assert policy.ready(connected=True)
+    assert policy.ready(connected=False)
+    assert policy.misses == 0
+
+
+def test_directed_between_wildcards(ap):
+    policy = ap.policy(full_scan_every=3)
+    # nothing known yet: the first scan looks around
+    assert _scan(policy, [b"RT-A", b"RT-B"])["kind"] == "wildcard"
+    assert policy.plan() == {"kind": "directed", "ssids": [b"RT-A", b"RT-B"]}
+    _scan(policy, [b"RT-A"])
+    _scan(policy, [b"RT-A", b"RT-C"])  # a directed scan can still turn up someone new
+    assert policy.known_ssids == {b"RT-A", b"RT-B", b"RT-C"}
+    _scan(policy, [b"RT-A"])
+    # every full_scan_every'th one is a wildcard, and that one forgets who went away
+    assert policy.plan()["kind"] == "wildcard"
+    _scan(policy, [b"RT-A"])
+    assert policy.known_ssids == {b"RT-A"}
+
+    # a directed scan that finds nobody means who we knew is gone, look around next
+    _scan(policy, [])
+    assert policy.plan()["kind"] == "wildcard"
+    assert policy.totals == {"scans": 6, "directed": 4, "wildcard": 2, "deferrals": 0, "deferred_seconds": 0}
+
+
+def test_scans_wait_for_the_ap_to_go_quiet(ap):
+    policy = ap.policy(busy_kbps=200, max_defer=120, connected_max_defer=600)
+    ap.now += 10
+    ap.traffic(10 * 1000 * 1000 // 8)  # 1000 kbps
+    assert not policy.ready(connected=False)
+    assert policy.totals["deferrals"] == 1
+
+    ap.now += 10
+    ap.traffic(100 * 1000 // 8)  # 10 kbps
+    assert policy.ready(connected=False)
+    scan = policy.begin(policy.plan())
+    assert scan["deferred"] == 10
+    ap.traffic(5000, dropped=3)
+    ap.now += 2
+    policy.end(scan, [b"RT-A"], 2462)
+
+    record = policy.history[-1]
+    assert record["deferred_s"] == 10 and record["ap_tx_dropped"] == 3 and record["duration_ms"] == 2000
+    assert record["ap_kbps_during"] == 20.0
+    saved = json.loads(ap.stats_path.read_text())
+    assert saved["known_ssids"] == ["RT-A"] and saved["totals"]["deferred_seconds"] == 10
+
+
+def test_a_busy_ap_only_holds_a_scan_so_long(ap):
+    policy = ap.policy(busy_kbps=200, max_defer=120, connected_max_defer=600)
+    for _ in range(12):
+        ap.now += 10
+        ap.traffic(10 * 1000 * 1000 // 8)
+        assert not policy.ready(connected=False)
+    ap.now += 10
+    ap.traffic(10 * 1000 * 1000 // 8)
+    # 120s without a parent is enough
+    assert policy.ready(connected=False)
+    assert policy.totals["deferrals"] == 1
+
+    # with a parent the check can wait longer
+    policy.begin(policy.plan())
+    ap.now += 130
+    ap.traffic(130 * 1000 * 1000 // 8)
+    assert not policy.ready(connected=True)
+    ap.now += 130
+    ap.traffic(130 * 1000 * 1000 // 8)
+    assert not policy.ready(connected=True)
@@ -0,0 +1,103 @@
+import pytest
+
+pytest.importorskip("RNS")
+
+from utils import status_codec
+from utils.status_codec import StatusEncoder, decode, parse_request
+
+IP1, IP2, IP3 = bytes([10, 42, 0, 10]), bytes([10, 42, 0, 11]), bytes([10, 42, 0, 12])
+
+
+def _readings(**changes):
+    readings = {"node": ["RT-TEST", "transport", 3600, 1700000000],
+                "sys": [0.5, 200, 48.2],
+                "iface": {"BackboneInterface[Wifi Mesh Server Interface]": [True, 1000, 2000]},
+                "peers": {IP1: [1, "RT-A", 12, 0, 800], IP2: [2, "RT-B", 40, 5, 120]}}
+    readings.update(changes)
+    return readings
+
+
+def test_full_then_delta_then_same():
+    encoder = StatusEncoder()
+    v1 = encoder.update(_readings())
+    cache = {}
+    first = decode(encoder.encode(parse_request("node,sys,peers")), cache)
+    assert first["version"] == v1 and first["missing"] == [] and first["more"] == []
+    assert first["fields"]["peers"] == _readings()["peers"]
+    assert cache["peers"] == [v1, _readings()["peers"]]
+
+    peers = {IP1: [1, "RT-A", 14, 0, 800], IP3: [2, "RT-C", 60, 0, 90]}
+    v2 = encoder.update({"peers": peers})
+    packed = encoder.encode(parse_request(f"node@{v1},sys@{v1},peers@{v1}"))
+    reply = status_codec.umsgpack.unpackb(packed)
+    # only what changed goes out: IP1's new record, IP3, and IP2's removal
+    assert reply[status_codec.DELTA] == {status_codec.FIELD_IDS["peers"]: [v1, {IP1: peers[IP1], IP3: peers[IP3]}, [IP2]]}
+    assert sorted(reply[status_codec.SAME]) == [status_codec.FIELD_IDS["node"], status_codec.FIELD_IDS["sys"]]
+
+    second = decode(packed, cache)
+    assert second["version"] == v2
+    assert second["fields"] == {"node": _readings()["node"], "sys": _readings()["sys"], "peers": peers}
+    assert cache["peers"] == [v2, peers]
+
+    # nothing new: an unchanged reading doesn't bump the version
+    assert encoder.update({"sys": [0.5, 200, 48.2]}) == v2
+    third = decode(encoder.encode(parse_request(f"peers@{v2}")), cache)
+    assert third["fields"] == {"peers": peers} and third["missing"] == []
+
+
+def test_what_doesnt_fit_is_left_for_more():
+    encoder = StatusEncoder()
+    many = {f"BackboneInterface[Client {i}]": [True, 10 ** 9 + i, 10 ** 9 + i] for i in range(12)}
+    encoder.update(_readings(iface=many))
+
+    packed = encoder.encode(parse_request("node,sys,iface,peers"))
+    assert len(packed) <= status_codec.MAX_BYTES
+    result = decode(packed)
+    assert list(result["fields"]) == ["node", "sys"]
+    assert result["more"] == ["iface", "peers"]
+
+    # asked for on their own, the rest comes through
+    result = decode(encoder.encode(parse_request(",".join(result["more"]))))
+    assert result["more"] == ["peers"] and "iface" in result["fields"]
+
+    # a single field too big for a packet still goes out rather than never
+    assert decode(encoder.encode(parse_request("iface")))["fields"]["iface"] == many
+
+
+def test_delta_against_a_version_we_dont_have_is_missing():
+    encoder = StatusEncoder()
+    v1 = encoder.update(_readings())
+    cache = {}
+    decode(encoder.encode(parse_request("peers")), cache)
+    encoder.update({"peers": {IP1: [1, "RT-A", 14, 0, 800]}})
+
+    # the cache lost peers (another cli run asked for it whole in between, or it was deleted)
+    cache["peers"] = [v1 - 5, {}]
+    result = decode(encoder.encode(parse_request(f"peers@{v1}")), cache)
+    assert result["missing"] == ["peers"] and "peers" not in result["fields"]
+    assert cache["peers"] == [v1 - 5, {}]
+    # same for an unchanged field we don't have at all
+    result = decode(encoder.encode(parse_request(f"node@{v1}")), {})
+    assert result["missing"] == ["node"]
+
+
+def test_restarted_encoder_answers_whole(monkeypatch):
+    encoder = StatusEncoder()
+    encoder.update(_readings())
+    cache = {}
+    decode(encoder.encode(parse_request("peers")), cache)
+    old_version = cache["peers"][0]
+
+    # a console restarted a while later starts its versions from the clock again, past anything it handed out
+    monkeypatch.setattr(status_codec.time, "time", lambda: old_version + 60)
+    restarted = StatusEncoder()
+    peers = {IP2: [2, "RT-B", 41, 5, 120]}
+    v = restarted.update(_readings(peers=peers))
+    assert v > old_version
+
+    # it doesn't know the version asked for, so the reply is whole, never a delta against the wrong base
+    packed = restarted.encode(parse_request(f"peers@{old_version}"))
+    assert status_codec.DELTA not in status_codec.umsgpack.unpackb(packed)
+    result = decode(packed, cache)
+    assert result["fields"]["peers"] == peers and result["missing"] == []
+    assert cache["peers"] == [v, peers]
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from plugins import thermal
+from utils.thermal import load_thermal_state
+
+TRANSPORTD, MESHCHAT, WRAPPER = 101, 102, 103
+THREADS = {TRANSPORTD: [101, 110, 111, 112], MESHCHAT: [102, 120], WRAPPER: [103]}  # interface and job threads
+GOVERNORS = "conservative ondemand userspace powersave performance schedutil"
+
+
+def _stat(pid, nice):
+    # nice is the 17th field after the ")" of the comm
+    return f"{pid} (python3) S " + " ".join(["0"] * 15 + [str(nice)] + ["0"] * 20)
+
+
+class Node:
+    """ a ThermalPlugin over a fake /sys and /proc in tmp_path, with renice going to the fake stat files"""
+
+    def __init__(self, tmp_path, monkeypatch, **config):
+        self.sys, self.proc = tmp_path / "sys", tmp_path / "proc"
+        self.zone = self.sys / "class/thermal/thermal_zone0/temp"
+        self.throttled = self.sys / "devices/platform/soc/soc:firmware/get_throttled"
+        self.policy = self.sys / "devices/system/cpu/cpufreq/policy0"
+        for path in (self.zone.parent, self.throttled.parent, self.policy, self.proc):
+            path.mkdir(parents=True, exist_ok=True)
+        (self.policy / "scaling_governor").write_text("performance\n")
+        (self.policy / "scaling_available_governors").write_text(GOVERNORS + "\n")
+        (self.proc / "loadavg").write_text("0.52 0.40 0.31 1/123 4567\n")
+        for pid, cmdline in ((TRANSPORTD, ["python", "transportd.py"]), (MESHCHAT, ["python", "meshchat.py"]),
+                             (WRAPPER, ["sh", "-c", "until python meshchat.py; do sleep 1; done"])):
+            (self.proc / str(pid)).mkdir()
+            (self.proc / str(pid) / "cmdline").write_bytes(b"\0".join(a.encode() for a in cmdline) + b"\0")
+            for tid in THREADS[pid]:
+                (self.proc / str(pid) / "task" / str(tid)).mkdir(parents=True)
+                self.set_nice(tid, 0)
+
+        self.calls = []
+        monkeypatch.setattr(thermal, "run_cmd", self._run_cmd)
+        self.report_path = tmp_path / "thermal.json"
+        monkeypatch.setattr(thermal, "THERMAL_PATH", str(self.report_path))
+        self.plugin = thermal.ThermalPlugin("node", dict(config, sysfs_root=str(self.sys), proc_root=str(self.proc)), {}, None)
+        self.plugin.init()
+
+    async def _run_cmd(self, *args, check=True, sudo=True):
+        self.calls.append(args)
+        if args[0] == "renice":
+            for tid in args[4:]:
+                self.set_nice(int(tid), int(args[2]))
+        return ""
+
+    def _stat_path(self, tid):
+        pid = next(pid for pid, tids in THREADS.items() if tid in tids)
+        return self.proc / str(pid) / "task" / str(tid) / "stat"
+
+    def set_nice(self, tid, nice):
+        self._stat_path(tid).write_text(_stat(tid, nice))
+
+    def nice(self, tid):
+        return int(self._stat_path(tid).read_text().rsplit(")", 1)[1].split()[16])
+
+    def governor(self):
+        return (self.policy / "scaling_governor").read_text().strip()
+
+    def step(self, temp, flags=0):
+        self.zone.write_text(str(int(temp * 1000)))
+        self.throttled.write_text(hex(flags))
+        return asyncio.run(self.plugin.loop())
+
+
+@pytest.fixture
+def node(tmp_path, monkeypatch):
+    return Node(tmp_path, monkeypatch)
+
+
+def test_states_follow_headroom_with_hysteresis(node):
+    # throttle_temp 80, warm below 15C of headroom, hot below 5C, 2C more to get cooler again
+    steps = [(50, "cool"), (66, "warm"), (64, "warm"), (62.5, "cool"),
+             (76, "hot"), (74, "hot"), (72, "warm"), (64, "warm"), (62, "cool")]
+    for temp, state in steps:
+        assert node.step(temp)["state"] == state, temp
+    assert node.plugin.changes == 6
+
+
+def test_throttle_bits_force_hot(node):
+    assert node.step(50, flags=0x4)["state"] == "hot"
+    report = node.step(50, flags=0x50005)
+    assert report["state"] == "hot"
+    assert report["throttled"]["now"] == ["under_voltage", "throttled"]
+    assert report["throttled"]["since_boot"] == ["under_voltage", "throttled"]
+    # under-voltage, or throttling that's over, isn't heat
+    assert node.step(50, flags=0x1)["state"] == "cool"
+    assert node.step(50, flags=0x40000)["state"] == "cool"
+
+
+def test_missing_temperature_holds_the_state(node):
+    node.step(70)
+    node.zone.unlink()
+    report = asyncio.run(node.plugin.loop())
+    assert report["state"] == "warm" and report["temp_c"] is None and report["headroom_c"] is None
+
+
+def test_governor_follows_the_state(node):
+    # the stock governor when cool, not performance
+    assert node.step(50)["governors"] == {"policy0": "ondemand"}
+    assert node.governor() == "ondemand"
+    node.step(70)
+    assert node.governor() == "conservative"
+    node.step(78)
+    assert node.governor() == "powersave"
+
+
+def test_governor_override_and_hands_off(tmp_path, monkeypatch):
+    node = Node(tmp_path, monkeypatch, governor_warm="schedutil")
+    node.step(70)
+    assert node.governor() == "schedutil"
+
+    hands_off = Node(tmp_path / "other", monkeypatch, manage_governor="false")
+    assert hands_off.step(78)["governors"] == {"policy0": "performance"}
+    assert hands_off.governor() == "performance"
+
+
+def test_renice_covers_every_thread_and_skips_wrappers(node):
+    report = node.step(78)
+    assert report["nice"] == {"transportd": -10, "meshchat": 10}
+    assert sorted(c[4:] for c in node.calls) == [tuple(map(str, THREADS[TRANSPORTD])), tuple(map(str, THREADS[MESHCHAT]))]
+    assert [node.nice(t) for t in THREADS[TRANSPORTD]] == [-10] * 4
+    assert node.nice(WRAPPER) == 0
+
+    node.calls.clear()
+    node.step(78)
+    assert node.calls == []
+
+    # a thread started since then (or reset by someone) gets caught up on its own
+    node.set_nice(111, 0)
+    node.step(78)
+    assert node.calls == [("renice", "-n", "-10", "-p", "111")]
+
+    # back to normal priority once it's cool again
+    assert node.step(50)["nice"] == {"transportd": 0, "meshchat": 0}
+    assert all(node.nice(t) == 0 for tids in THREADS.values() for t in tids)
+
+
+def test_report_goes_stale(node):
+    node.step(66)
+    report = load_thermal_state(str(node.report_path))
+    assert report["state"] == "warm" and report["headroom_c"] == 14.0 and report["load"] == [0.52, 0.40, 0.31]
+
+    old = dict(report, time=time.time() - 600)
+    node.report_path.write_text(json.dumps(old))
+    assert load_thermal_state(str(node.report_path)) == {}
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from plugins import timeseries as plugin_mod
+from utils.timeseries import TimeSeriesStore
+
+RETCON_CONFIG = {"retcon": {"mode": "transport", "wifi": {"prefix": "RT-", "psk": "x", "freq": 2462,
+                                                          "client_iface": "wlan0", "ap_iface": "uap0"}}}
+SERVER = "BackboneInterface[Wifi Mesh Server Interface]"
+
+
+def _status(rxb, clients):
+    """ transportd status with the server and one spawned interface per (port, rxb) client"""
+    interfaces = [{"name": SERVER, "online": True, "rxb": rxb, "txb": rxb // 2, "parent": None},
+                  {"name": "BackboneInterface[WifiMesh Client Interface Extra Long Name wlan1]", "online": True,
+                   "rxb": 100, "txb": 100, "parent": None}]
+    interfaces += [{"name": f"BackboneClientOnServer[Client on Wifi Mesh Server Interface/10.42.0.{port}:{port}]",
+                    "online": True, "rxb": c, "txb": c, "parent": SERVER} for port, c in clients]
+    return {"ok": True, "interfaces": interfaces}
+
+
+@pytest.fixture
+def plugin(tmp_path, monkeypatch):
+    monkeypatch.setattr(plugin_mod, "PERSIST_PATH", str(tmp_path / "timeseries.bin"))
+    p = plugin_mod.TimeseriesPlugin("RT-TEST", {}, RETCON_CONFIG, None)
+    p.init()
+    return p
+
+
+def test_spawned_client_interfaces_are_left_to_their_parent(plugin, monkeypatch):
+    replies = iter([_status(1000, [(50001, 10), (50002, 99999)]), _status(3000, [(50003, 5)])])
+
+    async def command_async(cmd, timeout=None):
+        return next(replies)
+
+    monkeypatch.setattr(plugin_mod, "command_async", command_async)
+    samples = {}
+    asyncio.run(plugin._rns(samples, 100.0))
+    asyncio.run(plugin._rns(samples, 110.0))
+
+    server = plugin_mod._series_name(SERVER)
+    assert samples[f"rns.{server}.rx"] == 200.0
+    assert "rns.BackboneInterface_WifiMesh_Client_Interface_Extra_Long_Name_wlan1.rx" in samples
+    assert not any("Client_on" in name for name in samples)
+    assert not any("Client_on" in name for name in plugin.counters)
+
+
+def test_series_expire_once_they_stop_reporting():
+    store = TimeSeriesStore(max_series=2)
+    store.add({"net.wlan1.rx": 1.0, "sys.cpu": 5.0}, ts=1000)
+    store.add({"sys.cpu": 6.0, "sys.temp": 50.0}, ts=1010)
+    assert store.dropped == {"sys.temp"}
+
+    assert store.expire(60, now=1050) == []
+    assert store.expire(60, now=1070) == ["net.wlan1.rx"]
+    assert store.names == ["sys.cpu"]
+    assert store.tier("1m").read("net.wlan1.rx", now=1070) == []
+
+    # its slot is free again
+    store.add({"sys.cpu": 7.0, "sys.temp": 51.0}, ts=1080)
+    assert store.names == ["sys.cpu", "sys.temp"]
+
+
+def test_restored_series_get_a_fresh_expiry(tmp_path):
+    path = str(tmp_path / "ts.bin")
+    store = TimeSeriesStore()
+    store.add({"sys.cpu": 5.0}, ts=1000)
+    store.save(path)
+
+    restored = TimeSeriesStore.load(path)
+    assert restored.names == ["sys.cpu"]
+    assert restored.expire(3600) == []
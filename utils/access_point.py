@@ -0,0 +1,156 @@
+"""
+Bring up the retcon_ap access point through NetworkManager's D-Bus API
+"""
+import asyncio
+import uuid
+import sdbus
+from sdbus_async.networkmanager import (
+    NetworkManager,
+    NetworkManagerSettings,
+    NetworkConnectionSettings,
+    NetworkDeviceGeneric,
+    ActiveConnection,
+)
+
+import logging
+logger = logging.getLogger("retcon")
+
+AP_CONNECTION_ID = "retcon_ap"
+
+# connection profiles we don't want fighting us for the radio
+STALE_CONNECTION_IDS = ["preconfigured", "RETCON_WIFI_MESH"]
+
+# NMActiveConnectionState
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED = 2
+NM_ACTIVE_CONNECTION_STATE_DEACTIVATING = 3
+
+
+def ap_settings(ap_iface: str, ssid: str, psk: str, channel: int, ip_subnet_str: str, connection_uuid: str,
+                connection_id: str = AP_CONNECTION_ID) -> dict:
+    """ Everything the old nmcli add/modify commands set, as a single NM settings dict"""
+    address, prefix = ip_subnet_str.split("/")
+    return {
+        "connection": {
+            "id": ("s", connection_id),
+            "uuid": ("s", connection_uuid),
+            "type": ("s", "802-11-wireless"),
+            "interface-name": ("s", ap_iface),
+            "autoconnect": ("b", True),
+        },
+        "802-11-wireless": {
+            "ssid": ("ay", ssid.encode()),
+            "mode": ("s", "ap"),
+            "band": ("s", "bg"),
+            "channel": ("u", channel),
+        },
+        "802-11-wireless-security": {
+            "key-mgmt": ("s", "wpa-psk"),
+            "psk": ("s", psk),
+        },
+        "ipv4": {
+            "method": ("s", "shared"),
+            "address-data": ("aa{sv}", [{"address": ("s", address), "prefix": ("u", int(prefix))}]),
+        },
+    }
+
+
+def _unwrap(value):
+    """ strip the dbus ("signature", value) wrapping so settings can be compared as plain python"""
+    if isinstance(value, tuple) and len(value) == 2 and isinstance(value[0], str):
+        return _unwrap(value[1])
+    if isinstance(value, dict):
+        return {k: _unwrap(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_unwrap(x) for x in value]
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return value
+
+
+async def _settings_match(connection: NetworkConnectionSettings, desired: dict) -> bool:
+    """ Does the existing profile already have every value we want?"""
+    existing = _unwrap(await connection.get_settings())
+    # secrets aren't returned by get_settings
+    secrets = _unwrap(await connection.get_secrets("802-11-wireless-security"))
+    for group, values in secrets.items():
+        existing.setdefault(group, {}).update(values)
+
+    for group, values in _unwrap(desired).items():
+        for key, value in values.items():
+            if key == "uuid":
+                continue
+            if existing.get(group, {}).get(key) != value:
+                logger.info(f"AP {group}.{key} differs. Updating profile")
+                return False
+    return True
+
+
+async def _wait_activated(active_path: str, timeout: float):
+    """ Wait on NM's state signal instead of sleeping and hoping"""
+    active = ActiveConnection(active_path)
+
+    async def _wait_signal():
+        async for state, reason in active.state_changed.catch():
+            if state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED:
+                return
+            if state >= NM_ACTIVE_CONNECTION_STATE_DEACTIVATING:
+                raise ConnectionError(f"AP failed to activate. reason={reason}")
+
+    waiter = asyncio.create_task(_wait_signal())
+    try:
+        await asyncio.sleep(0)  # let the signal match get registered before we check the current state
+        if await active.state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED:
+            return
+        await asyncio.wait_for(waiter, timeout)
+    finally:
+        waiter.cancel()
+
+
+async def bring_up_ap(ap_iface: str, ssid: str, psk: str, channel: int, ip_subnet_str: str, timeout: float = 30,
+                      connection_id: str = AP_CONNECTION_ID):
+    """
+    Create or update the AP profile (retcon_ap by default) and make sure it's active on ap_iface.
+    If the profile already matches and is up we don't touch it at all.
+    """
+    sdbus.set_default_bus(sdbus.sd_bus_open_system())
+    nm = NetworkManager()
+    settings = NetworkManagerSettings()
+
+    # only the main AP cleans up, extra radios come up later and would kill the mesh connection
+    for stale_id in (STALE_CONNECTION_IDS if connection_id == AP_CONNECTION_ID else []):
+        for path in await settings.get_connections_by_id(stale_id):
+            logger.info(f"Deleting connection {stale_id}")
+            await NetworkConnectionSettings(path).delete()
+
+    ap_paths = await settings.get_connections_by_id(connection_id)
+    # there should only ever be one
+    for path in ap_paths[1:]:
+        await NetworkConnectionSettings(path).delete()
+
+    changed = True
+    if len(ap_paths) > 0:
+        conn_path = ap_paths[0]
+        connection = NetworkConnectionSettings(conn_path)
+        existing_uuid = _unwrap((await connection.get_settings())["connection"]["uuid"])
+        desired = ap_settings(ap_iface, ssid, psk, channel, ip_subnet_str, existing_uuid, connection_id)
+        if await _settings_match(connection, desired):
+            changed = False
+        else:
+            await connection.update(desired)
+    else:
+        logger.info(f"Adding connection {connection_id}")
+        desired = ap_settings(ap_iface, ssid, psk, channel, ip_subnet_str, str(uuid.uuid4()), connection_id)
+        conn_path = await settings.add_connection(desired)
+
+    device_path = await nm.get_device_by_ip_iface(ap_iface)
+    active_path = await NetworkDeviceGeneric(device_path).active_connection
+    if not changed and active_path != "/":
+        active = ActiveConnection(active_path)
+        if await active.connection == conn_path and await active.state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED:
+            logger.info(f"{connection_id} already up and unchanged")
+            return
+
+    logger.info(f"Activating {connection_id} on {ap_iface}")
+    active_path = await nm.activate_connection(conn_path, device_path)
+    await _wait_activated(active_path, timeout)
+    logger.info(f"{connection_id} is up")
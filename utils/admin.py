@@ -2,13 +2,25 @@
 RETCON administration utility
 """
 import os
+import re
+import uuid
+import socket
 import asyncio
 import RNS
 from io import StringIO, BytesIO
 import time
-from LXMF import LXMessage, LXMRouter
+from LXMF import LXMessage
 import subprocess
 from rns_config_gen import get_recton_config
+from announce_scheduler import AnnounceScheduler
+import transportd
+from link_probe import load_link_table
+from config_sync import ConfigSync
+from propagation import RetconLXMRouter, propagation_config
+from status_codec import StatusEncoder, parse_request, STATUS_TITLE
+from diagnostics import DiagnosticsService
+from memstat import meminfo
+from thermal import load_thermal_state
 from configobj import ConfigObj
 import sdbus
 from sdbus_block.networkmanager import (
@@ -172,10 +184,13 @@ class LXMFAdminConsole:
     def __init__(self, admin: RetconAdmin):
         base_storage_dir = os.path.join(dir_path, "storage")
         self.admin = admin
+        # attaches to transportd's shared instance. We don't own any interfaces, so reloading them doesn't restart us
         self.r = RNS.Reticulum()
-        self.router = LXMRouter(storagepath=base_storage_dir)
-        self.router.register_delivery_callback(self.on_rns_recv)
-        self._announce_interval = 2
+        if not self.r.is_connected_to_shared_instance:
+            print("WARNING: transportd isn't running. The admin console is the shared instance now")
+        # jittered per node so a room full of nodes powered on together doesn't announce in lockstep
+        self.announce_scheduler = AnnounceScheduler.from_config(uuid.getnode(), admin.config, admin.announce_every)
+        RNS.Transport.register_announce_handler(self.announce_scheduler)
         
          # ensure provided storage dir exists, or the default storage dir exists
         
@@ -197,41 +212,146 @@ class LXMFAdminConsole:
         print("Reticulum Identity <{}> has been loaded from file {}.".format(identity.hash.hex(), default_identity_file))
         
         self.ident = identity
+        # the router shares our identity, so a propagation node keeps its address across restarts
+        self.propagation = propagation_config(admin.config)
+        self.router = RetconLXMRouter(identity=self.ident, storagepath=base_storage_dir,
+                                      max_age=self.propagation["max_age"] if self.propagation else None)
+        self.router.register_delivery_callback(self.on_rns_recv)
+        if self.propagation:
+            self.router.set_message_storage_limit(megabytes=self.propagation["quota_mb"])
+            self.router.enable_propagation()
+            print(f"LXMF propagation node {RNS.prettyhexrep(self.router.propagation_destination.hash)}, "
+                  f"{self.propagation['quota_mb']:.0f}MB quota")
         self.source = self.router.register_delivery_identity(self.ident, display_name=self.admin.name)
-        self.router.announce(self.source.hash)
         self._msg_queue = []
         self._response_queue = []
+        self._stats_saved = 0
+        # signed config deltas gossiped between consoles
+        self.config_sync = ConfigSync(self.admin, self.router, self.ident, self.source)
+        RNS.Transport.register_announce_handler(self.config_sync)
+        # versions compact status replies, so pollers only get what changed
+        self.status_encoder = StatusEncoder()
+        # logs for admins, on retcon.diagnostics
+        self.diagnostics = DiagnosticsService(self.admin, self.ident)
+        
+        # one schedule per announced destination, sharing the airtime budget
+        self._announcers = {
+            "lxmf": lambda: self.router.announce(self.source.hash),
+            "config_sync": self.config_sync.announce,
+            "diagnostics": self.diagnostics.announce,
+        }
+        if self.propagation:
+            self._announcers["propagation"] = self.router.announce_propagation_node
+        self.announce_schedules = self.announce_scheduler.split(list(self._announcers))
         
         
+    def status_readings(self, fields) -> dict:
+        """ the readings behind a compact status reply, only for the fields asked for. Layouts in status_codec.FIELDS"""
+        readings = {}
+        if "node" in fields:
+            with open("/proc/uptime") as fin:
+                uptime = float(fin.read().split()[0])
+            readings["node"] = [self.admin.name, self.admin.config["retcon"].get("mode"), int(uptime), int(time.time())]
+        if "sys" in fields:
+            try:
+                with open("/sys/class/thermal/thermal_zone0/temp") as fin:
+                    temp = round(int(fin.read()) / 1000, 1)
+            except (FileNotFoundError, ValueError):
+                temp = None
+            readings["sys"] = [round(os.getloadavg()[0], 2), meminfo()["available"] // 1024, temp]
+        if "td" in fields or "iface" in fields:
+            try:
+                td = transportd.command("status")
+                readings["td"] = [td["pid"], int(td["uptime"]), td["clients"]]
+                readings["iface"] = {i["name"]: [i["online"], i["rxb"], i["txb"]] for i in td["interfaces"]}
+            except (OSError, ValueError):
+                readings["td"] = [None, None, None]
+        if "peers" in fields:
+            readings["peers"] = {}
+            for ip, e in load_link_table().items():
+                rtt = None if e.get("rtt_ms") is None else round(e["rtt_ms"])
+                kbps = None if e.get("kbps") is None else round(e["kbps"])
+                readings["peers"][socket.inet_aton(ip)] = [e.get("role"), e.get("label"), rtt, round((e.get("loss") or 0) * 100), kbps]
+        if "prop" in fields and self.propagation:
+            p = self.router.propagation_stats()
+            readings["prop"] = [p["messages"], p["destinations"], p["bytes"], p["limit"],
+                                None if p["hit_rate"] is None else round(p["hit_rate"] * 100),
+                                p["messages_served"], p["evicted_age"] + p["evicted_quota"]]
+        if "config" in fields:
+            sync = self.config_sync.last_status or {}
+            readings["config"] = [self.config_sync.version, sync.get("version"), sync.get("status"), sync.get("detail")]
+        if "rnsh" in fields:
+            readings["rnsh"] = [bytes.fromhex(h) for h in re.findall(r"<([0-9a-f]{32})>", self.admin.rnsh_identity)]
+        if "thermal" in fields:
+            t = load_thermal_state()
+            if t:
+                governors = sorted(set(t["governors"].values()))
+                readings["thermal"] = [t["state"], t["temp_c"], ",".join((t["throttled"] or {}).get("now", [])),
+                                       ",".join(governors), t["load"][0] if t["load"] else None]
+        return readings
+        
     def process_command(self, message:bytes):
         command, *args = message.decode().strip().split(" ", 1)
         command = command.lower()
         
-        if command == "status":
+        if command == "status" and args and parse_request(args[0]):
+            # compact msgpack reply for slow links. See status_codec
+            wanted = parse_request(args[0])
+            self.status_encoder.update(self.status_readings(wanted))
+            return self.status_encoder.encode(wanted)
+        elif command == "status":
             result = "" 
             current_env = os.environ.copy()
             sresult = subprocess.run(['rnstatus'], capture_output=True, env=current_env)
             result+= sresult.stdout.decode()
             
             #result+= " wifi is connected to: " + self.admin.connected_ap
+            try:
+                td = transportd.command("status")
+                result+= f"\n TRANSPORTD \n pid {td['pid']} up {td['uptime']:.0f}s, {td['clients']} clients\n"
+            except (OSError, ValueError) as e:
+                result+= f"\n TRANSPORTD unreachable: {e}\n"
+            links = load_link_table()
+            if links:
+                result+= "\n LINKS \n"
+                for ip, e in sorted(links.items(), key=lambda kv: kv[1].get("role", "")):
+                    rtt = "-" if e.get("rtt_ms") is None else f"{e['rtt_ms']:.0f}ms"
+                    kbps = "-" if e.get("kbps") is None else f"{e['kbps']:.0f}kbps"
+                    result+= f" {e.get('role')} {e.get('label')} {ip}: rtt {rtt} loss {(e.get('loss') or 0):.0%} {kbps}\n"
+            if self.propagation:
+                p = self.router.propagation_stats()
+                hit_rate = "-" if p["hit_rate"] is None else f"{p['hit_rate']:.0%}"
+                result+= (f"\n PROPAGATION \n {p['messages']} messages for {p['destinations']} destinations, "
+                          f"{p['bytes'] / 1e6:.1f} of {p['limit'] / 1e6:.0f}MB. hit rate {hit_rate}, "
+                          f"{p['messages_served']} served, {p['evicted_age'] + p['evicted_quota']} evicted\n")
+            sync = self.config_sync.last_status
+            result+= f"\n CONFIG \n version {self.config_sync.version}"
+            result+= f", last update v{sync['version']} {sync['status']} {sync['detail']}\n" if sync else "\n"
+            t = load_thermal_state()
+            if t:
+                throttled = ",".join((t["throttled"] or {}).get("now", [])) or "no"
+                result+= (f"\n THERMAL \n {t['state']} since {time.strftime('%H:%M', time.localtime(t['since']))}, "
+                          f"{t['temp_c']}C ({t['headroom_c']}C headroom), throttled {throttled}, "
+                          f"governor {','.join(sorted(set(t['governors'].values()))) or '-'}\n")
             result+= "\n RNSH STATUS \n" + self.admin.rnsh_identity
             return result
         else:
             return ("Welcome to the RETCON LXMF admin interface. Possible commands are: \n" +
-                            "status")
+                            "status\n" +
+                            "status <fields> (compact, for status_codec.py. Fields: node,sys,td,iface,peers,prop,config,rnsh,thermal or all)")
         
                     
     def on_rns_recv(self, message : LXMessage):        
         # DO STUFF WITH MESSAGE HERE
         reply_hash = message.source_hash
+        if self.config_sync.handles(message):
+            return
         response = self.process_command(message.content)
         RNS.Transport.request_path(reply_hash)
         self._response_queue.append((reply_hash, response))
            
             
     async def loop(self):
-        last_announce = 0 # never announced
-        
         while True:
             self._msg_queue = []
                   
@@ -244,25 +364,27 @@ class LXMFAdminConsole:
                     destination = RNS.Destination(dest_id, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
                     lxm = LXMessage(destination, self.source,
                                     text,
-                                    "RETCON console",
+                                    STATUS_TITLE if isinstance(text, bytes) else "RETCON console",
                                     desired_method=LXMessage.OPPORTUNISTIC)
             
                     self.router.handle_outbound(lxm)
-                    print(" -> " + str(text))
+                    print(" -> " + (f"compact status, {len(text)} bytes" if isinstance(text, bytes) else str(text)))
                 else:
                     RNS.Transport.request_path(reply_hash)
                     self._response_queue.append((reply_hash, text))
                     
-            # announce when it's time
-            now = time.time()
-            if now - last_announce > self._announce_interval:
-                print("announcing again!")
-                self.router.announce(self.source.hash)
-                last_announce = now
-                # double the announce interval until we hit the desired max. This means way MORE announces on startup 
-                # before leveling off as qw're been around longer
-                self._announce_interval = min(self.admin.announce_every, self._announce_interval * 2)
+            # announce each destination when it's time. Every one ramps up to announce_every on its own schedule,
+            # jittered, airtime limited and backing off when busy
+            for name, schedule in self.announce_schedules.items():
+                if schedule.due():
+                    self._announcers[name]()
+                    delay = schedule.announced()
+                    print(f"announced {name}. next in {delay:.0f}s")
                 
+            self.config_sync.tick()
+            if self.propagation and time.time() - self._stats_saved > 60:
+                self.router.save_propagation_stats()
+                self._stats_saved = time.time()
             #print(os.getppid())
             await asyncio.sleep(2)
                     
@@ -0,0 +1,118 @@
+"""
+Announce scheduling for everything on a node that announces (the LXMF admin console, rnsh).
+
+A whole event's worth of nodes tends to get powered on at the same moment. If they all announce
+at 2, 4, 8, 16s... they do it in lockstep and flatten the LoRa segments. So:
+  * every node gets its own jitter, seeded from its node id so it's stable across reboots
+  * the interval never drops below what a per-interface airtime budget allows for the slowest LoRa radio
+  * if we're hearing lots of announces from other nodes we back off further
+  * a process announcing several destinations splits its schedule, so each destination gets its
+    own jittered slot and a share of the airtime budget instead of all going out back to back
+"""
+import time
+import random
+from collections import deque
+
+# imported as utils.announce_scheduler by retcon.py and as a plain module by admin.py
+try:
+    from .lora_planner import ANNOUNCE_BYTES, airtime, lora_interfaces
+except ImportError:
+    from lora_planner import ANNOUNCE_BYTES, airtime, lora_interfaces
+
+import logging
+logger = logging.getLogger("retcon")
+
+DEFAULT_AIRTIME_BUDGET = 0.01   # share of a LoRa channel our own announces may take
+MIN_INTERVAL = 2
+STARTUP_SPREAD = 30             # the first announce lands somewhere in this many seconds after start
+JITTER = 0.25                   # +/- fraction of every interval
+BUSY_WINDOW = 300               # seconds of observed announces we look back over
+BUSY_ANNOUNCES = 60             # more than this many in BUSY_WINDOW and we start backing off
+MAX_BACKOFF = 4                 # never stretch past announce_every * MAX_BACKOFF
+
+
+class AnnounceScheduler:
+    """
+    Decides when to announce. Also an RNS announce handler, register it with
+    RNS.Transport.register_announce_handler so it can see how busy the network is.
+    """
+
+    aspect_filter = None  # every announce, not just lxmf
+
+    def __init__(self, node_id: int, announce_every: float, interfaces: list = (),
+                 airtime_budget: float = DEFAULT_AIRTIME_BUDGET, min_interval: float = MIN_INTERVAL):
+        self.node_id = node_id
+        self.announce_every = announce_every
+        self.interfaces = list(interfaces)
+        self.airtime_budget = airtime_budget
+        self.min_interval = max(min_interval, self.airtime_floor)
+        self.interval = self.min_interval
+        self._rng = random.Random(node_id)
+        self._observed = deque()
+        self.next_announce = time.time() + self._rng.uniform(0, STARTUP_SPREAD)
+
+    @classmethod
+    def from_config(cls, node_id: int, config, announce_every: float):
+        budget = float(config.get("retcon", {}).get("announce_airtime_budget", DEFAULT_AIRTIME_BUDGET))
+        return cls(node_id, announce_every, lora_interfaces(config), airtime_budget=budget)
+
+    @property
+    def airtime_floor(self) -> float:
+        """ shortest interval that keeps our announces inside the budget on every LoRa radio"""
+        floors = [airtime(ANNOUNCE_BYTES, p.sf, p.bw, p.cr) / self.airtime_budget for _, p in self.interfaces]
+        return max(floors, default=0)
+
+    def received_announce(self, destination_hash, announced_identity, app_data):
+        self._observed.append(time.time())
+
+    def observed(self, now: float = None) -> int:
+        """ announces heard from others in the last BUSY_WINDOW seconds"""
+        now = now or time.time()
+        while self._observed and self._observed[0] < now - BUSY_WINDOW:
+            self._observed.popleft()
+        return len(self._observed)
+
+    def backoff(self, now: float = None) -> float:
+        return min(MAX_BACKOFF, max(1.0, self.observed(now) / BUSY_ANNOUNCES))
+
+    def due(self, now: float = None) -> bool:
+        return (now or time.time()) >= self.next_announce
+
+    def announced(self, now: float = None):
+        """ call after announcing to schedule the next one"""
+        now = now or time.time()
+        # same ramp as before, lots of announces early then level off at announce_every
+        self.interval = min(self.announce_every, self.interval * 2)
+        delay = min(self.interval * self.backoff(now), self.announce_every * MAX_BACKOFF)
+        delay = max(self.min_interval, delay * self._rng.uniform(1 - JITTER, 1 + JITTER))
+        self.next_announce = now + delay
+        return delay
+
+    def split(self, names: list) -> dict:
+        """
+        name -> a schedule per destination this process announces. Each gets an even share of the
+        airtime budget and its own jitter stream, and they all back off on what this one observes
+        """
+        schedules = {}
+        for name in names:
+            s = AnnounceScheduler(self.node_id, self.announce_every, self.interfaces,
+                                  airtime_budget=self.airtime_budget / len(names), min_interval=self.min_interval)
+            s._rng = self._rng_for(name)
+            s._observed = self._observed  # only this one is registered as the announce handler
+            s.next_announce = time.time() + s._rng.uniform(0, STARTUP_SPREAD)
+            schedules[name] = s
+        return schedules
+
+    def _rng_for(self, name: str) -> random.Random:
+        # separate stream per process so rnsh doesn't shift the admin console's schedule
+        return random.Random(f"{self.node_id}-{name}")
+
+    def startup_delay(self, name: str) -> float:
+        """ jittered start for processes that announce on their own as soon as they start"""
+        return self._rng_for(name).uniform(0, STARTUP_SPREAD)
+
+    def period(self, name: str, base: float) -> float:
+        """ jittered fixed period for processes with their own announce timer (rnsh -b)"""
+        rng = self._rng_for(name)
+        rng.random()  # skip the value startup_delay used
+        return max(self.min_interval, base * rng.uniform(1 - JITTER, 1 + JITTER))
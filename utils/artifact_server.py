@@ -0,0 +1,341 @@
+"""
+Artifact download server for the client homepage.
+
+Flask's dev server pushes every byte of a firmware image through python buffers, can't resume and
+makes every browser download the whole thing again. At an event dozens of people pull the same
+firmware at once, and that pegs the CPU of the node serving it. This serves artifacts/ and the
+rnode-flasher app instead:
+
+    - the kernel copies file data straight to the socket (sendfile)
+    - Range requests, so interrupted downloads resume, and If-Range
+    - strong ETags (content hash) with If-None-Match, and Cache-Control
+    - gzip (and brotli, if installed) variants of compressible files, built in a background thread
+      at startup into ~/.retcon/artifact_cache. Never next to the artifacts, the file explorer shows
+      those. Until that's done files go out uncompressed
+    - at most max_downloads transfers at once. Anyone past that gets a 503 with Retry-After
+
+    python utils/artifact_server.py --port 8080
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import mimetypes
+import threading
+import http.server
+from urllib.parse import unquote, urlsplit
+
+try:
+    import brotli  # optional, browsers prefer it. gzip alone is fine
+except ImportError:
+    brotli = None
+
+ARTIFACT_PORT = 8080
+MAX_DOWNLOADS = 8
+CACHE_DIR = os.path.expanduser("~/.retcon/artifact_cache")
+CACHE_CONTROL = "public, max-age=3600"
+
+# what's worth compressing. Firmware zips and images are already as small as they get, and raw firmware
+# (.bin/.hex) goes out as is. Flashers want the exact bytes, not a Content-Encoding to undo
+COMPRESSIBLE = {".html", ".js", ".css", ".json", ".txt", ".svg", ".map", ".md", ".csv", ".wasm"}
+COPY_CHUNK = 1 << 20
+MIN_COMPRESS_SIZE = 1024
+MIN_SAVING = 0.9  # keep a variant only if it's at most 90% of the original
+
+
+def _digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(COPY_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()[:32]
+
+
+def _gzip_file(src: str, dst: str):
+    with open(src, "rb") as fin, open(dst, "wb") as raw, \
+            gzip.GzipFile(filename="", mode="wb", compresslevel=9, fileobj=raw, mtime=0) as fout:
+        shutil.copyfileobj(fin, fout, COPY_CHUNK)
+
+
+def _brotli_file(src: str, dst: str):
+    compressor = brotli.Compressor(quality=11)
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        for chunk in iter(lambda: fin.read(COPY_CHUNK), b""):
+            fout.write(compressor.process(chunk))
+        fout.write(compressor.finish())
+
+
+class ArtifactStore:
+    """
+    url prefix -> directory. Resolves request paths to files and keeps per file metadata
+    (etag, precompressed variants) keyed by (size, mtime), so a replaced file is picked up
+    """
+
+    def __init__(self, roots: dict, cache_dir: str = CACHE_DIR):
+        self.roots = {prefix: os.path.realpath(root) for prefix, root in roots.items()}
+        self.cache_dir = cache_dir
+        self._meta = {}
+        self._lock = threading.Lock()
+        self.warmed = threading.Event()  # set once warm() built every variant
+
+    def resolve(self, url_path: str):
+        """ (prefix, real file path) or None. Never anything outside a root"""
+        url_path = unquote(urlsplit(url_path).path)
+        for prefix, root in self.roots.items():
+            if not url_path.startswith(prefix):
+                continue
+            path = os.path.realpath(os.path.join(root, url_path[len(prefix):].lstrip("/")))
+            if path != root and not path.startswith(root + os.sep):
+                return None
+            if os.path.isdir(path):
+                path = os.path.join(path, "index.html")
+            return (prefix, path) if os.path.isfile(path) else None
+        return None
+
+    def _variant_path(self, prefix: str, path: str, ext: str) -> str:
+        rel = os.path.relpath(path, self.roots[prefix])
+        return os.path.join(self.cache_dir, prefix.strip("/").replace("/", "_"), rel + ext)
+
+    def _build_variants(self, prefix: str, path: str, st) -> dict:
+        """ encoding -> variant path. Rebuilt only when the original is newer"""
+        if os.path.splitext(path)[1].lower() not in COMPRESSIBLE or st.st_size < MIN_COMPRESS_SIZE:
+            return {}
+        compressors = {"gzip": (".gz", _gzip_file)}
+        if brotli is not None:
+            compressors["br"] = (".br", _brotli_file)
+
+        variants = {}
+        for encoding, (ext, compress) in compressors.items():
+            out = self._variant_path(prefix, path, ext)
+            try:
+                fresh = os.stat(out).st_mtime >= st.st_mtime
+            except FileNotFoundError:
+                fresh = False
+            if not fresh:
+                # streamed through a per thread tmp file. A request can race warm() to the same variant
+                os.makedirs(os.path.dirname(out), exist_ok=True)
+                tmp = f"{out}.{threading.get_ident()}.tmp"
+                compress(path, tmp)
+                if os.path.getsize(tmp) > st.st_size * MIN_SAVING:
+                    os.unlink(tmp)
+                    continue
+                os.replace(tmp, out)
+            if os.path.getsize(out) <= st.st_size * MIN_SAVING:
+                variants[encoding] = out
+        return variants
+
+    def meta(self, prefix: str, path: str, compress: bool = True) -> dict:
+        """ etag, size and variants of a file. compress=False skips building variants that aren't there yet"""
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._meta.get(path)
+        if cached is not None and cached["key"] == key:
+            if cached["compressed"] or not compress:
+                return cached
+            etag = cached["etag"].strip('"')
+        else:
+            etag = _digest(path)
+        variants = {}
+        if compress:
+            for encoding, vpath in self._build_variants(prefix, path, st).items():
+                variants[encoding] = {"path": vpath, "size": os.path.getsize(vpath), "etag": f'"{etag}-{encoding}"'}
+        meta = {"key": key, "size": st.st_size, "etag": f'"{etag}"', "variants": variants, "compressed": compress,
+                "type": mimetypes.guess_type(path)[0] or "application/octet-stream"}
+        with self._lock:
+            self._meta[path] = meta
+        return meta
+
+    def warm(self) -> dict:
+        """ hash everything and build the compressed variants up front, not on the first download"""
+        start = time.time()
+        files = variants = 0
+        for prefix, root in self.roots.items():
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    try:
+                        variants += len(self.meta(prefix, os.path.join(dirpath, name))["variants"])
+                        files += 1
+                    except OSError:
+                        pass
+        self.warmed.set()
+        return {"files": files, "variants": variants, "seconds": time.time() - start}
+
+
+def parse_range(header: str, size: int):
+    """
+    (start, end inclusive) for a single byte range, None to ignore the header and send it all,
+    or False if it can't be satisfied
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None  # multi ranges aren't worth it for downloads. The whole file is a valid answer
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first == "":
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+class ArtifactServer:
+
+    def __init__(self, roots: dict, host: str = "0.0.0.0", port: int = ARTIFACT_PORT,
+                 max_downloads: int = MAX_DOWNLOADS, cache_dir: str = CACHE_DIR):
+        self.store = ArtifactStore(roots, cache_dir)
+        self.slots = threading.BoundedSemaphore(max_downloads)
+        self.max_downloads = max_downloads
+        self.stats = {"requests": 0, "bytes": 0, "busy": 0, "active": 0}
+        self._stats_lock = threading.Lock()  # every handler thread counts into stats
+        server = self
+
+        class Handler(_ArtifactHandler):
+            artifacts = server
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _warm(self):
+        warm = self.store.warm()
+        print(f"artifact server: {warm['files']} files, {warm['variants']} compressed variants in {warm['seconds']:.1f}s")
+
+    def start(self):
+        """
+        Serve from a background thread right away and precompress in another. start_homepage calls
+        this from retcon.py's event loop in compact mode, so it mustn't hash the whole tree first
+        """
+        threading.Thread(target=self._warm, daemon=True, name="artifact-warm").start()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        print(f"artifact server: serving on {self.httpd.server_address[0]}:{self.httpd.server_port}")
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _ArtifactHandler(http.server.BaseHTTPRequestHandler):
+    artifacts = None  # the ArtifactServer, set per server
+    protocol_version = "HTTP/1.1"
+    timeout = 60  # a stalled client shouldn't hold a download slot forever
+
+    def log_message(self, *args):
+        pass
+
+    def _empty(self, code: int, headers: dict = None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _pick_encoding(self, meta: dict):
+        accepted = {e.split(";")[0].strip() for e in self.headers.get("Accept-Encoding", "").split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in meta["variants"]:
+                return encoding
+        return None
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        server = self.artifacts
+        server.count("requests")
+        found = server.store.resolve(self.path)
+        if found is None:
+            return self._empty(404)
+        try:
+            # until warm() is done, send what isn't compressed yet as is instead of compressing it on request
+            meta = server.store.meta(*found, compress=server.store.warmed.is_set())
+        except OSError:
+            return self._empty(404)
+
+        encoding = self._pick_encoding(meta)
+        path, size, etag = found[1], meta["size"], meta["etag"]
+        if encoding is not None:
+            variant = meta["variants"][encoding]
+            path, size, etag = variant["path"], variant["size"], variant["etag"]
+        headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+        if meta["variants"]:
+            headers["Vary"] = "Accept-Encoding"
+
+        if etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+            return self._empty(304, headers)
+
+        span = parse_range(self.headers.get("Range"), size)
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            span = None  # the file changed since they started. Send the new one whole
+        if span is False:
+            headers["Content-Range"] = f"bytes */{size}"
+            return self._empty(416, headers)
+
+        if body and not server.slots.acquire(timeout=2):
+            server.count("busy")
+            headers = {"Retry-After": "5"}
+            return self._empty(503, headers)
+        try:
+            server.count("active")
+            start, end = span if span else (0, size - 1)
+            self.send_response(206 if span else 200)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            if span:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Type", meta["type"])
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if body and size > 0:
+                with open(path, "rb") as fin:
+                    # socket.sendfile is os.sendfile underneath. The data never enters python
+                    sent = self.connection.sendfile(fin, start, end - start + 1)
+                server.count("bytes", sent)
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            self.close_connection = True  # they went away. A Range request picks it up later
+        finally:
+            server.count("active", -1)
+            if body:
+                server.slots.release()
+
+
+if __name__ == "__main__":
+    dir_path = os.path.dirname(os.path.realpath(__file__)) + "/.."
+    parser = argparse.ArgumentParser(description="serve RETCON artifacts")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=ARTIFACT_PORT)
+    parser.add_argument("--max-downloads", type=int, default=MAX_DOWNLOADS)
+    parser.add_argument("--root", action="append", default=None,
+                        help="prefix=directory, repeatable. Default: /artifacts/ and /rnode-flasher/")
+    args = parser.parse_args()
+
+    roots = {"/artifacts/": dir_path + "/artifacts",
+             "/rnode-flasher/": dir_path + "/utils/client_web_ui/static/rnode-flasher"}
+    if args.root:
+        roots = dict(r.split("=", 1) for r in args.root)
+    server = ArtifactServer(roots, args.host, args.port, args.max_downloads).start()
+    try:
+        while True:
+            time.sleep(60)
+            with server._stats_lock:
+                print(json.dumps(server.stats))
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
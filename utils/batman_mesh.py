@@ -0,0 +1,132 @@
+"""
+Layer 2 mesh backend. An 802.11s mesh point with batman-adv routing on top.
+
+Instead of the AP/STA tree (one parent per node, a /24 per transport and a
+BackboneInterface re-encapsulating at every hop) every node joins one flat L2 segment
+(bat0). batman-adv picks paths and reroutes around dead nodes on its own, so there's
+no AP switching and reticulum just runs an AutoInterface over bat0.
+
+NOTE: the pi's onboard brcmfmac radio can't do mesh point mode. Use a USB adapter with a
+driver that can (ath9k_htc, mt76, rt2800usb...) and point batman_iface at it.
+All of this needs root, the image build adds sudo rules for iw/ip/batctl/wpa_supplicant. The ip and
+wpa_supplicant rules only allow the exact commands below, with the default mesh0/bat0 names.
+"""
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger("retcon")
+
+wpa_mesh_template = """ctrl_interface={ctrl_dir}
+update_config=0
+
+network={{
+    ssid="{mesh_id}"
+    mode=5
+    frequency={freq}
+    key_mgmt=SAE
+    psk="{psk}"
+    ieee80211w=2
+}}
+"""
+
+
+def _conf_string(name: str, value: str) -> str:
+    """ value, if it can sit between the quotes of a wpa_supplicant.conf string. A " or a newline would end it
+    and let the rest through as config of its own"""
+    if any(c == '"' or ord(c) < 0x20 or c == "\x7f" for c in value):
+        raise ValueError(f"batman mesh: {name} can't contain quotes, newlines or other control characters")
+    return value
+
+
+async def run_cmd(*args, check=True, sudo=True) -> str:
+    """ Run a command without a shell and return stdout"""
+    if sudo and os.geteuid() != 0:
+        args = ("sudo", "-n") + args
+    proc = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    out, err = await proc.communicate()
+    if check and proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed ({proc.returncode}): {err.decode().strip()}")
+    return out.decode()
+
+
+class BatmanMesh:
+
+    def __init__(self, mesh_id: str, psk: str, freq: int, phy_iface: str,
+                 mesh_iface: str = "mesh0", bat_iface: str = "bat0",
+                 state_dir: str = os.path.expanduser("~/.retcon")):
+        self.mesh_id = _conf_string("mesh_id", mesh_id)
+        self.psk = _conf_string("psk", psk)
+        self.freq = freq
+        self.phy_iface = phy_iface  # an existing wifi iface on the radio we take over
+        self.mesh_iface = mesh_iface
+        self.bat_iface = bat_iface
+        self.state_dir = state_dir
+        self._supplicant = None
+        self._active = True
+        self.neighbors = {}  # mac -> {"iface", "last_seen", "throughput"}
+
+    async def _create_mesh_iface(self):
+        # keep NetworkManager's hands off the mesh iface
+        existing = await run_cmd("iw", "dev", check=False, sudo=False)
+        if f"Interface {self.mesh_iface}" not in existing:
+            await run_cmd("iw", "dev", self.phy_iface, "interface", "add", self.mesh_iface, "type", "mp")
+        await run_cmd("nmcli", "device", "set", self.mesh_iface, "managed", "no", check=False, sudo=False)
+        await run_cmd("ip", "link", "set", self.mesh_iface, "up")
+
+    async def _start_supplicant(self):
+        # wpa_supplicant handles the SAE handshake and peering for a secured mesh
+        os.makedirs(self.state_dir, exist_ok=True)
+        conf_path = os.path.join(self.state_dir, "wpa_mesh.conf")
+        with open(conf_path, "w") as fout:
+            fout.write(wpa_mesh_template.format(ctrl_dir=os.path.join(self.state_dir, "wpa_mesh"),
+                                                mesh_id=self.mesh_id, freq=self.freq, psk=self.psk))
+        os.chmod(conf_path, 0o600)
+
+        args = ["wpa_supplicant", "-i", self.mesh_iface, "-c", conf_path, "-D", "nl80211"]
+        if os.geteuid() != 0:
+            args = ["sudo", "-n"] + args
+        self._supplicant = await asyncio.create_subprocess_exec(*args)
+
+    async def _setup_batman(self):
+        await run_cmd("modprobe", "batman-adv")
+        await run_cmd("batctl", "routing_algo", "BATMAN_V", check=False)
+        await run_cmd("batctl", "meshif", self.bat_iface, "interface", "add", self.mesh_iface)
+        # the mesh point iface must carry full size frames plus the batman header
+        await run_cmd("ip", "link", "set", self.mesh_iface, "mtu", "1560", check=False)
+        await run_cmd("ip", "link", "set", self.bat_iface, "up")
+
+    async def update_neighbors(self):
+        """ refresh the neighbor table from batctl"""
+        out = await run_cmd("batctl", "meshif", self.bat_iface, "neighbors", "-H", check=False)
+        neighbors = {}
+        for line in out.splitlines():
+            # BATMAN_V: "<iface> <mac> <last-seen>s ( <throughput>)"
+            parts = line.replace("(", " ").replace(")", " ").split()
+            if len(parts) < 3:
+                continue
+            neighbors[parts[1]] = {"iface": parts[0], "last_seen": parts[2], "throughput": " ".join(parts[3:])}
+        self.neighbors = neighbors
+        return neighbors
+
+    async def mesh_up(self, plugin=None) -> None:
+        logger.info(f"Bringing up 802.11s/batman-adv mesh {self.mesh_id} on {self.phy_iface}")
+        await self._create_mesh_iface()
+        await self._start_supplicant()
+        await self._setup_batman()
+
+        try:
+            while self._active:
+                await self.update_neighbors()
+                if self._supplicant.returncode is not None:
+                    raise ConnectionError(f"wpa_supplicant for {self.mesh_iface} exited with {self._supplicant.returncode}")
+                await asyncio.sleep(10)
+        finally:
+            await self.mesh_down()
+
+    async def mesh_down(self):
+        if self._supplicant is not None and self._supplicant.returncode is None:
+            self._supplicant.terminate()
+            await self._supplicant.wait()
+        await run_cmd("batctl", "meshif", self.bat_iface, "interface", "del", self.mesh_iface, check=False)
+        await run_cmd("iw", "dev", self.mesh_iface, "del", check=False)
@@ -1,6 +1,7 @@
 import netifaces as ni
 import json 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, redirect
+from urllib.parse import quote
 import os
 import sys
 import subprocess
@@ -14,6 +15,9 @@ util_path = os.path.dirname(os.path.realpath(__file__)) + "/../"
 print(util_path)
 sys.path.append(util_path)
 from admin import RetconAdmin
+from link_probe import load_link_table
+from artifact_server import ArtifactServer, ARTIFACT_PORT
+from timeseries import TimeSeriesStore, LIVE_PATH, PERSIST_PATH, sparkline_svg
 
 
 app = Flask(__name__)
@@ -24,6 +28,25 @@ app.config["FFE_BASE_DIRECTORY"] = util_path + '../artifacts'         # The dire
 app.register_blueprint(file_explorer_bp, url_prefix='/file-explorer')   # Add the blueprint to the flask app
 register_filters(app)                                                   # Register the filter
 
+def artifact_url(path):
+    return f"http://{request.host.split(':')[0]}:{ARTIFACT_PORT}/artifacts/{quote(path.lstrip('/'))}"
+
+@app.before_request
+def explorer_downloads():
+    # the explorer's /download (and /browse on a file) send_file through flask. Files go to the artifact server
+    if request.endpoint not in ("flask_file_explorer.download", "flask_file_explorer.browse"):
+        return None
+    path = request.args.get("path", "")
+    if os.path.isfile(os.path.join(app.config["FFE_BASE_DIRECTORY"], path.lstrip("/"))):
+        return redirect(artifact_url(path))
+    return None
+
+def start_artifact_server(host):
+    # downloads go through the artifact server (sendfile, resume, precompressed). Flask only browses
+    roots = {"/artifacts/": util_path + '../artifacts',
+             "/rnode-flasher/": os.path.dirname(os.path.realpath(__file__)) + '/static/rnode-flasher'}
+    return ArtifactServer(roots, host=host, port=ARTIFACT_PORT).start()
+
 @app.route('/')
 def index():
     return render_template("index.html", admin=admin)
@@ -93,6 +116,56 @@ def reset_reticulum_config():
     else:
         return jsonify({ "message" : "do_reset must be = 1"})
    
+@app.route('/link_quality', methods=['GET'])
+def link_quality():
+    # written by the wifi mesh link prober. peer ip -> rtt_ms, loss, kbps, role
+    return jsonify(load_link_table())
+
+@app.route('/artifacts/<path:path>', methods=['GET'])
+def artifacts(path):
+    return redirect(artifact_url(path))
+
+@app.route('/qos_stats', methods=['GET'])
+def qos_stats():
+    # written by the qos plugin every loop. Bytes, drops and backlog per shaping class
+    try:
+        with open(os.path.expanduser("~/.retcon/qos_stats.json")) as fin:
+            return jsonify(json.load(fin))
+    except (FileNotFoundError, ValueError):
+        return jsonify({})
+
+_timeseries = {"mtime": None, "store": None}
+
+def timeseries_store():
+    # written by the timeseries plugin every 10s. Only re-read when it changed, a page pulls a dozen sparklines
+    path = LIVE_PATH if os.path.exists(LIVE_PATH) else PERSIST_PATH
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _timeseries["mtime"] or _timeseries["store"] is None:
+        _timeseries["store"], _timeseries["mtime"] = TimeSeriesStore.load(path), mtime
+    return _timeseries["store"]
+
+@app.route('/timeseries', methods=['GET'])
+def timeseries():
+    # ?series=net.,sys.cpu (prefixes, default all) &tier=10s|1m|15m
+    store = timeseries_store()
+    series = request.args.get("series")
+    try:
+        return jsonify(store.query(series.split(",") if series else None, request.args.get("tier", "1m")))
+    except KeyError as e:
+        return jsonify({"message": str(e), "status": "error"}), 400
+
+@app.route('/sparkline/<name>.svg', methods=['GET'])
+def sparkline(name):
+    store = timeseries_store()
+    try:
+        points = store.tier(request.args.get("tier", "1m")).read(name)
+    except KeyError:
+        points = []
+    return sparkline_svg(points), 200, {"Content-Type": "image/svg+xml", "Cache-Control": "max-age=10"}
+   
 # main driver function
 if __name__ == '__main__':
     
@@ -105,6 +178,7 @@ if __name__ == '__main__':
         # run() method of Flask class runs the application 
         # on the local development server.
         print(f"Running retcon UI on {ip}")
+        start_artifact_server(ip)
         app.run(host=ip,port=80)
     except ValueError:
         print("ERROR Couldn't get netinfo for uap. Assuming dev session and launching with default settings")
@@ -32,6 +32,18 @@ if(bindIp) {
     },
     ws:true
     }).listen(443, bindIp);
+
+    // artifact server
+    httpProxy.createServer({
+    target: {
+        host: bindIp,
+        port: 8080
+    },
+    ssl: {
+        key: fs.readFileSync(homedir+'/.retcon/key.pem', 'utf8'),
+        cert: fs.readFileSync(homedir+'/.retcon/cert.pem', 'utf8')
+    },
+    }).listen(8081, bindIp);
 } else {
     console.log("Exiting, no bind ip set")
 }
\ No newline at end of file
@@ -0,0 +1,424 @@
+"""
+Fleet config distribution over the mesh.
+
+An operator signs a small delta (set/delete of individual profile keys) against the fleet's
+config version and hands it to any one node's admin console. Consoles gossip it on: each one
+verifies the signature, applies it if it's the next version, and forwards it over LXMF to its
+direct neighbours that are behind. Nobody pulls from the origin, so a venue of nodes behind one
+LoRa hop updates as fast as the slowest neighbour link.
+
+Each delta names its base version and the digest of the delta it builds on. Two admins signing
+different deltas against the same base would otherwise both make "the next version" and split
+the fleet quietly. A console that sees a second delta for a version it has, or one built on a
+delta it doesn't have, refuses it, reports the conflict to both signers and passes it on so the
+rest of the fleet notices too. Fix it by pushing a new delta on top of the version that won.
+
+Every console announces its config version on retcon.config_sync. Neighbours that hear an old
+version push whatever deltas it is missing, which also catches up nodes that were off while
+an update went round. Each node reports its apply status straight back to the signer.
+
+Deltas are only accepted from identities whose hash is in [retcon] config_signers, or whose LXMF
+address is in [retcon] admins.
+
+    python utils/config_sync.py identity                      # create/show the signer identity
+    python utils/config_sync.py push --set retcon.announce_every=1800 --set retcon.wifi.client_ap_psk=newpass
+    python utils/config_sync.py diff old.config new.config    # what a push of new.config would send
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+
+import RNS
+from RNS.vendor import umsgpack
+from LXMF import LXMessage
+
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
+
+STATE_PATH = os.path.expanduser("~/.retcon/config_sync.json")
+SIGNER_IDENTITY_PATH = os.path.expanduser("~/.retcon/config_signer")
+
+APP_NAME = "retcon"
+ASPECT = "config_sync"
+DELTA_TITLE = "RETCON config delta"
+STATUS_TITLE = "RETCON config status"
+FORMAT = 2
+
+LOG_SIZE = 16           # deltas kept to catch up neighbours that were away
+NEIGHBOUR_HOPS = 1      # only gossip to direct neighbours, they forward further
+RESEND_AFTER = 10 * 60  # don't push the same version to the same neighbour more often than this
+REBOOT_DELAY = 120      # time to forward a delta before a node reboots to apply it
+
+
+def config_delta(old: dict, new: dict, path: tuple = ()) -> list:
+    """ ops turning old into new. [path, value] sets a key or a whole section, [path] deletes one"""
+    ops = []
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            ops += config_delta(old[key], value, path + (key,))
+        elif key not in old or old[key] != value:
+            ops.append([list(path + (key,)), _plain(value)])
+    for key in old:
+        if key not in new:
+            ops.append([list(path + (key,))])
+    return ops
+
+
+def _plain(value):
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    return value
+
+
+def apply_delta(config, ops: list):
+    """ apply ops to a ConfigObj (or plain dict) in place"""
+    for op in ops:
+        *parents, key = op[0]
+        section = config
+        for p in parents:
+            if p not in section:
+                section[p] = {}
+            section = section[p]
+        if len(op) == 1:
+            section.pop(key, None)
+        else:
+            section[key] = op[1]
+
+
+def parse_assignment(text: str) -> list:
+    """ 'retcon.wifi.client_ap_psk=abc' -> set op. Commas make a list, like in the profile"""
+    dotted, _, value = text.partition("=")
+    value = [v.strip() for v in value.split(",")] if "," in value else value
+    return [dotted.split("."), value]
+
+
+def delta_digest(envelope: bytes) -> bytes:
+    return RNS.Identity.full_hash(envelope)[:16]
+
+
+def sign_delta(identity, base: int, ops: list, restart: bool = False, parent: bytes = b"") -> bytes:
+    """ the signed envelope consoles pass around. parent is the digest of the base version's delta, b"" for v0"""
+    body = umsgpack.packb([FORMAT, identity.get_public_key(), base, base + 1, parent, time.time(), restart, ops])
+    return umsgpack.packb([body, identity.sign(body)])
+
+
+class Delta:
+
+    def __init__(self, envelope: bytes):
+        self.envelope = envelope
+        body, signature = umsgpack.unpackb(envelope)
+        fmt, *fields = umsgpack.unpackb(body)
+        if fmt != FORMAT:
+            raise ValueError(f"unknown delta format {fmt}")
+        public_key, self.base, self.version, self.parent, self.created, self.restart, self.ops = fields
+        self.signer = RNS.Identity(create_keys=False)
+        self.signer.load_public_key(public_key)
+        if not self.signer.validate(signature, body):
+            raise ValueError("bad signature")
+
+    @property
+    def digest(self) -> bytes:
+        return delta_digest(self.envelope)
+
+    @property
+    def signer_lxmf_hash(self) -> bytes:
+        return RNS.Destination.hash(self.signer, "lxmf", "delivery")
+
+
+class ConfigSync:
+    """
+    Lives in the admin console. Feed it LXMF messages with handles(), call announce() when the
+    console announces and tick() from its loop
+
+    Announces and messages arrive on RNS threads while tick() runs on the console's loop, so
+    everything touching peers, the log or the outbox holds _lock
+    """
+
+    aspect_filter = f"{APP_NAME}.{ASPECT}"
+
+    def __init__(self, admin, router, identity, source, state_path: str = STATE_PATH):
+        self.admin = admin
+        self.router = router
+        self.source = source
+        self.state_path = state_path
+        self.destination = RNS.Destination(identity, RNS.Destination.IN, RNS.Destination.SINGLE, APP_NAME, ASPECT)
+        self.peers = {}     # lxmf hash -> {"identity", "version", "hops", "heard"}
+        self._sent = {}     # (lxmf hash, version) -> when we last pushed it
+        self._outbox = []   # (lxmf hash, identity, title, payload, method, tries)
+        self._reboot_at = None
+        self._conflicts = set()  # digests of deltas we've already reported as conflicting
+        self._lock = threading.RLock()
+
+        state = {}
+        try:
+            with open(state_path) as fin:
+                state = json.load(fin)
+        except (FileNotFoundError, ValueError):
+            pass
+        self.version = state.get("version", 0)
+        self.log = {}
+        for v, e in state.get("log", {}).items():
+            try:
+                Delta(bytes.fromhex(e))
+                self.log[int(v)] = bytes.fromhex(e)
+            except Exception:
+                pass  # from an older format. Neighbours still on it catch up with a fresh push
+        self.last_status = state.get("last_status")
+
+    def _save(self):
+        log = {str(v): e.hex() for v, e in sorted(self.log.items())[-LOG_SIZE:]}
+        self.log = {int(v): bytes.fromhex(e) for v, e in log.items()}
+        atomic_write(self.state_path, json.dumps({"version": self.version, "log": log,
+                                                  "last_status": self.last_status}).encode())
+
+    def trusted(self, delta: Delta) -> bool:
+        signers = self.admin.config["retcon"].get("config_signers", "")
+        if isinstance(signers, str):
+            signers = signers.split(",")
+        return (delta.signer.hash.hex() in [s.strip() for s in signers]
+                or delta.signer_lxmf_hash.hex() in [a.strip() for a in self.admin.admins])
+
+    # announces
+
+    def announce(self):
+        self.destination.announce(app_data=umsgpack.packb([self.version, self.source.hash]))
+
+    def received_announce(self, destination_hash, announced_identity, app_data):
+        try:
+            version, lxmf_hash = umsgpack.unpackb(app_data)
+        except Exception:
+            return
+        if lxmf_hash == self.source.hash:
+            return
+        with self._lock:
+            self.peers[lxmf_hash] = {"identity": announced_identity, "version": version,
+                                     "hops": RNS.Transport.hops_to(destination_hash), "heard": time.time()}
+
+    # lxmf
+
+    def _send(self, lxmf_hash: bytes, identity, title: str, payload: bytes, method=LXMessage.DIRECT):
+        with self._lock:
+            self._outbox.append((lxmf_hash, identity, title, payload, method, 0))
+
+    def handles(self, message) -> bool:
+        """ True if message was ours (a delta or a status report), so the console shouldn't treat it as a command"""
+        title = message.title_as_string()
+        if title == DELTA_TITLE:
+            self.receive(message.content, message.source_hash)
+            return True
+        return title == STATUS_TITLE  # reports are for the signer's cli. A console has no use for them
+
+    def receive(self, envelope: bytes, from_hash: bytes = None):
+        try:
+            delta = Delta(envelope)
+        except Exception as e:
+            print(f"config sync: dropping delta from {RNS.prettyhexrep(from_hash) if from_hash else '?'}: {e}")
+            return
+        if not self.trusted(delta):
+            print(f"config sync: dropping delta v{delta.version} from untrusted signer {delta.signer.hash.hex()}")
+            return
+        with self._lock:
+            if from_hash is not None and from_hash in self.peers:
+                self.peers[from_hash]["version"] = max(self.peers[from_hash]["version"], delta.base)
+            if delta.version in self.log:
+                if delta_digest(self.log[delta.version]) != delta.digest:
+                    self._conflict(Delta(self.log[delta.version]), delta)
+                return  # already have it. This is what ends the gossip
+            if delta.version <= self.version:
+                return  # older than what we keep a log of
+
+            self.log[delta.version] = envelope
+            self._apply_ready()
+            if delta.version > self.version and delta.version in self.log:
+                self._report(delta, "waiting", f"at v{self.version}, need v{delta.base} first")
+            self._save()
+            self.gossip()
+
+    def _conflict(self, ours: Delta, theirs: Delta):
+        """ theirs claims a version ours already holds, or builds on a delta other than ours. Refuse it loudly"""
+        if theirs.digest in self._conflicts:
+            return
+        self._conflicts.add(theirs.digest)
+        detail = (f"v{theirs.version} conflict: ours {ours.digest.hex()[:8]} by {ours.signer.hash.hex()[:8]}, "
+                  f"refused {theirs.digest.hex()[:8]} by {theirs.signer.hash.hex()[:8]}. Push a fix on top of v{ours.version}")
+        print(f"config sync: {detail}")
+        self._report(ours, "conflict", detail)
+        if theirs.signer.hash != ours.signer.hash:
+            self._report(theirs, "conflict", detail)
+        # pass it on once, so neighbours that took ours notice as well
+        now = time.time()
+        for lxmf_hash, peer in self.peers.items():
+            if peer["hops"] <= NEIGHBOUR_HOPS and now - peer["heard"] <= 6 * 3600:
+                self._send(lxmf_hash, peer["identity"], DELTA_TITLE, theirs.envelope)
+
+    def _apply_ready(self):
+        """ apply every logged delta that follows on from our version"""
+        while self.version + 1 in self.log:
+            delta = Delta(self.log[self.version + 1])
+            if delta.base != self.version:
+                break
+            if self.version in self.log and delta.parent != delta_digest(self.log[self.version]):
+                # built on another v{base} than the one we applied
+                del self.log[delta.version]
+                self._conflict(Delta(self.log[self.version]), delta)
+                break
+            try:
+                apply_delta(self.admin.config, delta.ops)
+                self.admin.write_config()
+            except Exception as e:
+                # a delta that doesn't apply here stays logged for neighbours, but we stop at it
+                self._report(delta, "failed", repr(e))
+                return
+            self.version = delta.version
+            print(f"config sync: applied v{delta.version}, {len(delta.ops)} changes")
+            if delta.restart:
+                self._report(delta, "applied", f"rebooting in {REBOOT_DELAY}s")
+                self._reboot_at = time.time() + REBOOT_DELAY
+            else:
+                self._report(delta, "applied", "takes effect on next restart")
+
+    def _report(self, delta: Delta, status: str, detail: str = ""):
+        self.last_status = {"version": delta.version, "status": status, "detail": detail, "time": time.time()}
+        payload = umsgpack.packb([self.admin.name, self.version, delta.version, status, detail])
+        self._send(delta.signer_lxmf_hash, delta.signer, STATUS_TITLE, payload, LXMessage.OPPORTUNISTIC)
+
+    def gossip(self):
+        """ push missing deltas to direct neighbours that are behind us"""
+        now = time.time()
+        with self._lock:
+            for lxmf_hash, peer in self.peers.items():
+                if peer["hops"] > NEIGHBOUR_HOPS or now - peer["heard"] > 6 * 3600:
+                    continue
+                for version in sorted(v for v in self.log if v > peer["version"]):
+                    if now - self._sent.get((lxmf_hash, version), 0) < RESEND_AFTER:
+                        continue
+                    self._sent[(lxmf_hash, version)] = now
+                    self._send(lxmf_hash, peer["identity"], DELTA_TITLE, self.log[version])
+
+    def tick(self):
+        if self._reboot_at is not None and time.time() > self._reboot_at:
+            self._reboot_at = None
+            self.admin.reboot()
+        self.gossip()
+
+        with self._lock:
+            outbox, self._outbox = self._outbox, []
+        for lxmf_hash, identity, title, payload, method, tries in outbox:
+            if RNS.Transport.has_path(lxmf_hash):
+                destination = RNS.Destination(identity, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+                self.router.handle_outbound(LXMessage(destination, self.source, payload, title, desired_method=method))
+            elif tries < 30:
+                if tries % 10 == 0:
+                    RNS.Transport.request_path(lxmf_hash)
+                with self._lock:
+                    self._outbox.append((lxmf_hash, identity, title, payload, method, tries + 1))
+
+
+def load_signer(path: str = SIGNER_IDENTITY_PATH, create: bool = False):
+    if not os.path.exists(path):
+        if not create:
+            raise FileNotFoundError(f"no signer identity at {path}. Create one with: config_sync.py identity")
+        identity = RNS.Identity(create_keys=True)
+        atomic_write(path, identity.get_private_key(), mode=0o600)
+    return RNS.Identity.from_file(path)
+
+
+if __name__ == "__main__":
+    from configobj import ConfigObj
+
+    dir_path = os.path.dirname(os.path.realpath(__file__)) + "/.."
+    parser = argparse.ArgumentParser(description="push signed config changes to the RETCON fleet")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_identity = sub.add_parser("identity", help="create or show the signer identity")
+    p_identity.add_argument("--identity", default=SIGNER_IDENTITY_PATH)
+    p_diff = sub.add_parser("diff", help="print the delta between two profiles")
+    p_diff.add_argument("old")
+    p_diff.add_argument("new")
+    p_push = sub.add_parser("push", help="sign a delta and hand it to a console to gossip")
+    p_push.add_argument("--identity", default=SIGNER_IDENTITY_PATH)
+    p_push.add_argument("--set", action="append", default=[], metavar="SECTION.KEY=VALUE")
+    p_push.add_argument("--delete", action="append", default=[], metavar="SECTION.KEY")
+    p_push.add_argument("--from-diff", nargs=2, metavar=("OLD", "NEW"), help="push the delta between two profiles")
+    p_push.add_argument("--base", type=int, default=None, help="fleet config version. Default: what this node's console is at")
+    p_push.add_argument("--parent", default=None, help="digest of the v<base> delta, if this node's console doesn't have it")
+    p_push.add_argument("--restart", action="store_true", help="reboot nodes after applying")
+    p_push.add_argument("--to", default=None, help="lxmf address of the console to inject at. Default: this node's")
+    p_push.add_argument("--wait", type=float, default=600, help="seconds to collect apply reports")
+    args = parser.parse_args()
+
+    if args.command == "diff":
+        for op in config_delta(ConfigObj(args.old, interpolation=False), ConfigObj(args.new, interpolation=False)):
+            print(("set " if len(op) == 2 else "del ") + ".".join(op[0]) + (f" = {op[1]}" if len(op) == 2 else ""))
+        sys.exit(0)
+
+    if args.command == "identity":
+        signer = load_signer(args.identity, create=True)
+        print(f"signer identity {signer.hash.hex()}")
+        print(f"add it to [retcon] config_signers, or {RNS.Destination.hash(signer, 'lxmf', 'delivery').hex()} to admins")
+        sys.exit(0)
+
+    from LXMF import LXMRouter
+    ops = [parse_assignment(s) for s in args.set] + [[d.split(".")] for d in args.delete]
+    if args.from_diff:
+        ops += config_delta(ConfigObj(args.from_diff[0], interpolation=False), ConfigObj(args.from_diff[1], interpolation=False))
+    if not ops:
+        parser.error("nothing to push")
+    try:
+        with open(STATE_PATH) as fin:
+            local = json.load(fin)
+    except (FileNotFoundError, ValueError):
+        local = {}
+    base = local.get("version", 0) if args.base is None else args.base
+    if args.parent is not None:
+        parent = bytes.fromhex(args.parent)
+    elif base == 0:
+        parent = b""
+    elif str(base) in local.get("log", {}):
+        parent = delta_digest(bytes.fromhex(local["log"][str(base)]))
+    else:
+        parser.error(f"this node doesn't have v{base}'s delta to build on. Pass its digest with --parent")
+
+    signer = load_signer(args.identity)
+    envelope = sign_delta(signer, base, ops, args.restart, parent)
+    print(f"v{base} -> v{base + 1}: {len(ops)} changes, {len(envelope)} bytes signed, digest {delta_digest(envelope).hex()}")
+
+    reticulum = RNS.Reticulum()
+    router = LXMRouter(storagepath=os.path.expanduser("~/.retcon/config_sync_cli"))
+    source = router.register_delivery_identity(signer, display_name="RETCON config signer")
+    reports = {}
+
+    def on_report(message):
+        if message.title_as_string() != STATUS_TITLE:
+            return
+        node, at, version, status, detail = umsgpack.unpackb(message.content)
+        reports[node] = (at, status, detail)
+        print(f"{node:<24} v{at:<4} {status:<8} {detail}")
+    router.register_delivery_callback(on_report)
+    router.announce(source.hash)
+
+    if args.to:
+        to_hash = bytes.fromhex(args.to)
+        RNS.Transport.request_path(to_hash)
+        deadline = time.time() + 60
+        while RNS.Identity.recall(to_hash) is None and time.time() < deadline:
+            time.sleep(1)
+        console = RNS.Identity.recall(to_hash)
+        if console is None:
+            sys.exit(f"no path to {args.to}")
+    else:
+        console = RNS.Identity.from_file(os.path.join(dir_path, "identity"))  # the local admin console
+    destination = RNS.Destination(console, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+    router.handle_outbound(LXMessage(destination, source, envelope, DELTA_TITLE, desired_method=LXMessage.DIRECT))
+
+    print(f"handed to {RNS.prettyhexrep(destination.hash)}. Waiting {args.wait:.0f}s for reports")
+    try:
+        time.sleep(args.wait)
+    except KeyboardInterrupt:
+        pass
+    applied = sum(1 for at, status, _ in reports.values() if status == "applied")
+    print(f"{applied} applied, {len(reports) - applied} other, of {len(reports)} reporting")
@@ -0,0 +1,328 @@
+"""
+Remote log retrieval over Reticulum.
+
+retcon.py logs to ~/retcon.log (rotated, LOG_FORMAT). The admin console serves those logs on
+retcon.diagnostics, under its own identity, to admins only: the requester identifies on the link,
+and its LXMF address must be in [retcon] admins, or the request must carry the node's password.
+
+    /logs/index  the log files, oldest first: id (inode, survives rotation), name, size, first/last time
+    /logs        one chunk of one file: {id, offset or since, until, length, level, subsystems, keep}
+                 -> {id, offset, next, eof, lines, keep, data (bz2 of the matching lines)}
+
+A chunk covers at most `length` bytes of the file and always ends on a line. A record's continuation
+lines can start the next chunk, so `keep` (whether the record they belong to matched) goes back with
+the next request. Responses bigger than
+a packet go as a Reticulum Resource. The fetcher keeps the next offset of every file it's reading,
+so a fetch that drops out over a bad link picks up where it stopped:
+
+    python utils/diagnostics.py fetch <console lxmf address> --since 2h --level WARNING --out node.log
+    python utils/diagnostics.py fetch <console lxmf address> --subsystem wifi_mesh,qos   # rerun to resume
+"""
+import os
+import re
+import bz2
+import sys
+import json
+import time
+import argparse
+
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
+
+# RNS is imported where it's used. retcon.py imports this for the log settings and doesn't need it
+LOG_PATH = os.path.expanduser("~/retcon.log")
+LOG_FORMAT = "%(asctime)s %(levelname)s %(module)s: %(message)s"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 4
+FETCH_STATE_DIR = os.path.expanduser("~/.retcon/diagnostics_fetch")
+
+APP_NAME = "retcon"
+ASPECT = "diagnostics"
+CHUNK = 64 * 1024
+MAX_CHUNK = 1024 * 1024
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+
+# 2026-10-19 10:21:00,123 INFO wifi_mesh: ...  Lines that don't match continue the record above (tracebacks)
+RECORD = re.compile(rb"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),\d{3} ([A-Z]+) (\S+): ")
+
+
+def _record_time(line: bytes):
+    m = RECORD.match(line)
+    return time.mktime(time.strptime(m.group(1).decode(), "%Y-%m-%d %H:%M:%S")) if m else None
+
+
+def log_segments(path: str = LOG_PATH) -> list:
+    """ the current log and its rotated backups, oldest first"""
+    segments = []
+    for i in range(LOG_BACKUPS, -1, -1):
+        name = f"{path}.{i}" if i else path
+        try:
+            st = os.stat(name)
+            with open(name, "rb") as fin:
+                first = None
+                for line in fin:
+                    first = _record_time(line)
+                    if first is not None:
+                        break
+        except FileNotFoundError:
+            continue
+        segments.append({"id": st.st_ino, "name": os.path.basename(name), "size": st.st_size,
+                         "first": first, "last": st.st_mtime})
+    return segments
+
+
+def _seek_time(fin, size: int, since: float) -> int:
+    """ offset of the first record at or after since, by bisecting on record times"""
+    lo, hi = 0, size
+    while hi - lo > 4096:
+        mid = (lo + hi) // 2
+        fin.seek(mid)
+        fin.readline()  # to the next line start
+        t = None
+        while t is None:
+            pos = fin.tell()
+            line = fin.readline()
+            if not line:
+                break
+            t = _record_time(line)
+        if t is None or t >= since:
+            hi = mid
+        else:
+            lo = pos
+    fin.seek(lo)
+    if lo:
+        fin.readline()
+    while True:
+        pos = fin.tell()
+        line = fin.readline()
+        if not line:
+            return pos
+        t = _record_time(line)
+        if t is not None and t >= since:
+            return pos
+
+
+def read_chunk(path: str, segment_id: int, offset: int = None, since: float = None, until: float = None,
+               length: int = CHUNK, level: str = None, subsystems: list = None, keep: bool = None) -> dict:
+    """ keep: whether the record continuing at offset matched, from the previous chunk's response"""
+    name = next((os.path.join(os.path.dirname(path), s["name"]) for s in log_segments(path) if s["id"] == segment_id), None)
+    if name is None:
+        return {"error": f"log {segment_id} rotated out"}
+    min_level = LEVELS.get((level or "DEBUG").upper(), 10)
+    subsystems = set(s.encode() for s in subsystems) if subsystems else None
+    length = max(1, min(int(length), MAX_CHUNK))
+
+    with open(name, "rb") as fin:
+        size = os.fstat(fin.fileno()).st_size
+        if offset is None:
+            offset = _seek_time(fin, size, since) if since else 0
+        fin.seek(offset)
+        raw = fin.read(length)
+    if len(raw) == length and b"\n" in raw:
+        raw = raw[:raw.rindex(b"\n") + 1]  # whole lines only. The rest comes with the next chunk
+
+    filtered = bool(level) or subsystems is not None
+    keep = bool(keep) or not filtered
+    out, lines, past_until = [], 0, False
+    consumed = 0
+    for line in raw.splitlines(keepends=True):
+        m = RECORD.match(line)
+        if m:
+            t = _record_time(line)
+            if until is not None and t > until:
+                past_until = True
+                break
+            if filtered:
+                keep = (LEVELS.get(m.group(2).decode(), 0) >= min_level and
+                        (subsystems is None or m.group(3) in subsystems))
+            lines += keep
+        if keep:
+            out.append(line)
+        consumed += len(line)
+    end = offset + consumed
+    return {"id": segment_id, "offset": offset, "next": end, "size": size, "lines": lines, "keep": keep,
+            "eof": past_until or end >= size, "past_until": past_until, "data": bz2.compress(b"".join(out))}
+
+
+class DiagnosticsService:
+    """ serves the node's logs on retcon.diagnostics to admins"""
+
+    def __init__(self, admin, identity, log_path: str = LOG_PATH):
+        import RNS
+        self.admin = admin
+        self.log_path = log_path
+        self.destination = RNS.Destination(identity, RNS.Destination.IN, RNS.Destination.SINGLE, APP_NAME, ASPECT)
+        self.destination.register_request_handler("/logs/index", self.index, allow=RNS.Destination.ALLOW_ALL)
+        self.destination.register_request_handler("/logs", self.logs, allow=RNS.Destination.ALLOW_ALL)
+        self.served = 0
+
+    def announce(self):
+        self.destination.announce()
+
+    def _refused(self, data, remote_identity):
+        import RNS
+        if remote_identity is None:
+            return {"error": "identify on the link first"}
+        lxmf_hash = RNS.Destination.hash(remote_identity, "lxmf", "delivery").hex()
+        password = data.get("password") if isinstance(data, dict) else None
+        if not self.admin.is_admin(lxmf_hash, password):
+            print(f"diagnostics: refused {lxmf_hash}, not an admin")
+            return {"error": "not an admin"}
+        return None
+
+    def index(self, path, data, request_id, link_id, remote_identity, requested_at):
+        return self._refused(data, remote_identity) or {"segments": log_segments(self.log_path)}
+
+    def logs(self, path, data, request_id, link_id, remote_identity, requested_at):
+        refused = self._refused(data, remote_identity)
+        if refused:
+            return refused
+        try:
+            chunk = read_chunk(self.log_path, int(data["id"]), data.get("offset"), data.get("since"), data.get("until"),
+                               data.get("length", CHUNK), data.get("level"), data.get("subsystems"), data.get("keep"))
+        except (KeyError, TypeError, ValueError, OSError) as e:
+            return {"error": f"bad request: {e}"}
+        self.served += len(chunk.get("data", b""))
+        return chunk
+
+
+def parse_when(text: str):
+    """ "2h", "30m", "90s", "2026-10-19 10:00" or epoch seconds -> epoch"""
+    if text is None:
+        return None
+    m = re.fullmatch(r"(\d+)([smhd])", text)
+    if m:
+        return time.time() - int(m.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[m.group(2)]
+    if re.fullmatch(r"\d+(\.\d+)?", text):
+        return float(text)
+    return time.mktime(time.strptime(text, "%Y-%m-%d %H:%M"))
+
+
+def _request(link, path: str, data, timeout: float):
+    import RNS
+    receipt = link.request(path, data, timeout=timeout)
+    shown = 0
+    while receipt.get_status() not in (RNS.RequestReceipt.READY, RNS.RequestReceipt.FAILED):
+        if link.status == RNS.Link.CLOSED:
+            break
+        progress = receipt.get_progress() or 0
+        if progress - shown >= 0.1:
+            shown = progress
+            print(f"  {progress:.0%}", end="\r")
+        time.sleep(0.2)
+    if receipt.get_status() != RNS.RequestReceipt.READY:
+        raise ConnectionError(f"{path} failed")
+    response = receipt.get_response()
+    if isinstance(response, dict) and "error" in response:
+        raise PermissionError(response["error"])
+    return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fetch a RETCON node's logs over Reticulum")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_fetch = sub.add_parser("fetch")
+    p_fetch.add_argument("to", help="lxmf address of the node's admin console")
+    p_fetch.add_argument("--since", default=None, help="2h, 30m, 'YYYY-mm-dd HH:MM' or epoch. Default: everything")
+    p_fetch.add_argument("--until", default=None)
+    p_fetch.add_argument("--level", default=None, choices=list(LEVELS))
+    p_fetch.add_argument("--subsystem", default=None, help="comma separated module names, e.g. wifi_mesh,qos")
+    p_fetch.add_argument("--chunk", type=int, default=CHUNK, help="log bytes per request. Smaller for LoRa")
+    p_fetch.add_argument("--identity", default=None, help="identity whose lxmf address is in the node's admins. "
+                                                          "Default: the config signer identity")
+    p_fetch.add_argument("--password", default=None, help="the node's [retcon] password, instead of being an admin")
+    p_fetch.add_argument("--out", default=None, help="default: <to>.log")
+    p_fetch.add_argument("--restart", action="store_true", help="start over instead of resuming")
+    p_fetch.add_argument("--timeout", type=float, default=600, help="seconds per request")
+    args = parser.parse_args()
+
+    import RNS
+    try:
+        from .config_sync import load_signer, SIGNER_IDENTITY_PATH
+    except ImportError:
+        from config_sync import load_signer, SIGNER_IDENTITY_PATH
+
+    out_path = args.out or f"{args.to}.log"
+    asked = [args.since, args.until, args.level, args.subsystem]
+    state_path = os.path.join(FETCH_STATE_DIR, f"{args.to}.json")
+    state = {}
+    if not args.restart:
+        try:
+            with open(state_path) as fin:
+                state = json.load(fin)
+        except (FileNotFoundError, ValueError):
+            pass
+    if state.get("asked") != asked or state.get("out") != out_path:
+        # "2h" is resolved once, so a resumed fetch keeps the range it started with
+        query = {"since": parse_when(args.since), "until": parse_when(args.until), "level": args.level,
+                 "subsystems": args.subsystem.split(",") if args.subsystem else None}
+        state = {"asked": asked, "query": query, "out": out_path, "next": {}, "keep": {}}
+        open(out_path, "wb").close()
+    elif state.get("done"):
+        sys.exit(f"already fetched into {out_path}. --restart to fetch again")
+
+    query = state["query"]
+    identity = RNS.Identity.from_file(args.identity) if args.identity else load_signer(SIGNER_IDENTITY_PATH)
+    reticulum = RNS.Reticulum()
+    to_hash = bytes.fromhex(args.to)
+    RNS.Transport.request_path(to_hash)
+    deadline = time.time() + 60
+    while RNS.Identity.recall(to_hash) is None and time.time() < deadline:
+        time.sleep(1)
+    console = RNS.Identity.recall(to_hash)
+    if console is None:
+        sys.exit(f"no path to {args.to}")
+    destination = RNS.Destination(console, RNS.Destination.OUT, RNS.Destination.SINGLE, APP_NAME, ASPECT)
+    if not RNS.Transport.has_path(destination.hash):
+        RNS.Transport.request_path(destination.hash)
+        while not RNS.Transport.has_path(destination.hash) and time.time() < deadline:
+            time.sleep(1)
+
+    link = RNS.Link(destination)
+    while link.status != RNS.Link.ACTIVE and time.time() < deadline:
+        if link.status == RNS.Link.CLOSED:
+            break
+        time.sleep(0.5)
+    if link.status != RNS.Link.ACTIVE:
+        sys.exit(f"couldn't establish a link to {RNS.prettyhexrep(destination.hash)}")
+    link.identify(identity)
+    auth = {"password": args.password} if args.password else {}
+
+    fetched = 0
+    try:
+        segments = _request(link, "/logs/index", auth, args.timeout)["segments"]
+        for segment in segments:
+            if query["since"] and segment["last"] < query["since"]:
+                continue
+            if query["until"] and segment["first"] and segment["first"] > query["until"]:
+                break
+            if state["next"].get(str(segment["id"]), -1) >= segment["size"]:
+                continue  # read all of it last time
+            while True:
+                offset = state["next"].get(str(segment["id"]))
+                request = dict(auth, id=segment["id"], offset=offset, since=query["since"], until=query["until"],
+                               length=args.chunk, level=query["level"], subsystems=query["subsystems"],
+                               keep=state.setdefault("keep", {}).get(str(segment["id"])))
+                started = time.time()
+                chunk = _request(link, "/logs", request, args.timeout)
+                with open(out_path, "ab") as fout:
+                    fout.write(bz2.decompress(chunk["data"]))
+                state["next"][str(segment["id"])] = chunk["next"]
+                state["keep"][str(segment["id"])] = chunk["keep"]
+                atomic_write(state_path, json.dumps(state).encode())
+                fetched += chunk["next"] - chunk["offset"]
+                print(f"{segment['name']}: {chunk['next']}/{chunk['size']} bytes, {chunk['lines']} lines, "
+                      f"{len(chunk['data'])} bytes over the link in {time.time() - started:.1f}s")
+                if chunk["eof"]:
+                    break
+            if chunk.get("past_until"):
+                break
+        state["done"] = bool(query["until"])  # without an until, a rerun picks up what was logged since
+        atomic_write(state_path, json.dumps(state).encode())
+    except (ConnectionError, PermissionError) as e:
+        link.teardown()
+        sys.exit(f"{e}. {fetched} log bytes fetched into {out_path}. Run again to resume")
+    link.teardown()
+    print(f"done. {fetched} log bytes read into {out_path}")
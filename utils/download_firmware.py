@@ -1,46 +1,230 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# run as a script from utils/ during the image build, but importable as utils.download_firmware too
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
 
 dir_path = os.path.dirname(os.path.realpath(__file__)) + "/.."
 
-def download_latest_release_artifacts(owner, repo):
-    # GitHub API URL for releases
+FIRMWARE_DIR = dir_path + "/artifacts/firmware/"
+MANIFEST_NAME = "manifest.json"
+RELEASE_DATA_NAME = "github_release_data.json"
+
+CHUNK_SIZE = 64 * 1024
+MAX_WORKERS = 4    # bad airport wifi doesn't get faster with more connections
+RETRIES = 4
+TIMEOUT = (15, 60)  # connect, read
+
+_manifest_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    """ a download that went wrong in a way another attempt can fix: short read, bad status, bad hash"""
+
+
+def _sha256_file(path: str, h=None):
+    h = h or hashlib.sha256()
+    with open(path, "rb") as fin:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h
+
+
+def load_manifest(local_path: str) -> dict:
+    """ asset name -> {sha256, size, etag, id, updated_at} for what we already mirrored"""
+    try:
+        with open(os.path.join(local_path, MANIFEST_NAME)) as fin:
+            return json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_manifest(local_path: str, manifest: dict):
+    with _manifest_lock:
+        atomic_write(os.path.join(local_path, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+
+def is_current(local_path: str, asset: dict, entry: dict) -> bool:
+    """ Is the file on disk the same asset github has, and does it still hash to what we recorded?"""
+    path = os.path.join(local_path, asset["name"])
+    if entry is None or not os.path.exists(path):
+        return False
+    if entry.get("id") != asset.get("id") or entry.get("updated_at") != asset.get("updated_at"):
+        return False
+    if os.path.getsize(path) != entry.get("size"):
+        return False
+    return _sha256_file(path).hexdigest() == entry.get("sha256")
+
+
+def download_asset(session: requests.Session, url: str, local_path: str, asset: dict, entry: dict) -> dict:
+    """
+    Stream one asset to disk and return its manifest entry.
+    Downloads go to <name>.part and only get renamed into place once complete and hashed.
+    An interrupted .part is resumed with a Range request if the server still has the same ETag.
+    """
+    name = asset["name"]
+    dest = os.path.join(local_path, name)
+    part = dest + ".part"
+    part_meta = part + ".json"
+
+    headers = {'Accept': 'application/octet-stream'}
+    # we have it, but it might be stale. Let the server tell us with a 304.
+    # Only if it's still what we downloaded, a 304 would keep a corrupted file forever
+    if entry is not None and entry.get("etag") and os.path.exists(dest) \
+            and _sha256_file(dest).hexdigest() == entry.get("sha256"):
+        headers["If-None-Match"] = entry["etag"]
+
+    offset = 0
+    part_etag = None
+    if os.path.exists(part) and os.path.exists(part_meta):
+        with open(part_meta) as fin:
+            part_etag = json.load(fin).get("etag")
+        if part_etag and os.path.getsize(part) > 0:
+            offset = os.path.getsize(part)
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = part_etag
+
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 304:
+            print(f"Unchanged: {name}")
+            return dict(entry, id=asset.get("id"), updated_at=asset.get("updated_at"))
+
+        if response.status_code == 416:
+            # our .part doesn't line up with what the server has anymore. Start over next attempt
+            os.unlink(part)
+            os.unlink(part_meta)
+            raise requests.RequestException(f"Range not satisfiable for {name}")
+
+        if response.status_code == 206 and offset > 0:
+            mode = "ab"
+            h = _sha256_file(part)
+            print(f"Resuming: {name} at {offset} bytes")
+        elif response.status_code == 200:
+            mode, offset, h = "wb", 0, hashlib.sha256()
+        else:
+            raise DownloadError(f"Failed to download {name}: {response.status_code} {response.text[:200]}")
+
+        etag = response.headers.get("ETag")
+        with open(part_meta, "w") as fout:
+            json.dump({"etag": etag}, fout)
+
+        with open(part, mode) as fout:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                fout.write(chunk)
+                h.update(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    size = os.path.getsize(part)
+    expected = asset.get("size")
+    if expected is not None and size != expected:
+        # the .part stays, the next attempt resumes it
+        raise DownloadError(f"Incomplete download of {name}: got {size} of {expected} bytes")
+    # github lists a digest for newer assets. A mismatch means the .part is junk, start over
+    digest = asset.get("digest") or ""
+    if digest.startswith("sha256:") and digest[7:] != h.hexdigest():
+        os.unlink(part)
+        os.unlink(part_meta)
+        raise DownloadError(f"Hash mismatch for {name}: got {h.hexdigest()}, release says {digest[7:]}")
+
+    os.replace(part, dest)
+    os.unlink(part_meta)
+    print(f"Downloaded: {name}")
+    return {"sha256": h.hexdigest(), "size": size, "etag": etag, "id": asset.get("id"), "updated_at": asset.get("updated_at")}
+
+
+def _download_with_retry(session, url, local_path, asset, entry):
+    for attempt in range(RETRIES):
+        try:
+            return download_asset(session, url, local_path, asset, entry)
+        except (DownloadError, requests.RequestException, OSError) as e:
+            # the .part file stays around, so the next attempt picks up where this one stopped
+            wait = 2 ** attempt
+            print(f"Error downloading {asset['name']} ({e}). Retrying in {wait}s")
+            time.sleep(wait)
+    return download_asset(session, url, local_path, asset, entry)
+
+
+def fetch_release(session: requests.Session, owner: str, repo: str, local_path: str):
+    """ Latest release json for a repo. Conditional on the last ETag so a re-run is nearly free"""
     api_url = f"https://api.github.com/repos/{owner}/{repo}/releases/latest"
+    release_path = os.path.join(local_path, RELEASE_DATA_NAME)
+    etag_path = release_path + ".etag"
+
+    headers = {}
+    if os.path.exists(release_path) and os.path.exists(etag_path):
+        with open(etag_path) as fin:
+            headers["If-None-Match"] = fin.read().strip()
 
-    # Get the latest release information
-    response = requests.get(api_url)
+    response = session.get(api_url, headers=headers, timeout=TIMEOUT)
+    if response.status_code == 304:
+        with open(release_path) as fin:
+            return json.load(fin)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch releases: {response.status_code} {response.text}")
 
     release_data = response.json()
+    # save the release data
+    atomic_write(release_path, json.dumps(release_data).encode())
+    if response.headers.get("ETag"):
+        atomic_write(etag_path, response.headers["ETag"].encode())
+    return release_data
 
-    # Create a directory for the artifacts
-    local_path = dir_path + "/artifacts/firmware/" + repo
-    os.makedirs( local_path, exist_ok=True)
 
-    # save the release data
-    with open(os.path.join(local_path, "github_release_data.json"), 'w') as fout:
-            json.dump(release_data, fp=fout)
-                
-    # Download each asset
-    for asset in release_data.get('assets', []):
-        asset_name = asset['name']
-        asset_url = asset['url']
-        browser_download_url = asset.get("browser_download_url", asset_url)
-        download_url = browser_download_url
-
-        # Get the asset content
-        asset_response = requests.get(download_url, headers={'Accept': 'application/octet-stream'})
-        if asset_response.status_code == 200:
-            with open(os.path.join(local_path, asset_name), 'wb') as f:
-                f.write(asset_response.content)
-            print(f"Downloaded: {asset_name}")
-        else:
-            print(f"Failed to download {asset_name}: {asset_response.status_code} {asset_response.text}")
-            
+def mirror_releases(repos: list, max_workers: int = MAX_WORKERS):
+    """ Mirror the latest release assets of every (owner, repo) with one bounded pool of downloads"""
+    session = requests.Session()
+    # requests sessions aren't formally thread safe, but the connection pool is. Size it to the workers
+    session.mount("https://", HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers))
+
+    jobs = []
+    manifests = {}
+    for owner, repo in repos:
+        local_path = FIRMWARE_DIR + repo
+        os.makedirs(local_path, exist_ok=True)
+        release_data = fetch_release(session, owner, repo, local_path)
+        manifest = manifests[local_path] = load_manifest(local_path)
+
+        for asset in release_data.get('assets', []):
+            entry = manifest.get(asset["name"])
+            if is_current(local_path, asset, entry):
+                print(f"Up to date: {asset['name']}")
+                continue
+            url = asset.get("browser_download_url", asset['url'])
+            jobs.append((local_path, asset, entry, url))
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_download_with_retry, session, url, local_path, asset, entry): (local_path, asset)
+                   for local_path, asset, entry, url in jobs}
+        for future in as_completed(futures):
+            local_path, asset = futures[future]
+            try:
+                manifests[local_path][asset["name"]] = future.result()
+                save_manifest(local_path, manifests[local_path])
+            except Exception as e:
+                print(f"Failed to download {asset['name']}: {e}")
+                failures.append(asset["name"])
+    return failures
+
+
+def download_latest_release_artifacts(owner, repo):
+    return mirror_releases([(owner, repo)])
+
 if __name__ == "__main__":
-    download_latest_release_artifacts("markqvist","RNode_Firmware")
-    download_latest_release_artifacts("attermann","microReticulum_Firmware")
-    download_latest_release_artifacts("liberatedsystems","RNode_Firmware_CE")
-    
\ No newline at end of file
+    failed = mirror_releases([
+        ("markqvist", "RNode_Firmware"),
+        ("attermann", "microReticulum_Firmware"),
+        ("liberatedsystems", "RNode_Firmware_CE"),
+    ])
+    if failed:
+        print(f"{len(failed)} assets failed. Run again to resume them: {failed}")
@@ -0,0 +1,273 @@
+"""
+Active link quality probing between mesh hops.
+
+RSSI says nothing about a congested parent or one whose own uplink is broken. Every node in the
+tree backend runs this next to the BackboneInterface on 4242: a small UDP responder on 4243, and a
+prober that measures RTT, loss and a short burst throughput to its parent(s) and children every
+cycle, within a byte budget so probing never eats a meaningful share of the airtime.
+
+Results are smoothed into a per-link table in ~/.retcon/link_quality.json for the UI, the admin
+console and RetconMesh's parent selection to read.
+"""
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
+
+logger = logging.getLogger("retcon")
+
+PROBE_PORT = 4243
+LINK_TABLE_PATH = os.path.expanduser("~/.retcon/link_quality.json")
+
+PROBE_INTERVAL = 60
+PROBE_BUDGET = 64 * 1024    # bytes we may send per cycle, all peers together
+ECHO_COUNT = 10
+ECHO_SPACING = 0.1
+ECHO_TIMEOUT = 1.0
+BURST_BYTES = 32 * 1024
+BURST_PACKET = 1200
+EWMA_ALPHA = 0.3
+
+# what counts as a bad link for parent selection
+BAD_LOSS = 0.3
+BAD_RTT_MS = 500
+BAD_KBPS = 100
+
+MAGIC = b"RLP1"
+HEADER = struct.Struct("!4sBIId")   # magic, type, probe id, seq, sender timestamp
+REPORT = struct.Struct("!IIdd")     # packets, bytes, first arrival, last arrival
+ECHO, ECHO_REPLY, BURST, BURST_QUERY, BURST_REPORT = range(1, 6)
+
+
+def load_link_table(path: str = LINK_TABLE_PATH) -> dict:
+    """ peer ip -> link entry, as last written by the prober"""
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def link_penalty(entry: dict) -> int:
+    """ strength points to take off a parent candidate for a bad measured link"""
+    if entry is None or time.time() - entry.get("updated", 0) > 30 * 60:
+        return 0  # nothing recent enough to hold against it
+    penalty = 0
+    if (entry.get("loss") or 0) > BAD_LOSS:
+        penalty += 30
+    if entry.get("rtt_ms") is not None and entry["rtt_ms"] > BAD_RTT_MS:
+        penalty += 15
+    if entry.get("kbps") is not None and entry["kbps"] < BAD_KBPS:
+        penalty += 15
+    return penalty
+
+
+def dhcp_lease_ips(iface: str) -> list:
+    """ children on one of our APs, from NetworkManager's shared mode dnsmasq leases"""
+    ips = []
+    try:
+        with open(f"/var/lib/NetworkManager/dnsmasq-{iface}.leases") as fin:
+            for line in fin:
+                parts = line.split()
+                # expiry mac ip hostname clientid
+                if len(parts) >= 3 and int(parts[0]) > time.time():
+                    ips.append(parts[2])
+    except (FileNotFoundError, ValueError):
+        pass
+    return ips
+
+
+class LinkTable:
+
+    def __init__(self, path: str = LINK_TABLE_PATH):
+        self.path = path
+        self.links = load_link_table(path)
+
+    def _smooth(self, old, new):
+        if new is None:
+            return old
+        if old is None:
+            return new
+        return (1 - EWMA_ALPHA) * old + EWMA_ALPHA * new
+
+    def update(self, ip: str, role: str, rtt_ms=None, loss=None, kbps=None, label: str = None):
+        entry = self.links.setdefault(ip, {"rtt_ms": None, "loss": None, "kbps": None, "samples": 0})
+        entry.update(role=role, label=label, updated=time.time())
+        entry["rtt_ms"] = self._smooth(entry["rtt_ms"], rtt_ms)
+        entry["loss"] = self._smooth(entry["loss"], loss)
+        entry["kbps"] = self._smooth(entry["kbps"], kbps)
+        entry["samples"] += 1
+
+    def expire(self, keep: set):
+        """ forget peers we aren't linked to anymore"""
+        self.links = {ip: e for ip, e in self.links.items() if ip in keep}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write(self.path, json.dumps(self.links, indent=2, sort_keys=True).encode())
+
+
+class _ProbeProtocol(asyncio.DatagramProtocol):
+    """ one socket is both the responder for other nodes and the sender for our own probes"""
+
+    MAX_BURSTS = 64
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}   # (type, probe id, seq) -> future
+        self.bursts = {}    # (ip, probe id) -> [packets, bytes, first, last]
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < HEADER.size:
+            return
+        magic, kind, probe_id, seq, sent = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            return
+
+        if kind == ECHO:
+            # header only reply. No need to spend the payload's airtime twice
+            self.transport.sendto(HEADER.pack(MAGIC, ECHO_REPLY, probe_id, seq, sent), addr)
+        elif kind == BURST:
+            now = time.time()
+            burst = self.bursts.setdefault((addr[0], probe_id), [0, 0, now, now])
+            burst[0] += 1
+            burst[1] += len(data)
+            burst[3] = now
+            while len(self.bursts) > self.MAX_BURSTS:
+                self.bursts.pop(next(iter(self.bursts)))
+        elif kind == BURST_QUERY:
+            burst = self.bursts.get((addr[0], probe_id), [0, 0, 0, 0])
+            self.transport.sendto(HEADER.pack(MAGIC, BURST_REPORT, probe_id, seq, sent) + REPORT.pack(*burst), addr)
+        elif kind in (ECHO_REPLY, BURST_REPORT):
+            future = self.pending.pop((kind, probe_id, seq), None)
+            if future is not None and not future.done():
+                future.set_result((time.time(), data[HEADER.size:]))
+
+    def expect(self, kind, probe_id, seq) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.pending[(kind, probe_id, seq)] = future
+        return future
+
+
+class LinkProber:
+    """
+    peers() returns [(ip, role, label)] to probe this cycle. role is "parent" or "child".
+    Parents are probed first and always get a burst if the budget allows. Children share what's left
+    """
+
+    def __init__(self, peers, interval: float = PROBE_INTERVAL, budget: int = PROBE_BUDGET,
+                 port: int = PROBE_PORT, table: LinkTable = None):
+        self.peers = peers
+        self.interval = interval
+        self.budget = budget
+        self.port = port
+        self.table = table or LinkTable()
+        self._protocol = None
+        self._probe_id = int(time.time()) & 0xffffffff
+        self._burst_turn = 0  # rotates which children get a burst when the budget is short
+
+    def _next_id(self) -> int:
+        self._probe_id = (self._probe_id + 1) & 0xffffffff
+        return self._probe_id
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        _, self._protocol = await loop.create_datagram_endpoint(_ProbeProtocol, local_addr=("0.0.0.0", self.port))
+
+    async def probe_rtt(self, ip: str, count: int = ECHO_COUNT):
+        """ (mean rtt ms or None, loss fraction)"""
+        probe_id = self._next_id()
+        futures = []
+        for seq in range(count):
+            futures.append((time.time(), self._protocol.expect(ECHO_REPLY, probe_id, seq)))
+            self._protocol.transport.sendto(HEADER.pack(MAGIC, ECHO, probe_id, seq, time.time()), (ip, self.port))
+            await asyncio.sleep(ECHO_SPACING)
+
+        rtts = []
+        for sent, future in futures:
+            try:
+                received, _ = await asyncio.wait_for(future, max(0.01, sent + ECHO_TIMEOUT - time.time()))
+                rtts.append((received - sent) * 1000)
+            except asyncio.TimeoutError:
+                pass
+        for seq in range(count):
+            self._protocol.pending.pop((ECHO_REPLY, probe_id, seq), None)
+        loss = 1 - len(rtts) / count
+        return (sum(rtts) / len(rtts) if rtts else None), loss
+
+    async def probe_burst(self, ip: str, nbytes: int = BURST_BYTES):
+        """ receive side throughput of a back to back burst in kbit/s, or None"""
+        probe_id = self._next_id()
+        padding = b"\0" * (BURST_PACKET - HEADER.size)
+        for seq in range(max(2, nbytes // BURST_PACKET)):
+            self._protocol.transport.sendto(HEADER.pack(MAGIC, BURST, probe_id, seq, time.time()) + padding, (ip, self.port))
+            await asyncio.sleep(0)
+
+        for attempt in range(3):
+            future = self._protocol.expect(BURST_REPORT, probe_id, attempt)
+            self._protocol.transport.sendto(HEADER.pack(MAGIC, BURST_QUERY, probe_id, attempt, time.time()), (ip, self.port))
+            try:
+                _, payload = await asyncio.wait_for(future, ECHO_TIMEOUT)
+            except asyncio.TimeoutError:
+                self._protocol.pending.pop((BURST_REPORT, probe_id, attempt), None)
+                continue
+            packets, received, first, last = REPORT.unpack_from(payload)
+            if packets < 2 or last <= first:
+                return None
+            return received * 8 / (last - first) / 1000
+        return None
+
+    async def run_cycle(self):
+        peers = self.peers()
+        budget = self.budget
+        echo_cost = ECHO_COUNT * HEADER.size * 2
+
+        results = {}
+        for ip, role, label in peers:
+            if budget < echo_cost:
+                break
+            budget -= echo_cost
+            results[ip] = [role, label] + list(await self.probe_rtt(ip)) + [None]
+
+        # bursts are the expensive part. Parents first, then children in rotation
+        parents = [p for p in peers if p[1] == "parent" and p[0] in results]
+        children = [p for p in peers if p[1] != "parent" and p[0] in results]
+        if children:
+            self._burst_turn %= len(children)
+            children = children[self._burst_turn:] + children[:self._burst_turn]
+        for ip, role, label in parents + children:
+            if budget < BURST_BYTES or results[ip][3] == 1.0:
+                continue  # out of budget, or it didn't answer a single echo
+            budget -= BURST_BYTES
+            results[ip][4] = await self.probe_burst(ip)
+            if role != "parent":
+                self._burst_turn += 1
+
+        for ip, (role, label, rtt_ms, loss, kbps) in results.items():
+            self.table.update(ip, role, rtt_ms=rtt_ms, loss=loss, kbps=kbps, label=label)
+        self.table.expire({p[0] for p in peers})
+        self.table.save()
+        logger.debug(f"link probe: {len(results)} peers, {self.budget - budget} bytes")
+
+    async def run(self):
+        await self.start()
+        try:
+            while True:
+                try:
+                    await self.run_cycle()
+                except Exception as e:
+                    logger.error(f"link probe cycle failed: {e!r}")
+                await asyncio.sleep(self.interval)
+        finally:
+            # free the port so a restarted plugin can bind it again
+            self._protocol.transport.close()
@@ -0,0 +1,157 @@
+"""
+LoRa airtime and link budget planning for RNode parameters.
+
+What do frequency/bandwidth/txpower/spreadingfactor/codingrate in a profile actually buy you?
+This works out time on air, bitrate, link budget and how much of the channel a given number of
+nodes announcing at a given rate will eat, and suggests other settings when that's too much.
+
+    python utils/lora_planner.py --profile dc33 --nodes 150
+    python utils/lora_planner.py --sf 9 --bw 125000 --cr 5 --txp 17 --nodes 40 --announce-every 600
+"""
+import math
+import argparse
+from collections import namedtuple
+
+ANNOUNCE_BYTES = 200          # an lxmf delivery announce with display name, including the RNS header
+# admin console (lxmf delivery, config sync, diagnostics, propagation node on transports), meshchat, rnsh
+ANNOUNCERS_PER_NODE = 6
+MAX_CHANNEL_LOAD = 0.10       # past ~10% of airtime in announces alone, real traffic starts colliding badly
+EU868_DUTY_CYCLE = 0.01
+NOISE_FIGURE = 6              # dB, typical sx126x/sx127x front end
+
+# demodulation SNR floor per spreading factor (Semtech datasheets)
+SNR_LIMIT = {5: -2.5, 6: -5, 7: -7.5, 8: -10, 9: -12.5, 10: -15, 11: -17.5, 12: -20}
+BANDWIDTHS = [62500, 125000, 250000, 500000]
+
+LoraParams = namedtuple("LoraParams", ["sf", "bw", "cr", "txpower", "frequency"])
+
+
+def params_from_config(section) -> LoraParams:
+    """ LoraParams from an RNodeInterface or [[[rnode]]] config section"""
+    return LoraParams(int(section["spreadingfactor"]), int(section["bandwidth"]), int(section.get("codingrate", 5)),
+                      int(section.get("txpower", 14)), int(section.get("frequency", 0)))
+
+
+def lora_interfaces(config) -> list:
+    """ (name, LoraParams) for every LoRa radio a retcon profile or rendered reticulum config brings up"""
+    radios = []
+    rnode = config.get("retcon_plugins", {}).get("usb_autodetect", {}).get("rnode", None)
+    if rnode is not None:
+        radios.append(("RnodeUSB", params_from_config(rnode)))
+
+    for name, iface in config.get("interfaces", {}).items():
+        if iface.get("type") == "RNodeInterface" and "spreadingfactor" in iface:
+            radios.append((name, params_from_config(iface)))
+    return radios
+
+
+def airtime(payload_len: int, sf: int, bw: int, cr: int, preamble: int = 8) -> float:
+    """ seconds on air for one packet (Semtech AN1200.13). explicit header, CRC on. cr is 5-8 like RNodeInterface"""
+    t_sym = (2 ** sf) / bw
+    low_dr = 1 if t_sym > 0.016 else 0  # low data rate optimisation kicks in above 16ms symbols
+    n_payload = 8 + max(math.ceil((8 * payload_len - 4 * sf + 28 + 16) / (4 * (sf - 2 * low_dr))) * cr, 0)
+    return (preamble + 4.25) * t_sym + n_payload * t_sym
+
+
+def bitrate(sf: int, bw: int, cr: int) -> float:
+    """ raw bits/s, the same number RNodeInterface reports"""
+    return sf * ((4.0 / cr) / (2 ** sf / bw))
+
+
+def sensitivity(sf: int, bw: int) -> float:
+    """ receiver sensitivity in dBm"""
+    return -174 + 10 * math.log10(bw) + NOISE_FIGURE + SNR_LIMIT[sf]
+
+
+def link_budget(params: LoraParams) -> float:
+    """ dB between tx power and receiver sensitivity. Every 6dB is roughly double the range"""
+    return params.txpower - sensitivity(params.sf, params.bw)
+
+
+def duty_cycle_limit(frequency: int):
+    """ regulatory duty cycle for the band, None if there isn't one"""
+    if 863_000_000 <= frequency <= 870_000_000:
+        return EU868_DUTY_CYCLE
+    return None
+
+
+def plan(params: LoraParams, nodes: int, announce_every: float, announcers: int = ANNOUNCERS_PER_NODE) -> dict:
+    """ what a channel full of nodes with these params looks like"""
+    t_announce = airtime(ANNOUNCE_BYTES, params.sf, params.bw, params.cr)
+    node_duty = announcers * t_announce / announce_every
+    load = nodes * node_duty
+    return {
+        "params": params._asdict(),
+        "airtime_announce": t_announce,
+        "bitrate": bitrate(params.sf, params.bw, params.cr),
+        "link_budget": link_budget(params),
+        "node_duty_cycle": node_duty,
+        "channel_load": load,
+        # how many nodes the channel holds before announces alone go over MAX_CHANNEL_LOAD
+        "max_nodes": int(MAX_CHANNEL_LOAD / node_duty) if node_duty > 0 else None,
+    }
+
+
+def check(params: LoraParams, nodes: int, announce_every: float, announcers: int = ANNOUNCERS_PER_NODE) -> list:
+    """ human readable warnings, empty if the params look fine"""
+    p = plan(params, nodes, announce_every, announcers)
+    warnings = []
+    if p["channel_load"] > MAX_CHANNEL_LOAD:
+        warnings.append(f"{nodes} nodes announcing every {announce_every:.0f}s take {p['channel_load']:.0%} of airtime "
+                        f"on SF{params.sf}/{params.bw // 1000}kHz. Channel holds about {p['max_nodes']} nodes")
+    limit = duty_cycle_limit(params.frequency)
+    if limit is not None and p["node_duty_cycle"] > limit:
+        warnings.append(f"each node transmits {p['node_duty_cycle']:.2%} of the time in announces alone, "
+                        f"over the {limit:.0%} duty cycle limit for {params.frequency / 1e6:.1f}MHz")
+    if p["airtime_announce"] > 2:
+        warnings.append(f"one announce takes {p['airtime_announce']:.1f}s on air")
+    return warnings
+
+
+def suggest(params: LoraParams, nodes: int, announce_every: float, announcers: int = ANNOUNCERS_PER_NODE, count: int = 3) -> list:
+    """ nearby sf/bw settings that fit the channel, longest range first"""
+    options = []
+    for sf in range(7, 13):
+        for bw in BANDWIDTHS:
+            candidate = params._replace(sf=sf, bw=bw)
+            if candidate == params or check(candidate, nodes, announce_every, announcers):
+                continue
+            options.append(plan(candidate, nodes, announce_every, announcers))
+    options.sort(key=lambda p: p["link_budget"], reverse=True)
+    return options[:count]
+
+
+def format_plan(p: dict) -> str:
+    params = p["params"]
+    return (f"SF{params['sf']} BW{params['bw'] // 1000}kHz CR4/{params['cr']} {params['txpower']}dBm: "
+            f"{p['bitrate']:.0f}bps, announce {p['airtime_announce'] * 1000:.0f}ms on air, "
+            f"link budget {p['link_budget']:.1f}dB, channel load {p['channel_load']:.1%}, max nodes {p['max_nodes']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Airtime, capacity and link budget for RNode parameters")
+    parser.add_argument("--profile", default=None, help="read [[usb_autodetect]] [[[rnode]]] from this retcon profile")
+    parser.add_argument("--sf", type=int, default=8)
+    parser.add_argument("--bw", type=int, default=125000)
+    parser.add_argument("--cr", type=int, default=5)
+    parser.add_argument("--txp", type=int, default=14)
+    parser.add_argument("--freq", type=int, default=914875000)
+    parser.add_argument("--nodes", type=int, default=20, help="nodes sharing the channel")
+    parser.add_argument("--announce-every", type=float, default=600, help="seconds between announces per announcer")
+    parser.add_argument("--announcers", type=int, default=ANNOUNCERS_PER_NODE, help="announcing destinations per node")
+    args = parser.parse_args()
+
+    params = LoraParams(args.sf, args.bw, args.cr, args.txp, args.freq)
+    if args.profile is not None:
+        from rns_config_gen import get_recton_config
+        config = get_recton_config(args.profile)
+        params = params_from_config(config["retcon_plugins"]["usb_autodetect"]["rnode"])
+
+    print(format_plan(plan(params, args.nodes, args.announce_every, args.announcers)))
+    warnings = check(params, args.nodes, args.announce_every, args.announcers)
+    for w in warnings:
+        print(f"WARNING: {w}")
+    if warnings:
+        print("Alternatives that fit:")
+        for p in suggest(params, args.nodes, args.announce_every, args.announcers):
+            print("  " + format_plan(p))
@@ -0,0 +1,123 @@
+"""
+Memory use per RETCON component.
+
+Walks /proc, sorts every process into a component by its command line and sums RSS, PSS and swap.
+PSS is the number to watch on a Zero 2W: shared pages (python itself, RNS) are split between the
+processes mapping them, so PSS adds up to what we actually cost and RSS doesn't.
+In the compact run mode the admin console and homepage live in retcon.py and show up as "retcon".
+
+    python utils/memstat.py
+    python utils/memstat.py --watch 10 --json
+"""
+import os
+import json
+import time
+import argparse
+
+# component -> substrings of a command line that belong to it. First match wins
+COMPONENTS = [
+    ("transportd", ["transportd.py"]),
+    ("admin", ["utils/admin.py"]),
+    ("homepage", ["retcon_client_ui.py"]),
+    ("meshchat", ["meshchat.py"]),
+    ("tls_proxy", ["proxy.js"]),
+    ("rnsh", ["rnsh"]),
+    ("retcon", ["retcon.py"]),
+    ("dnsmasq", ["dnsmasq"]),
+    ("wpa_supplicant", ["wpa_supplicant"]),
+]
+
+
+def _cmdline(pid: str) -> str:
+    with open(f"/proc/{pid}/cmdline", "rb") as fin:
+        return fin.read().replace(b"\0", b" ").decode(errors="replace").strip()
+
+
+def _smaps_rollup(pid: str) -> dict:
+    """ Rss/Pss/Swap in kB. Falls back to status (no Pss) on old kernels"""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as fin:
+            for line in fin:
+                parts = line.split()
+                if len(parts) == 3 and parts[0] in ("Rss:", "Pss:", "Swap:"):
+                    values[parts[0][:-1].lower()] = int(parts[1])
+    except FileNotFoundError:
+        with open(f"/proc/{pid}/status") as fin:
+            for line in fin:
+                if line.startswith("VmRSS:"):
+                    values["rss"] = int(line.split()[1])
+                elif line.startswith("VmSwap:"):
+                    values["swap"] = int(line.split()[1])
+    return values
+
+
+def classify(cmdline: str):
+    for component, needles in COMPONENTS:
+        if any(n in cmdline for n in needles):
+            return component
+    return None
+
+
+def component_usage() -> dict:
+    """ component -> {"rss", "pss", "swap" (kB), "pids"}"""
+    usage = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            cmdline = _cmdline(pid)
+            component = classify(cmdline)
+            if component is None:
+                continue
+            # the restart wrappers are "sh -c until python ...; do" loops. Don't count the shell as the app
+            if os.path.basename(cmdline.split()[0]) in ("sh", "bash", "dash"):
+                component = "wrappers"
+            mem = _smaps_rollup(pid)
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue  # gone, or not ours to read
+        entry = usage.setdefault(component, {"rss": 0, "pss": 0, "swap": 0, "pids": []})
+        for key in ("rss", "pss", "swap"):
+            entry[key] += mem.get(key, 0)
+        entry["pids"].append(int(pid))
+    return usage
+
+
+def meminfo() -> dict:
+    values = {}
+    with open("/proc/meminfo") as fin:
+        for line in fin:
+            key, value = line.split(":", 1)
+            values[key] = int(value.split()[0])
+    return {"total": values["MemTotal"], "available": values["MemAvailable"],
+            "swap_used": values.get("SwapTotal", 0) - values.get("SwapFree", 0)}
+
+
+def report() -> dict:
+    return {"time": time.time(), "components": component_usage(), "system": meminfo()}
+
+
+def format_report(r: dict) -> str:
+    lines = [f"{'component':<16}{'pids':>6}{'rss MB':>10}{'pss MB':>10}{'swap MB':>10}"]
+    components = sorted(r["components"].items(), key=lambda kv: kv[1]["pss"], reverse=True)
+    for name, c in components:
+        lines.append(f"{name:<16}{len(c['pids']):>6}{c['rss'] / 1024:>10.1f}{c['pss'] / 1024:>10.1f}{c['swap'] / 1024:>10.1f}")
+    total_pss = sum(c["pss"] for _, c in components)
+    s = r["system"]
+    lines.append(f"{'retcon total':<16}{'':>6}{'':>10}{total_pss / 1024:>10.1f}")
+    lines.append(f"system: {s['available'] / 1024:.0f} of {s['total'] / 1024:.0f} MB available, {s['swap_used'] / 1024:.0f} MB swapped")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RETCON memory use per component")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--watch", type=float, default=None, help="repeat every N seconds")
+    args = parser.parse_args()
+
+    while True:
+        r = report()
+        print(json.dumps(r) if args.json else format_report(r) + "\n")
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
@@ -0,0 +1,304 @@
+"""
+Bench for the wifi mesh backends that runs on a plain linux box. No pis needed.
+
+Every node is a network namespace with mac80211_hwsim virtual radios moved into it.
+Nodes are chained 0 - 1 - 2 ... - N-1 and we measure RTT and throughput from node 0 to
+every hop count, then how long traffic takes to recover when a relay node dies and an
+alternate node (connected to the same neighbors) has to take over.
+
+  tree   : hostapd AP + wpa_supplicant STA per node, each STA pinned to its parent's SSID,
+           static routes up/down the chain. This is the IP equivalent of what the tree backend
+           does with BackboneInterfaces, so treat it as a lower bound for tree mode
+           (it leaves out the scan loop, DHCP and the rnsd restart).
+  batman : open 802.11s mesh point + batman-adv per node. Non neighbors get their peer links
+           blocked so the chain really is multi-hop.
+
+hwsim doesn't model airtime so absolute numbers are optimistic. Compare the two modes
+against each other, not against real hardware.
+
+Needs root, iw, hostapd, wpa_supplicant, batctl, iperf3 and ping.
+
+    sudo python utils/mesh_lab.py --nodes 4 --mode both
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import argparse
+import tempfile
+import subprocess
+
+PSK = "retconlab123"
+FREQ = 2412
+NS_PREFIX = "retconlab"
+
+
+def sh(args, ns=None, check=True, background=False, **kwargs):
+    if ns is not None:
+        args = ["ip", "netns", "exec", ns] + args
+    if background:
+        return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, **kwargs)
+    result = subprocess.run(args, capture_output=True, text=True, **kwargs)
+    if check and result.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed: {result.stderr.strip()}")
+    return result.stdout
+
+
+class Lab:
+
+    def __init__(self, nodes: int, radios_per_node: int):
+        self.n = nodes + 1  # +1 for the alternate relay used in the recovery test
+        self.radios_per_node = radios_per_node
+        self.workdir = tempfile.mkdtemp(prefix="retcon-mesh-lab-")
+        self.procs = []
+        self.ifaces = {}  # node -> [iface names]
+        self.parent_of = {}  # tree mode: node -> current parent
+
+    def ns(self, i):
+        return f"{NS_PREFIX}{i}"
+
+    @property
+    def alt(self):
+        """ the spare node that stands in for node 1 in the recovery test"""
+        return self.n - 1
+
+    def setup(self):
+        sh(["modprobe", "-r", "mac80211_hwsim"], check=False)
+        sh(["modprobe", "mac80211_hwsim", f"radios={self.n * self.radios_per_node}"])
+        time.sleep(1)
+        phys = sorted(
+            (p for p in glob.glob("/sys/class/ieee80211/*") if "hwsim" in os.path.realpath(p)),
+            key=lambda p: int(re.sub(r"\D", "", os.path.basename(p)) or 0))
+
+        for i in range(self.n):
+            sh(["ip", "netns", "add", self.ns(i)], check=False)
+            sh(["ip", "link", "set", "lo", "up"], ns=self.ns(i))
+            self.ifaces[i] = []
+            for phy_path in phys[i * self.radios_per_node:(i + 1) * self.radios_per_node]:
+                iface = os.listdir(os.path.join(phy_path, "device", "net"))[0]
+                sh(["iw", "phy", os.path.basename(phy_path), "set", "netns", "name", self.ns(i)])
+                self.ifaces[i].append(iface)
+
+    def teardown(self):
+        for p in self.procs:
+            p.terminate()
+        for i in range(self.n):
+            sh(["ip", "netns", "del", self.ns(i)], check=False)
+        sh(["modprobe", "-r", "mac80211_hwsim"], check=False)
+
+    def chain_links(self):
+        """ which nodes may talk to each other. A chain, plus the alt node bridging 0 and 2"""
+        links = {(i, i + 1) for i in range(self.alt - 1)}
+        links |= {(0, self.alt), (self.alt, 2)}
+        return links
+
+    # ---- batman mode -----
+    def node_ip(self, i):
+        return f"10.200.0.{i + 1}"
+
+    def up_batman(self):
+        macs = {}
+        for i in range(self.n):
+            iface, ns = self.ifaces[i][0], self.ns(i)
+            sh(["iw", "dev", iface, "interface", "add", "mesh0", "type", "mp"], ns=ns)
+            sh(["ip", "link", "set", "mesh0", "up"], ns=ns)
+            sh(["iw", "dev", "mesh0", "mesh", "join", "retconlab", "freq", str(FREQ)], ns=ns)
+            sh(["batctl", "routing_algo", "BATMAN_V"], ns=ns, check=False)
+            sh(["batctl", "meshif", "bat0", "interface", "add", "mesh0"], ns=ns)
+            sh(["ip", "link", "set", "mesh0", "mtu", "1560"], ns=ns, check=False)
+            sh(["ip", "addr", "add", self.node_ip(i) + "/24", "dev", "bat0"], ns=ns)
+            sh(["ip", "link", "set", "bat0", "up"], ns=ns)
+            macs[i] = sh(["cat", "/sys/class/net/mesh0/address"], ns=ns).strip()
+
+        # every radio hears every other one, so block peer links that aren't in our topology
+        links = self.chain_links()
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            for i in range(self.n):
+                for j in range(self.n):
+                    if i != j and (i, j) not in links and (j, i) not in links:
+                        sh(["iw", "dev", "mesh0", "station", "set", macs[j], "plink_action", "block"],
+                           ns=self.ns(i), check=False)
+            time.sleep(1)
+        # give batman a moment to settle its originator tables
+        time.sleep(5)
+
+    def kill_batman_relay(self, i):
+        sh(["ip", "link", "set", "mesh0", "down"], ns=self.ns(i))
+
+    # ---- tree mode -----
+    def subnet(self, i):
+        return f"10.201.{i}"
+
+    def up_tree(self):
+        hostapd_tpl = ("interface={iface}\ndriver=nl80211\nssid=retconlab-{i}\nhw_mode=g\nchannel=1\n"
+                       "wpa=2\nwpa_passphrase={psk}\nwpa_key_mgmt=WPA-PSK\nrsn_pairwise=CCMP\n")
+        sta_tpl = 'network={{\n ssid="retconlab-{parent}"\n psk="{psk}"\n priority={prio}\n}}\n'
+        parents = self.tree_parents()
+
+        for i in range(self.n):
+            ns = self.ns(i)
+            ap_iface, sta_iface = self.ifaces[i]
+            sh(["sysctl", "-w", "net.ipv4.ip_forward=1"], ns=ns)
+            # AP side: every node hosts its own subnet
+            conf = os.path.join(self.workdir, f"hostapd-{i}.conf")
+            with open(conf, "w") as fout:
+                fout.write(hostapd_tpl.format(iface=ap_iface, i=i, psk=PSK))
+            sh(["ip", "addr", "add", self.subnet(i) + ".1/24", "dev", ap_iface], ns=ns)
+            sh(["ip", "link", "set", ap_iface, "up"], ns=ns)
+            self.procs.append(sh(["hostapd", conf], ns=ns, background=True))
+
+        time.sleep(3)
+        for i, candidates in parents.items():
+            ns = self.ns(i)
+            _, sta_iface = self.ifaces[i]
+            conf = os.path.join(self.workdir, f"wpa-{i}.conf")
+            with open(conf, "w") as fout:
+                fout.write(f"ctrl_interface={self.workdir}/wpa-{i}\n")
+                for prio, parent in enumerate(reversed(candidates)):
+                    fout.write(sta_tpl.format(parent=parent, psk=PSK, prio=prio))
+            sh(["ip", "link", "set", sta_iface, "up"], ns=ns)
+            self.procs.append(sh(["wpa_supplicant", "-i", sta_iface, "-c", conf, "-D", "nl80211"], ns=ns, background=True))
+        time.sleep(5)
+        # parents first so every ancestor already knows its own route up
+        for i in sorted(parents.keys(), key=self.tree_depth):
+            self.set_tree_parent(i, parents[i][0])
+
+    def tree_parents(self):
+        """ child -> parent candidates (preferred first). The alt node is node 2's backup parent"""
+        parents = {i: [i - 1] for i in range(1, self.alt)}
+        parents[self.alt] = [0]
+        if self.alt > 2:
+            parents[2] = [1, self.alt]
+        return parents
+
+    def tree_depth(self, i):
+        depth, parents = 0, self.tree_parents()
+        while i != 0:
+            i, depth = parents[i][0], depth + 1
+        return depth
+
+    def set_tree_parent(self, i, parent):
+        """ address the STA in the parent's subnet and route everything upstream through it"""
+        ns = self.ns(i)
+        _, sta_iface = self.ifaces[i]
+        sh(["ip", "addr", "flush", "dev", sta_iface], ns=ns)
+        sh(["ip", "addr", "add", f"{self.subnet(parent)}.{100 + i}/24", "dev", sta_iface], ns=ns)
+        sh(["ip", "route", "replace", "default", "via", f"{self.subnet(parent)}.1"], ns=ns)
+        self.parent_of[i] = parent
+        # and tell every ancestor how to get back down to us
+        child, ancestor = i, parent
+        while True:
+            sh(["ip", "route", "replace", f"{self.subnet(i)}.0/24", "via", f"{self.subnet(ancestor)}.{100 + child}"],
+               ns=self.ns(ancestor), check=False)
+            if ancestor == 0:
+                break
+            child, ancestor = ancestor, self.parent_of[ancestor]
+
+    def tree_ip(self, i):
+        return self.subnet(i) + ".1"
+
+    def kill_tree_relay(self, i):
+        sh(["ip", "link", "set", self.ifaces[i][0], "down"], ns=self.ns(i))
+
+    # ---- measurements -----
+    def rtt(self, src, dst_ip):
+        out = sh(["ping", "-c", "5", "-i", "0.2", "-q", dst_ip], ns=self.ns(src), check=False)
+        m = re.search(r"= [\d.]+/([\d.]+)/", out)
+        loss = re.search(r"([\d.]+)% packet loss", out)
+        return (float(m.group(1)) if m else None), (float(loss.group(1)) if loss else 100.0)
+
+    def throughput(self, src, dst, dst_ip, seconds=5):
+        server = sh(["iperf3", "-s", "-1"], ns=self.ns(dst), background=True)
+        time.sleep(0.5)
+        out = sh(["iperf3", "-c", dst_ip, "-t", str(seconds), "-J"], ns=self.ns(src), check=False)
+        server.terminate()
+        try:
+            return json.loads(out)["end"]["sum_received"]["bits_per_second"]
+        except (ValueError, KeyError):
+            return None
+
+    def recovery(self, src, dst_ip, fail, timeout=60):
+        """ seconds between the relay dying and pings getting through again"""
+        pinger = sh(["ping", "-D", "-i", "0.1", "-W", "1", dst_ip], ns=self.ns(src), background=True)
+        time.sleep(2)
+        failed_at = time.time()
+        fail()
+        deadline = failed_at + timeout
+        recovered_at = None
+        for line in pinger.stdout:
+            m = re.match(r"\[([\d.]+)\].*bytes from", line)
+            if m and float(m.group(1)) > failed_at + 0.3:
+                recovered_at = float(m.group(1))
+                break
+            if time.time() > deadline:
+                break
+        pinger.terminate()
+        return None if recovered_at is None else recovered_at - failed_at
+
+
+def run_mode(mode: str, nodes: int) -> dict:
+    lab = Lab(nodes, radios_per_node=1 if mode == "batman" else 2)
+    results = {"mode": mode, "hops": []}
+    try:
+        lab.setup()
+        if mode == "batman":
+            lab.up_batman()
+            ip = lab.node_ip
+        else:
+            lab.up_tree()
+            ip = lab.tree_ip
+
+        for dst in range(1, lab.alt):
+            rtt, loss = lab.rtt(0, ip(dst))
+            results["hops"].append({"hops": dst, "rtt_ms": rtt, "loss_pct": loss,
+                                    "throughput_bps": lab.throughput(0, dst, ip(dst))})
+
+        if lab.alt > 2:
+            if mode == "batman":
+                fail = lambda: lab.kill_batman_relay(1)
+            else:
+                def fail():
+                    lab.kill_tree_relay(1)
+                    # the tree has to notice, associate to the backup parent and re-address
+                    deadline = time.time() + 60
+                    while time.time() < deadline:
+                        status = sh(["wpa_cli", "-p", f"{lab.workdir}/wpa-2", "status"], ns=lab.ns(2), check=False)
+                        if f"ssid=retconlab-{lab.alt}" in status and "wpa_state=COMPLETED" in status:
+                            lab.set_tree_parent(2, lab.alt)
+                            return
+                        time.sleep(0.2)
+            results["recovery_s"] = lab.recovery(0, ip(2), fail)
+    finally:
+        lab.teardown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare RETCON wifi mesh backends on mac80211_hwsim radios")
+    parser.add_argument("--nodes", type=int, default=4, help="length of the node chain (>= 3 for the recovery test)")
+    parser.add_argument("--mode", choices=["tree", "batman", "both"], default="both")
+    parser.add_argument("--json", action="store_true", help="print raw json results")
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("mesh_lab needs root for namespaces and hwsim")
+        sys.exit(1)
+
+    modes = ["tree", "batman"] if args.mode == "both" else [args.mode]
+    all_results = [run_mode(m, args.nodes) for m in modes]
+
+    if args.json:
+        print(json.dumps(all_results, indent=2))
+    else:
+        for r in all_results:
+            print(f"== {r['mode']} ==")
+            for h in r["hops"]:
+                bps = h["throughput_bps"]
+                print(f"  {h['hops']} hop(s): rtt={h['rtt_ms']} ms loss={h['loss_pct']}% "
+                      f"throughput={'n/a' if bps is None else f'{bps / 1e6:.1f} Mbit/s'}")
+            if "recovery_s" in r:
+                rec = r["recovery_s"]
+                print(f"  relay failure recovery: {'did not recover' if rec is None else f'{rec:.1f}s'}")
@@ -21,7 +21,7 @@ class MeshchatHandle():
     _tls_proxy_singletone = None
 
     @classmethod
-    def start_meshchat(cls, iface, ssid, retcon_config):
+    def start_meshchat(cls, iface, ssid, retcon_config, homepage=True):
         ip = ni.ifaddresses(iface)[ni.AF_INET][0]['addr']
         logger.info(f"Starting Meshchat on {ip}")
         current_env = os.environ.copy()
@@ -37,11 +37,13 @@ class MeshchatHandle():
         
         time.sleep(2.5)
                 
-        logger.info("starting retcon client homepage")
-        # Also launch the retcon homepage!
-        cls._homepage_singleton = subprocess.Popen(
-            Template(restart_template).render(command=f"authbind --deep python {dir_path}/client_web_ui/retcon_client_ui.py {ssid}"), 
-            shell=True, env=current_env)
+        # in compact mode retcon.py serves the homepage itself
+        if homepage:
+            logger.info("starting retcon client homepage")
+            # Also launch the retcon homepage!
+            cls._homepage_singleton = subprocess.Popen(
+                Template(restart_template).render(command=f"authbind --deep python {dir_path}/client_web_ui/retcon_client_ui.py {ssid}"), 
+                shell=True, env=current_env)
         
         time.sleep(0.25)
         
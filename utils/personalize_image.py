@@ -0,0 +1,239 @@
+"""
+Personalize a built retcon.img per node without rebuilding it.
+
+build_retcon.sh produces one base image. This takes that image and, for every node in a
+nodes file, makes a copy (reflinked where the filesystem supports it, so the shared blocks
+aren't duplicated) or writes it to an sd card, then mounts the rootfs through a loop device and
+drops in the node's active profile, hostname and optionally its reticulum identity.
+
+nodes file (configobj, one section per node):
+
+    [transport-01]
+      profile = dc33             # retcon_profiles/<profile>.config
+      hostname = retcon-t01
+      identity = generate        # or a path to an existing identity file. Omit to create one on first boot
+      device = /dev/sdb          # optional. Write straight to this card instead of <out>/<node>.img
+      [[overrides]]              # merged on top of the profile
+        [[[retcon]]]
+          name = Transport 01
+
+Needs root for losetup and mount.
+
+    sudo venv/bin/python utils/personalize_image.py retcon.img nodes.config --out ~/fleet --jobs 8
+
+--out must be outside the repo. The images hold private keys and the repo gets served and copied around.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import RNS
+from configobj import ConfigObj
+
+# works both as utils.personalize_image and as a script from utils/
+try:
+    from .rns_config_gen import get_recton_config, dir_path
+except ImportError:
+    from rns_config_gen import get_recton_config, dir_path
+
+ROOTFS_PART = 2  # mbr/simple_dual: p1 boot, p2 root
+DEFAULT_USER = "retcon"
+COPY_BLOCK = 4 * 1024 * 1024
+
+
+def run_cmd(*args, check=True) -> str:
+    """ Run a command without a shell and return stdout"""
+    if os.geteuid() != 0:
+        args = ("sudo", "-n") + args
+    proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if check and proc.returncode != 0:
+        raise RuntimeError(f"{' '.join(args)} failed ({proc.returncode}): {proc.stderr.strip()}")
+    return proc.stdout
+
+
+def image_user() -> str:
+    """ the user the image was built for, from retcon.options"""
+    options = ConfigObj(os.path.join(dir_path, "retcon_pi", "retcon.options"))
+    return options.get("device_user1", DEFAULT_USER)
+
+
+def node_profile(node: dict) -> ConfigObj:
+    """ the node's profile with its overrides merged on top"""
+    profile = get_recton_config(node.get("profile", "default"))
+    profile.merge(node.get("overrides", {}))
+    return profile
+
+
+def copy_image(base: str, dest: str):
+    """ copy-on-write copy where the filesystem supports it (btrfs, xfs), sparse copy otherwise"""
+    subprocess.run(["cp", "--reflink=auto", "--sparse=always", base, dest], check=True)
+
+
+def write_device(base: str, device: str):
+    """ stream the base image onto a block device"""
+    with open(base, "rb") as fin, open(device, "wb") as fout:
+        while chunk := fin.read(COPY_BLOCK):
+            fout.write(chunk)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
+class MountedRootfs:
+    """ loop attach an image (or card) and mount its rootfs for the duration of a with block"""
+
+    def __init__(self, target: str):
+        self.target = target
+        self.loop = None
+        self.mountpoint = None
+
+    def __enter__(self) -> str:
+        self.loop = run_cmd("losetup", "--find", "--show", "--partscan", self.target).strip()
+        try:
+            # partition nodes can show up a moment after losetup returns
+            part = f"{self.loop}p{ROOTFS_PART}"
+            for _ in range(50):
+                if os.path.exists(part):
+                    break
+                time.sleep(0.1)
+            self.mountpoint = tempfile.mkdtemp(prefix="retcon-rootfs-")
+            run_cmd("mount", part, self.mountpoint)
+        except Exception:
+            self.__exit__()
+            raise
+        return self.mountpoint
+
+    def __exit__(self, *args):
+        if self.mountpoint is not None:
+            run_cmd("umount", self.mountpoint, check=False)
+            os.rmdir(self.mountpoint)
+        if self.loop is not None:
+            run_cmd("losetup", "--detach", self.loop, check=False)
+
+
+def _owner(rootfs: str, user: str) -> tuple:
+    """ uid/gid of user inside the image. It won't match the build host"""
+    with open(os.path.join(rootfs, "etc", "passwd")) as fin:
+        for line in fin:
+            fields = line.split(":")
+            if fields[0] == user:
+                return int(fields[2]), int(fields[3])
+    raise KeyError(f"user {user} not in image")
+
+
+def _install(rootfs: str, path: str, data: bytes, owner: tuple = None, mode: int = 0o644):
+    full = os.path.join(rootfs, path.lstrip("/"))
+    with open(full, "wb") as fout:
+        fout.write(data)
+    os.chmod(full, mode)
+    if owner is not None:
+        os.chown(full, *owner)
+
+
+def personalize_rootfs(rootfs: str, name: str, node: dict, user: str) -> dict:
+    """ drop the node's profile, hostname and identity into a mounted rootfs. Returns what was done"""
+    owner = _owner(rootfs, user)
+    retcon_dir = f"/home/{user}/retcon"
+    result = {"node": name}
+
+    profile = node_profile(node)
+    buf = BytesIO()
+    profile.write(buf)
+    _install(rootfs, f"{retcon_dir}/retcon_profiles/active", buf.getvalue(), owner)
+    result["profile"] = node.get("profile", "default")
+
+    hostname = node.get("hostname")
+    if hostname:
+        _install(rootfs, "/etc/hostname", f"{hostname}\n".encode())
+        with open(os.path.join(rootfs, "etc", "hosts")) as fin:
+            hosts = [line for line in fin.read().splitlines() if not line.startswith("127.0.1.1")]
+        hosts.append(f"127.0.1.1\t{hostname}")
+        _install(rootfs, "/etc/hosts", ("\n".join(hosts) + "\n").encode(), mode=0o666)  # retcon rewrites it at runtime
+        result["hostname"] = hostname
+
+    identity_src = node.get("identity")
+    if identity_src:
+        if identity_src == "generate":
+            identity = RNS.Identity(create_keys=True)
+        else:
+            identity = RNS.Identity.from_file(identity_src)
+        # same place admin.py looks for it
+        _install(rootfs, f"{retcon_dir}/identity", identity.get_private_key(), owner, mode=0o600)
+        result["identity"] = identity.hash.hex()
+
+    return result
+
+
+def personalize_node(base: str, name: str, node: dict, out_dir: str, user: str) -> dict:
+    start = time.time()
+    device = node.get("device")
+    if device:
+        write_device(base, device)
+        target = device
+    else:
+        target = os.path.join(out_dir, f"{name}.img")
+        copy_image(base, target)
+
+    with MountedRootfs(target) as rootfs:
+        result = personalize_rootfs(rootfs, name, node, user)
+    run_cmd("sync")
+
+    result["target"] = target
+    result["seconds"] = round(time.time() - start, 1)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make per-node RETCON images from one base image")
+    parser.add_argument("base", help="base retcon.img from build_retcon.sh")
+    parser.add_argument("nodes", help="nodes file. One section per node")
+    parser.add_argument("--out", required=True, help="where node images go. Not inside the repo")
+    parser.add_argument("--only", action="append", help="only these nodes. Repeatable")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="nodes to work on at once")
+    parser.add_argument("--user", default=None, help="image user (default: device_user1 from retcon.options)")
+    args = parser.parse_args()
+
+    # images hold each node's identity and psk. The repo's artifacts/ is served to every attendee and
+    # the whole repo is copied into the next base image, so they must not end up anywhere in it
+    out = os.path.realpath(args.out)
+    if os.path.commonpath([out, os.path.realpath(dir_path)]) == os.path.realpath(dir_path):
+        print(f"--out {args.out} is inside the retcon repo. Node images hold private keys, put them somewhere else")
+        sys.exit(1)
+
+    nodes = ConfigObj(args.nodes, interpolation=False)
+    names = [n for n in nodes.sections if args.only is None or n in args.only]
+    user = args.user or image_user()
+    os.makedirs(args.out, exist_ok=True)
+
+    # cards are written in parallel too, but never hand the same device to two jobs
+    devices = [nodes[n]["device"] for n in names if nodes[n].get("device")]
+    if len(devices) != len(set(devices)):
+        print("The same device is listed for more than one node")
+        sys.exit(1)
+
+    results, failed = [], []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(personalize_node, args.base, n, nodes[n], args.out, user): n for n in names}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+                results.append(result)
+                print(f"{name}: {result['target']} in {result['seconds']}s")
+            except Exception as e:
+                print(f"{name}: FAILED {e}")
+                failed.append(name)
+
+    # identity hashes are what the admin list and rnsh allow lists need, so keep them with the images
+    with open(os.path.join(args.out, "manifest.json"), "w") as fout:
+        json.dump(sorted(results, key=lambda r: r["node"]), fout, indent=2)
+    shutil.copy(args.nodes, os.path.join(args.out, "nodes.config"))
+
+    print(f"{len(results)} ok, {len(failed)} failed")
+    sys.exit(1 if failed else 0)
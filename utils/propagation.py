@@ -0,0 +1,143 @@
+"""
+Bounded LXMF propagation node for transport nodes.
+
+With [retcon] [[propagation]] enabled, a transport node's admin console also stores and forwards
+LXMF messages for attendees whose devices are offline, so they sync from the node next to them
+instead of every retry crossing the LoRa backbone. An SD card and a few hundred MB of RAM aren't a
+server, so on top of what LXMF does:
+
+    - quota_mb caps the store. LXMF culls past it by age x size (big old messages go first)
+    - max_age_hours evicts anything older, long before LXMF's own 30 day expiry
+    - clients listing their messages hit an index by destination, not a scan of the whole store
+    - hit rate, served messages and evictions are written to ~/.retcon/propagation_stats.json
+
+    [[propagation]]
+      enabled = true
+      quota_mb = 200
+      max_age_hours = 72
+"""
+import os
+import json
+import time
+
+import RNS
+from LXMF import LXMRouter, APP_NAME
+from LXMF.LXMPeer import LXMPeer
+
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
+
+STATS_PATH = os.path.expanduser("~/.retcon/propagation_stats.json")
+QUOTA_MB = 200
+MAX_AGE_HOURS = 72
+
+
+class RetconLXMRouter(LXMRouter):
+    """ an LXMRouter whose propagation store is bounded, indexed and counted. Plain LXMRouter otherwise"""
+
+    def __init__(self, *args, max_age: float = None, **kwargs):
+        self.max_age = max_age
+        self.by_destination = {}  # destination hash -> set of transient ids
+        self.counters = {"list_requests": 0, "list_hits": 0, "messages_listed": 0,
+                         "evicted_age": 0, "evicted_quota": 0, "evicted_bytes": 0}
+        super().__init__(*args, **kwargs)
+
+    def reindex(self):
+        index = {}
+        for transient_id, entry in list(self.propagation_entries.items()):
+            index.setdefault(entry[0], set()).add(transient_id)
+        self.by_destination = index
+
+    def enable_propagation(self):
+        super().enable_propagation()
+        self.reindex()
+
+    def lxmf_propagation(self, lxmf_data, *args, **kwargs):
+        result = super().lxmf_propagation(lxmf_data, *args, **kwargs)
+        if self.propagation_node and len(lxmf_data) >= RNS.Identity.HASHLENGTH // 8:
+            transient_id = RNS.Identity.full_hash(lxmf_data)
+            entry = self.propagation_entries.get(transient_id)
+            if entry is not None:
+                self.by_destination.setdefault(entry[0], set()).add(transient_id)
+        return result
+
+    def clean_message_store(self):
+        before = len(self.propagation_entries), self.message_storage_size() or 0
+
+        if self.max_age is not None:
+            cutoff = time.time() - self.max_age
+            for transient_id, entry in list(self.propagation_entries.items()):
+                if entry[2] < cutoff:
+                    self.propagation_entries.pop(transient_id, None)
+                    try:
+                        os.unlink(entry[1])
+                    except FileNotFoundError:
+                        pass
+                    self.counters["evicted_age"] += 1
+        after_age = len(self.propagation_entries)
+
+        super().clean_message_store()  # LXMF's own expiry, and the quota by weight
+        self.counters["evicted_quota"] += after_age - len(self.propagation_entries)
+        self.counters["evicted_bytes"] += before[1] - (self.message_storage_size() or 0)
+        self.reindex()
+
+    def message_get_request(self, path, data, request_id, remote_identity, requested_at):
+        # listing is what every client sync starts with. LXMF scans the whole store for it
+        if remote_identity is None or data is None or data[0] is not None or data[1] is not None:
+            return super().message_get_request(path, data, request_id, remote_identity, requested_at)
+        if not self.identity_allowed(remote_identity):
+            return LXMPeer.ERROR_NO_ACCESS
+
+        destination_hash = RNS.Destination.hash(remote_identity, APP_NAME, "delivery")
+        available = []
+        for transient_id in list(self.by_destination.get(destination_hash, ())):
+            entry = self.propagation_entries.get(transient_id)
+            if entry is None:
+                self.by_destination[destination_hash].discard(transient_id)  # purged since we indexed it
+                continue
+            available.append((entry[3], transient_id))
+        available.sort()
+
+        self.counters["list_requests"] += 1
+        self.counters["list_hits"] += 1 if available else 0
+        self.counters["messages_listed"] += len(available)
+        return [transient_id for _, transient_id in available]
+
+    def propagation_stats(self) -> dict:
+        size = self.message_storage_size() or 0
+        requests = self.counters["list_requests"]
+        return dict(self.counters, **{
+            "time": time.time(),
+            "enabled": self.propagation_node,
+            "messages": len(self.propagation_entries) if self.propagation_node else 0,
+            "destinations": sum(1 for ids in self.by_destination.values() if ids),
+            "bytes": size,
+            "limit": self.message_storage_limit,
+            "usage": size / self.message_storage_limit if self.message_storage_limit else None,
+            "max_age": self.max_age,
+            "hit_rate": self.counters["list_hits"] / requests if requests else None,
+            "messages_served": self.client_propagation_messages_served,
+            "messages_received": self.client_propagation_messages_received,
+        })
+
+    def save_propagation_stats(self, path: str = STATS_PATH):
+        atomic_write(path, json.dumps(self.propagation_stats(), indent=2).encode())
+
+
+def propagation_config(config) -> dict:
+    """ the [retcon] [[propagation]] section, or None if this node shouldn't be a propagation node"""
+    section = config["retcon"].get("propagation", {})
+    if config["retcon"].get("mode") != "transport" or str(section.get("enabled", "false")).lower() not in ("true", "yes", "1"):
+        return None
+    return {"quota_mb": float(section.get("quota_mb", QUOTA_MB)),
+            "max_age": float(section.get("max_age_hours", MAX_AGE_HOURS)) * 3600}
+
+
+def load_propagation_stats(path: str = STATS_PATH) -> dict:
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return {}
@@ -0,0 +1,331 @@
+"""
+Bulk RNode provisioning station.
+
+Flashes every attached RNode at once from the firmware download_firmware.py already
+mirrored into artifacts/firmware/, sets it up for a RETCON profile and writes a report.
+
+Flashing is done by rnodeconf pointed at a tiny local HTTP server that serves the mirror,
+so nothing here needs internet access.
+
+    python utils/provision_rnodes.py --profile dc33
+    python utils/provision_rnodes.py --port /dev/ttyACM0 --port /dev/ttyACM1 --skip-flash
+
+--port and --rnodeconf also take pseudo-ttys and a stand-in script, to dry run a batch without radios.
+
+rnodeconf --update only works on boards that already run RNode firmware with a valid EEPROM.
+Boards with the firmware but no EEPROM get one written first when --board says what they are.
+Factory fresh boards have no firmware answering at all. Those are refused, with a pointer to
+rnodeconf --autoinstall, which asks for the model and band interactively.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import functools
+import threading
+import subprocess
+import http.server
+from concurrent.futures import ThreadPoolExecutor
+
+# works both as utils.provision_rnodes and as a script from utils/
+try:
+    from .rns_config_gen import get_recton_config, dir_path
+except ImportError:
+    from rns_config_gen import get_recton_config, dir_path
+
+FIRMWARE_REPO = "RNode_Firmware"
+REPORT_DIR = dir_path + "/artifacts/provisioning/"
+
+# usb vid:pid of the usb-serial bridges and native usb boards RNodes show up as
+RNODE_USB_IDS = {
+    (0x10c4, 0xea60),  # CP210x (lilygo t-beam, heltec v2 ...)
+    (0x1a86, 0x7523),  # CH340
+    (0x1a86, 0x55d4),  # CH9102 (t3s3, t-beam supreme)
+    (0x303a, 0x1001),  # esp32-s3 native usb
+    (0x239a, 0x8029),  # rak4631 (nrf52)
+    (0x0403, 0x6001),  # FTDI
+}
+
+# boards we can bootstrap (write a fresh EEPROM on) without rnodeconf's interactive autoinstall:
+# name -> (platform, product, [(low hz, high hz, model)]). The model depends on the band, we pick it from the profile frequency
+BOARDS = {
+    "t3s3": ("80", "03", [(410000000, 525000000, "a1"), (820000000, 1020000000, "a6")]),
+    "lora32_v21": ("80", "b1", [(420000000, 520000000, "b4"), (850000000, 950000000, "b9")]),
+    "heltec_v3": ("80", "c1", [(420000000, 520000000, "c5"), (850000000, 950000000, "ca")]),
+    "tbeam": ("80", "e0", [(420000000, 520000000, "e4"), (850000000, 950000000, "e9")]),
+    "tbeam_supreme": ("80", "ea", [(420000000, 520000000, "db"), (850000000, 950000000, "dc")]),
+    "rak4631": ("70", "10", [(430000000, 510000000, "11"), (779000000, 928000000, "12")]),
+}
+
+# what rnodeconf --info says about a board that isn't a working RNode yet
+PROVISIONED, UNPROVISIONED, BLANK = "provisioned", "unprovisioned", "blank"
+_UNPROVISIONED_MARKERS = ("EEPROM is invalid", "has not been initialised", "not provisioned", "has not been provisioned")
+_BLANK_MARKERS = ("RNode did not respond", "No answer from device", "Could not detect a connected RNode")
+
+
+def board_state(info: str) -> str:
+    """ provisioned, unprovisioned (RNode firmware but no valid EEPROM) or blank (no RNode firmware answering)"""
+    if any(m in info for m in _BLANK_MARKERS):
+        return BLANK
+    if any(m in info for m in _UNPROVISIONED_MARKERS):
+        return UNPROVISIONED
+    return PROVISIONED
+
+
+def bootstrap_args(board: str, frequency: int) -> list:
+    """ rnodeconf args that write a fresh EEPROM for board, with the model for the band frequency is in"""
+    if board not in BOARDS:
+        raise ValueError(f"Unknown board {board}. Known: {', '.join(sorted(BOARDS))}")
+    platform, product, bands = BOARDS[board]
+    for low, high, model in bands:
+        if low <= int(frequency) <= high:
+            return ["--rom", "--platform", platform, "--product", product, "--model", model, "--hwrev", "1"]
+    raise ValueError(f"{board} has no model for {int(frequency) / 1e6:.3f} MHz")
+
+
+def detect_ports() -> list:
+    """ every attached serial port that looks like it could be an RNode"""
+    from serial.tools import list_ports  # only needed for autodetect, explicit --port lists work without pyserial
+    return [p for p in list_ports.comports() if (p.vid, p.pid) in RNODE_USB_IDS]
+
+
+def firmware_release(repo: str = FIRMWARE_REPO) -> dict:
+    """ the release data download_firmware.py saved next to the mirrored firmware"""
+    with open(os.path.join(dir_path, "artifacts", "firmware", repo, "github_release_data.json")) as fin:
+        return json.load(fin)
+
+
+def rnode_params(profile) -> dict:
+    """ radio parameters from the profile's [[usb_autodetect]] [[[rnode]]] section"""
+    config = get_recton_config(profile)
+    return dict(config.get("retcon_plugins", {}).get("usb_autodetect", {}).get("rnode", {}))
+
+
+class FirmwareServer:
+    """
+    Serve artifacts/firmware/<repo>/ as <tag>/<filename> on localhost, the same layout as github
+    release downloads, so rnodeconf --fw-url can flash straight from the mirror.
+    """
+
+    def __init__(self, repo: str, tag: str):
+        self.root = os.path.join(dir_path, "artifacts", "firmware", repo)
+        self.tag = tag
+        handler = functools.partial(self._Handler, directory=self.root, tag=tag)
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+
+    class _Handler(http.server.SimpleHTTPRequestHandler):
+        def __init__(self, *args, tag=None, **kwargs):
+            self.tag = tag
+            super().__init__(*args, **kwargs)
+
+        def translate_path(self, path):
+            # strip the /<tag>/ prefix rnodeconf asks for
+            prefix = f"/{self.tag}/"
+            return super().translate_path("/" + path[len(prefix):] if path.startswith(prefix) else path)
+
+        def log_message(self, *args):
+            pass
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_port}/"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+
+
+class RadioJob:
+    """ provisioning state for one port"""
+
+    def __init__(self, port: str, serial_number: str = None):
+        self.port = port
+        self.serial_number = serial_number
+        self.step = "queued"
+        self.status = "pending"
+        self.last_line = ""
+        self.firmware_version = None
+        self.steps = {}  # step -> {"ok", "seconds", "output"}
+
+    def as_dict(self) -> dict:
+        return {
+            "port": self.port,
+            "usb_serial": self.serial_number,
+            "status": self.status,
+            "firmware_version": self.firmware_version,
+            "steps": self.steps,
+        }
+
+
+class Provisioner:
+
+    def __init__(self, rnodeconf: str, params: dict, tag: str, fw_url: str = None, tnc: bool = False,
+                 skip_flash: bool = False, step_timeout: float = 600, board: str = None):
+        self.rnodeconf = rnodeconf
+        self.board = board  # what unprovisioned boards get bootstrapped as. None = refuse them
+        self.params = params
+        self.tag = tag
+        self.fw_url = fw_url
+        self.tnc = tnc
+        self.skip_flash = skip_flash
+        self.step_timeout = step_timeout
+
+    def _run(self, job: RadioJob, step: str, args: list) -> str:
+        job.step = step
+        start = time.time()
+        proc = subprocess.Popen([self.rnodeconf, job.port] + args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        # rnodeconf sometimes waits for enter. Never block a batch on someone pressing it
+        proc.stdin.write("\n" * 10)
+        proc.stdin.close()
+
+        timer = threading.Timer(self.step_timeout, proc.kill)
+        timer.start()
+        output = []
+        try:
+            for line in proc.stdout:
+                line = line.strip()
+                if line:
+                    output.append(line)
+                    job.last_line = line
+            proc.wait()
+        finally:
+            timer.cancel()
+
+        ok = proc.returncode == 0
+        job.steps[step] = {"ok": ok, "seconds": round(time.time() - start, 1), "output": output[-20:]}
+        if not ok:
+            raise RuntimeError(f"{step} failed on {job.port}: {job.last_line}")
+        return "\n".join(output)
+
+    @staticmethod
+    def _parse_version(info: str):
+        m = re.search(r"Firmware version\s*:?\s*([\d.]+)", info)
+        return m.group(1) if m else None
+
+    def provision(self, job: RadioJob) -> RadioJob:
+        job.status = "running"
+        try:
+            state = board_state(self._run(job, "probe", ["--info"]))
+            if state == BLANK:
+                # flashing a board from nothing needs the model and band picked in rnodeconf's interactive installer
+                raise RuntimeError(f"no RNode firmware answering on {job.port}. Install it once with "
+                                   f"'rnodeconf {job.port} --autoinstall', then run this again")
+            if state == UNPROVISIONED:
+                # rnodeconf --update refuses boards without a valid EEPROM
+                if self.board is None:
+                    raise RuntimeError(f"{job.port} runs RNode firmware but isn't provisioned. Run again with "
+                                       f"--board ({', '.join(sorted(BOARDS))}) or use 'rnodeconf {job.port} --autoinstall'")
+                self._run(job, "bootstrap", bootstrap_args(self.board, self.params["frequency"]))
+                if board_state(self._run(job, "probe", ["--info"])) != PROVISIONED:
+                    raise RuntimeError(f"{job.port} still isn't provisioned after bootstrapping it as {self.board}")
+
+            if not self.skip_flash:
+                args = ["--update", "--fw-version", self.tag, "--nocheck"]
+                if self.fw_url is not None:
+                    args += ["--fw-url", self.fw_url]
+                self._run(job, "flash", args)
+
+            if self.tnc:
+                # standalone TNC mode with the profile's radio settings
+                p = self.params
+                self._run(job, "configure", ["--tnc", "--freq", str(p["frequency"]), "--bw", str(p["bandwidth"]),
+                                             "--txp", str(p["txpower"]), "--sf", str(p["spreadingfactor"]),
+                                             "--cr", str(p["codingrate"])])
+            else:
+                # RETCON drives the radio from RNodeInterface, so make sure it's in normal (host controlled) mode
+                self._run(job, "configure", ["--normal"])
+
+            info = self._run(job, "verify", ["--info"])
+            job.firmware_version = self._parse_version(info)
+            expected = self.tag.lstrip("v")
+            if not self.skip_flash and job.firmware_version is not None and job.firmware_version != expected:
+                raise RuntimeError(f"{job.port} reports firmware {job.firmware_version}, expected {expected}")
+            job.status = "ok"
+        except Exception as e:
+            job.status = "failed"
+            job.last_line = str(e)
+        job.step = "done"
+        return job
+
+
+def print_progress(jobs: list, stop: threading.Event, interval: float = 1.0):
+    """ one line per port, redrawn in place on a terminal"""
+    tty = sys.stdout.isatty()
+    last = None
+    while True:
+        lines = [f"{j.port:<16} {j.status:<8} {j.step:<10} {j.last_line[:60]}" for j in jobs]
+        if tty:
+            if last is not None:
+                sys.stdout.write(f"\x1b[{len(last)}F")
+            sys.stdout.write("\n".join(f"{line}\x1b[K" for line in lines) + "\n")
+            sys.stdout.flush()
+        elif lines != last:
+            print("\n".join(line for line, old in zip(lines, last or [None] * len(lines)) if line != old))
+        last = lines
+        if stop.is_set():
+            return
+        stop.wait(interval)
+
+
+def write_report(jobs: list, params: dict, tag: str) -> str:
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    path = os.path.join(REPORT_DIR, time.strftime("report-%Y%m%d-%H%M%S.json"))
+    with open(path, "w") as fout:
+        json.dump({
+            "time": time.time(),
+            "firmware_tag": tag,
+            "rnode_params": params,
+            "ok": sum(1 for j in jobs if j.status == "ok"),
+            "failed": sum(1 for j in jobs if j.status != "ok"),
+            "radios": [j.as_dict() for j in jobs],
+        }, fout, indent=2)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flash and configure many RNodes in parallel")
+    parser.add_argument("--profile", default=None, help="retcon profile to take radio params from (default: active)")
+    parser.add_argument("--port", action="append", help="port to provision. Repeatable. Default: autodetect")
+    parser.add_argument("--jobs", type=int, default=0, help="radios to work on at once (default: all)")
+    parser.add_argument("--rnodeconf", default="rnodeconf", help="rnodeconf executable")
+    parser.add_argument("--skip-flash", action="store_true", help="only configure and verify")
+    parser.add_argument("--tnc", action="store_true", help="put radios in standalone TNC mode with the profile params")
+    parser.add_argument("--board", choices=sorted(BOARDS), default=None,
+                        help="bootstrap unprovisioned radios as this board, band from the profile frequency. "
+                             "Boards without RNode firmware at all still need rnodeconf --autoinstall once")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds any single step may take")
+    args = parser.parse_args()
+
+    if args.port:
+        jobs = [RadioJob(p) for p in args.port]
+    else:
+        jobs = [RadioJob(p.device, p.serial_number) for p in detect_ports()]
+    if len(jobs) == 0:
+        print("No radios found")
+        sys.exit(1)
+
+    params = rnode_params(args.profile)
+    tag = firmware_release()["tag_name"]
+    print(f"Provisioning {len(jobs)} radios with {FIRMWARE_REPO} {tag}")
+
+    with FirmwareServer(FIRMWARE_REPO, tag) as fw_server:
+        provisioner = Provisioner(args.rnodeconf, params, tag, fw_url=fw_server.url, tnc=args.tnc,
+                                  skip_flash=args.skip_flash, step_timeout=args.timeout, board=args.board)
+        stop = threading.Event()
+        reporter = threading.Thread(target=print_progress, args=(jobs, stop), daemon=True)
+        reporter.start()
+        with ThreadPoolExecutor(max_workers=args.jobs or len(jobs)) as pool:
+            list(pool.map(provisioner.provision, jobs))
+        stop.set()
+        reporter.join()
+
+    report = write_report(jobs, params, tag)
+    failed = [j for j in jobs if j.status != "ok"]
+    print(f"{len(jobs) - len(failed)} ok, {len(failed)} failed. Report: {report}")
+    sys.exit(1 if failed else 0)
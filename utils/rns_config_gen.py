@@ -1,53 +1,358 @@
 import os
+import re
 import sys
-import importlib.util
-from jinja2 import Environment, Template
+import glob
+import hashlib
+import json
+import argparse
+from jinja2 import Template
 from typing import Optional
-from io import BytesIO
 from configobj import ConfigObj
 
+# we get imported both as utils.rns_config_gen (retcon.py) and as a plain module (admin.py)
+try:
+    from .state import atomic_write
+    from . import lora_planner
+except ImportError:
+    from state import atomic_write
+    import lora_planner
+
+import logging
+logger = logging.getLogger("retcon")
+
 dir_path = os.path.dirname(os.path.realpath(__file__)) + "/.."
 
+RNS_CONFIG_PATH = os.path.expanduser("~/.reticulum/config")
+
+# What kind of link an interface is decides its bitrate, announce cap, ingress control and mode.
+# Without them reticulum caps every interface's announces at 2% of whatever bitrate it guesses,
+# so a transport happily relays a wifi sized burst of announces into LoRa.
+LINK_WIFI = "wifi"              # the wifi mesh backbone (and any AutoInterface)
+LINK_LORA = "lora"              # RNode
+LINK_MESHTASTIC = "meshtastic"  # RNS over meshtastic
+LINK_INTERNET = "internet"      # hardcoded TCP/I2P links to testnets and other sites
+
+WIFI_BITRATE = 10_000_000  # one 2.4GHz hop with the AP and uplink sharing a radio. Reticulum's guess is far higher
+# RNS_Over_Meshtastic data_speed is meshtastic's modem preset. Raw LoRa bitrate of each
+MESHTASTIC_BITRATE = {0: 1070, 1: 180, 2: 90, 3: 1950, 4: 3520, 5: 6250, 6: 10940, 7: 340, 8: 21880}
+
+# every key tuning may add. Anything already in the profile or a plugin template wins
+TUNING_KEYS = ("bitrate", "announce_cap", "mode", "ingress_control", "ic_burst_freq_new", "ic_burst_freq",
+               "ic_max_held_announces", "announce_rate_target", "announce_rate_grace", "announce_rate_penalty")
+
+# The reticulum template doesn't change while we're running so only read and compile it once
+_rns_template = None
+_rns_template_src = None
+
+# digest of the last set of inputs we rendered and the result
+_last_render = (None, None)
+
 def get_recton_config(retcon_profile: Optional[str] = None):
     profile_path = (retcon_profile + ".config") if retcon_profile is not None else "active"
     profile_path = dir_path + "/retcon_profiles/" + profile_path
     return ConfigObj(profile_path, interpolation=False)
 
-def generate_rns_config(plugins: dict, retcon_profile: Optional[str] = None):
-    """Generate an RNS config file based on the retcon config"""   
-    
-    with open(dir_path+"/templates/reticulum.config") as f:
-        t_str = f.read()
-    
-    # read the rns config template    
-    template = Template(t_str)
-    
-    # parse the retcon config
-    config = get_recton_config(retcon_profile)
-   
+def _get_rns_template():
+    global _rns_template, _rns_template_src
+    if _rns_template is None:
+        with open(dir_path+"/templates/reticulum.config") as f:
+            _rns_template_src = f.read()
+        _rns_template = Template(_rns_template_src)
+    return _rns_template
+
+def _quote(value) -> str:
+    """ quote a config value the same way configobj would so reticulum parses it back the same"""
+    if isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return ","
+        if len(value) == 1:
+            return _quote(value[0]) + ","
+        return ", ".join(_quote(x) for x in value)
+
+    value = str(value)
+    if value == "" or value != value.strip() or any(c in value for c in ",#\"'\n"):
+        if '"' not in value:
+            return f'"{value}"'
+        if "'" not in value:
+            return f"'{value}'"
+        return f'"""{value}"""'
+    return value
+
+def render_section(section, depth: int = 2) -> str:
+    """
+    Render a parsed configobj section (like [interfaces]) back to config text.
+    configobj doesn't give us access to the string that built a section, but the section keeps
+    its keys in file order so walking it is enough to get the same output every time.
+    """
+    lines = []
+    indent = "  " * depth
+    for key in section.scalars:
+        lines.append(f"{indent}{key} = {_quote(section[key])}")
+    for key in section.sections:
+        lines.append(f"{'  ' * (depth - 1)}{'[' * depth}{key}{']' * depth}")
+        lines.append(render_section(section[key], depth + 1))
+    return "\n".join(lines)
+
+def collect_plugin_vars(plugins: dict) -> dict:
+    """ Ask every plugin for its template vars. Returns plugin_name -> vars"""
+    return {name: plugin.get_config() for name, plugin in plugins.items()}
+
+def config_digest(*parts) -> str:
+    """ sha256 over anything json serializable. Used to tell if config inputs changed"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+def classify_interface(section) -> Optional[str]:
+    """ LINK_* for a parsed reticulum interface section, None if we don't know the type"""
+    kind = section.get("type", "")
+    if kind in ("RNodeInterface", "RNodeMultiInterface"):
+        return LINK_LORA
+    if kind == "Meshtastic_Interface":
+        return LINK_MESHTASTIC
+    if kind == "AutoInterface" or str(section.get("name", "")).startswith("retcon_"):
+        return LINK_WIFI  # our own backbone interfaces are all named retcon_*
+    if kind in ("BackboneInterface", "TCPClientInterface", "TCPServerInterface", "I2PInterface", "UDPInterface"):
+        return LINK_INTERNET
+    return None
+
+def interface_tuning(link: str, section, is_transport: bool, slow_links: bool) -> dict:
+    """
+    The settings for one interface. slow_links: this node also has LoRa or meshtastic, so whatever
+    comes in fast ends up queued on a radio that moves a few kbit/s
+    """
+    if link == LINK_LORA:
+        if "spreadingfactor" not in section or "bandwidth" not in section:
+            return {}
+        params = lora_planner.params_from_config(section)
+        # a transport relays the whole venue's announces into the channel. Keep them to 1% of it
+        return {"bitrate": int(lora_planner.bitrate(params.sf, params.bw, params.cr)),
+                "announce_cap": 1 if is_transport else 2,
+                "mode": "full" if is_transport else "roaming",
+                "ingress_control": True}
+    if link == LINK_MESHTASTIC:
+        try:
+            bitrate = MESHTASTIC_BITRATE[int(section.get("data_speed", 0))]
+        except (ValueError, KeyError):
+            bitrate = MESHTASTIC_BITRATE[0]
+        return {"bitrate": bitrate, "announce_cap": 1,
+                "mode": "full" if is_transport else "roaming",
+                "ingress_control": True}
+    if link == LINK_WIFI:
+        tuning = {"bitrate": WIFI_BITRATE, "announce_cap": 2, "ingress_control": True}
+        if is_transport and slow_links:
+            # hold announce bursts at the wifi edge instead of passing them on to the radio
+            tuning.update({"ic_burst_freq_new": 2, "ic_burst_freq": 6, "ic_max_held_announces": 64})
+        return tuning
+    if link == LINK_INTERNET:
+        # testnets are full of destinations announcing every few minutes. Only pass on an hourly one
+        tuning = {"ingress_control": True}
+        if slow_links:
+            tuning.update({"announce_rate_target": 3600, "announce_rate_grace": 6, "announce_rate_penalty": 7200})
+        return tuning
+    return {}
+
+_IFACE_HEADER = re.compile(r"^(\s*)\[\[([^\[\]]+)\]\]\s*(#.*)?$")
+
+def tune_rns_config(config: ConfigObj, rns_config: str) -> str:
+    """
+    Add the tuning for every interface in a rendered reticulum config, right under its [[header]].
+    Keys an interface already has are left alone
+    """
+    try:
+        rendered = ConfigObj(rns_config.splitlines(), interpolation=False)
+    except Exception as e:
+        logger.warning(f"could not parse rendered config for interface tuning: {e}")
+        return rns_config
+    interfaces = rendered.get("interfaces", {})
+    is_transport = config["retcon"].get("mode") == "transport"
+    links = {name: classify_interface(section) for name, section in interfaces.items()}
+    slow_links = any(link in (LINK_LORA, LINK_MESHTASTIC) for link in links.values())
+
+    lines = []
+    in_interfaces = False
+    pending = None  # (indent, tuning lines) waiting for the first key of the section, to match its indent
+
+    def flush(indent=None):
+        nonlocal pending
+        if pending is not None:
+            lines.extend((indent if indent is not None else pending[0]) + t for t in pending[1])
+            pending = None
+
+    for line in rns_config.splitlines(keepends=True):
+        stripped = line.strip()
+        if pending is not None and stripped and not stripped.startswith("#"):
+            flush(None if stripped.startswith("[") else line[:len(line) - len(line.lstrip())])
+        lines.append(line)
+        if stripped.startswith("[") and not stripped.startswith("[["):
+            in_interfaces = stripped.split("#")[0].strip() == "[interfaces]"
+            continue
+        m = _IFACE_HEADER.match(line.rstrip("\n"))
+        if not in_interfaces or m is None or m.group(2).strip() not in interfaces:
+            continue
+        name = m.group(2).strip()
+        section = interfaces[name]
+        tuning = {k: v for k, v in interface_tuning(links[name], section, is_transport, slow_links).items()
+                  if k not in section}
+        if tuning:
+            pending = (m.group(1) + "  ", [f"# {links[name]} link, tuned by retcon\n"] +
+                       [f"{k} = {_quote(v)}\n" for k, v in tuning.items()])
+    flush()
+    return "".join(lines)
+
+def render_rns_config(config: ConfigObj, plugin_vars: dict) -> str:
+    """ Render the reticulum config from a parsed retcon profile and the vars each plugin returned"""
+    global _last_render
+    template = _get_rns_template()
+
     mode = config["retcon"]["mode"]
     # generate the values
     enable_transport = "yes" if mode == "transport" else "no"
-    plugin_interfaces = ""
     hardcoded_interfaces = config.get('interfaces', None)
-    
-    if hardcoded_interfaces is not None:
-        # configObj doesn't give us access to the string that built a section
-        # so we have to be hacky and re-construc it from the parsed section dict
-        section_config = ConfigObj()
-        section_config.merge(hardcoded_interfaces)
-        with BytesIO() as fout:
-            section_config.write(fout)
-            hardcoded_interfaces = fout.getvalue().decode()
-        
-    
-    for plugin in plugins.values():
-        template_vars = plugin.get_config()
-        # right now just plugin config, but maybe more later
-        plugin_interfaces += template_vars.get("plugin_interfaces","")
-        
-    return template.render(enable_transport=enable_transport, 
-                           plugin_interfaces=plugin_interfaces, 
-                           hardcoded_interfaces="" if hardcoded_interfaces is None else hardcoded_interfaces
-                           )
 
+    # right now just plugin config, but maybe more later
+    plugin_interfaces = "".join(v.get("plugin_interfaces", "") for v in plugin_vars.values())
+
+    template_vars = {
+        "enable_transport": enable_transport,
+        "plugin_interfaces": plugin_interfaces,
+        "hardcoded_interfaces": "" if hardcoded_interfaces is None else render_section(hardcoded_interfaces).lstrip(),
+    }
+
+    # same inputs always give the same bytes, so don't bother rendering again
+    digest = config_digest(_rns_template_src, template_vars)
+    if _last_render[0] == digest:
+        return _last_render[1]
+
+    rendered = tune_rns_config(config, template.render(**template_vars))
+    _last_render = (digest, rendered)
+    return rendered
+
+def lora_warnings(config: ConfigObj, rns_config: str) -> list:
+    """
+    Run the LoRa planner over every RNodeInterface in a rendered reticulum config
+    (hardcoded ones and the ones plugins rendered from rnode_config_template)
+    """
+    try:
+        rendered = ConfigObj(rns_config.splitlines(), interpolation=False)
+    except Exception as e:
+        return [f"could not parse rendered config for LoRa checks: {e}"]
+
+    r_config = config.get("retcon", {})
+    nodes = int(r_config.get("expected_nodes", 20))
+    announce_every = float(r_config.get("announce_every", 10*60))
+    warnings = []
+    for name, params in lora_planner.lora_interfaces(rendered):
+        warnings += [f"{name}: {w}" for w in lora_planner.check(params, nodes, announce_every)]
+    return warnings
+
+def generate_rns_config(plugins: dict, retcon_profile: Optional[str] = None, plugin_vars: Optional[dict] = None,
+                        validate: bool = False):
+    """
+    Generate an RNS config file based on the retcon config
+    With validate, LoRa planner warnings are logged and left as comments at the top of the config
+    """
+    # parse the retcon config
+    config = get_recton_config(retcon_profile)
+
+    if plugin_vars is None:
+        plugin_vars = collect_plugin_vars(plugins)
+
+    rns_config = render_rns_config(config, plugin_vars)
+    if validate:
+        warnings = lora_warnings(config, rns_config)
+        for w in warnings:
+            logger.warning(f"LoRa planner: {w}")
+        if warnings:
+            rns_config = "".join(f"# LoRa planner: {w}\n" for w in warnings) + rns_config
+    return rns_config
+
+def write_rns_config(rns_config: str, path: str = RNS_CONFIG_PATH) -> bool:
+    """
+    Atomically write the rendered config to path.
+    Returns False (and doesn't touch the file) if it already has exactly this content
+    so callers can skip restarting anything that reads it.
+    """
+    new_bytes = rns_config.encode()
+    try:
+        with open(path, "rb") as fin:
+            if hashlib.sha256(fin.read()).digest() == hashlib.sha256(new_bytes).digest():
+                return False
+    except FileNotFoundError:
+        pass
+
+    atomic_write(path, new_bytes)
+    return True
+
+def _check_plugin_vars(config: ConfigObj) -> dict:
+    """ what each plugin in a profile would render, without touching hardware. RNode/meshtastic get a placeholder port"""
+    if dir_path not in sys.path:
+        sys.path.insert(0, dir_path)
+    from plugins import load_plugin_class
+
+    plugin_vars = {}
+    for name, section in config.get("retcon_plugins", {}).items():
+        if name == "usb_autodetect":
+            from plugins.usb_autodetect import _rnode_template, _meshtastic_template
+            interfaces = ""
+            if "meshtastic" in section:
+                interfaces += "\n\n" + _meshtastic_template.render(port="/dev/ttyCHECK0", **section["meshtastic"])
+            if "rnode" in section:
+                interfaces += "\n\n" + _rnode_template.render(port="/dev/ttyCHECK1", **section["rnode"])
+            plugin_vars[name] = {"plugin_interfaces": interfaces}
+        else:
+            plugin = load_plugin_class(name)("CHECK", section, config, None)
+            plugin_vars[name] = plugin.get_config()
+    return plugin_vars
+
+def check_profile(profile: str) -> tuple:
+    """ (rendered config, problems, notes) for one profile in retcon_profiles/"""
+    config = get_recton_config(profile)
+    rendered = render_rns_config(config, _check_plugin_vars(config))
+    problems, notes = [], []
+    try:
+        interfaces = ConfigObj(rendered.splitlines(), interpolation=False).get("interfaces", {})
+    except Exception as e:
+        return rendered, [f"rendered config doesn't parse: {e}"], notes
+    if not interfaces:
+        problems.append("no interfaces")
+    is_transport = config["retcon"].get("mode") == "transport"
+    links = {name: classify_interface(section) for name, section in interfaces.items()}
+    slow_links = any(link in (LINK_LORA, LINK_MESHTASTIC) for link in links.values())
+    for name, section in interfaces.items():
+        link = links[name]
+        notes.append(f"{name}: {link}, " + ", ".join(f"{k} {section[k]}" for k in TUNING_KEYS if k in section))
+        if link is None:
+            problems.append(f"{name}: can't tell what kind of link a {section.get('type')} is")
+        elif link in (LINK_LORA, LINK_MESHTASTIC):
+            if "bitrate" not in section or "announce_cap" not in section:
+                problems.append(f"{name}: {link} without bitrate and announce_cap")
+            elif float(section["announce_cap"]) > 2:
+                problems.append(f"{name}: announce_cap {section['announce_cap']} on a {link} link")
+        elif link == LINK_WIFI and is_transport and slow_links and "ic_burst_freq_new" not in section:
+            problems.append(f"{name}: wifi into a radio link without announce burst limits")
+    notes += [f"LoRa planner: {w}" for w in lora_warnings(config, rendered)]
+    return rendered, problems, notes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render the reticulum config for retcon profiles")
+    parser.add_argument("profiles", nargs="*", help="profile names. Default: every profile in retcon_profiles/")
+    parser.add_argument("--check", action="store_true", help="check every interface got its link tuning. Exits 1 if not")
+    parser.add_argument("--print", action="store_true", help="print the rendered configs")
+    args = parser.parse_args()
+
+    profiles = args.profiles or sorted(os.path.basename(p)[:-len(".config")]
+                                       for p in glob.glob(dir_path + "/retcon_profiles/*.config"))
+    failed = 0
+    for profile in profiles:
+        rendered, problems, notes = check_profile(profile)
+        if args.print:
+            print(rendered)
+        print(f"{profile}: {'FAIL' if problems else 'ok'}")
+        for line in notes:
+            print(f"    {line}")
+        for line in problems:
+            print(f"  ! {line}")
+        failed += bool(problems)
+    sys.exit(1 if args.check and failed else 0)
@@ -0,0 +1,179 @@
+"""
+When and how a mesh client scans for parents.
+
+A scan on the onboard radio takes the AP off its channel with it. Every full NetworkManager
+scan walks all channels, which stalls and drops traffic for everyone on the AP. So:
+
+    - only the configured mesh freq is scanned (iw ... scan trigger freq <freq>). It's the
+      channel the AP is on anyway, and parents on other channels can't be used
+    - scans probe for the SSIDs we already know. Every full_scan_every'th scan is a wildcard
+      probe on the same channel to find new parents
+    - with no parent around the interval backs off exponentially, base to backoff_max, jittered
+    - while the AP pushes more than busy_kbps the scan waits, up to max_defer seconds
+      (connected_max_defer when we already have a parent and the scan is just a check)
+
+Each scan records how long it took, what the AP did before and during it and how many
+packets the AP dropped, in ~/.retcon/scan_stats_<iface>.json.
+"""
+import os
+import json
+import time
+import random
+from collections import deque
+
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
+
+STATS_DIR = os.path.expanduser("~/.retcon")
+
+SCAN_BASE = 8
+SCAN_BACKOFF_MAX = 300
+SCAN_BUSY_KBPS = 200
+SCAN_MAX_DEFER = 120
+SCAN_CONNECTED_MAX_DEFER = 600
+FULL_SCAN_EVERY = 5
+HISTORY = 50
+
+COUNTERS = ("tx_bytes", "rx_bytes", "tx_dropped", "tx_errors")
+
+
+def iface_counters(ifaces: list, sysfs_root: str = "/sys/class/net") -> dict:
+    """ summed sysfs statistics of ifaces. Missing ifaces count as zero"""
+    totals = dict.fromkeys(COUNTERS, 0)
+    for iface in ifaces:
+        for counter in COUNTERS:
+            try:
+                with open(os.path.join(sysfs_root, iface, "statistics", counter)) as fin:
+                    totals[counter] += int(fin.read())
+            except (FileNotFoundError, ValueError):
+                pass
+    return totals
+
+
+class ScanPolicy:
+
+    def __init__(self, iface: str, watch_ifaces: list, base: float = SCAN_BASE, backoff_max: float = SCAN_BACKOFF_MAX,
+                 busy_kbps: float = SCAN_BUSY_KBPS, max_defer: float = SCAN_MAX_DEFER,
+                 connected_max_defer: float = SCAN_CONNECTED_MAX_DEFER, full_scan_every: int = FULL_SCAN_EVERY,
+                 sysfs_root: str = "/sys/class/net"):
+        self.iface = iface
+        self.watch_ifaces = watch_ifaces
+        self.base = base
+        self.backoff_max = backoff_max
+        self.busy_kbps = busy_kbps
+        self.max_defer = max_defer
+        self.connected_max_defer = connected_max_defer
+        self.full_scan_every = full_scan_every
+        self.sysfs_root = sysfs_root
+        self.stats_path = os.path.join(STATS_DIR, f"scan_stats_{iface}.json")
+
+        self.misses = 0               # scans in a row that found no candidate
+        self.next_scan = 0
+        self.known_ssids = set()      # candidates seen before, what directed scans probe for
+        self.scans_since_full = FULL_SCAN_EVERY  # first scan is a wildcard one
+        self.history = deque(maxlen=HISTORY)
+        self.totals = {"scans": 0, "directed": 0, "wildcard": 0, "deferrals": 0, "deferred_seconds": 0}
+        self._deferred_since = None
+        self._before_kbps = 0
+        self._was_connected = None
+        self._sample = (time.time(), iface_counters(watch_ifaces, sysfs_root))
+        self._rng = random.Random()
+
+    def ap_kbps(self) -> float:
+        """ AP throughput, both directions, since the last call"""
+        now, counters = time.time(), iface_counters(self.watch_ifaces, self.sysfs_root)
+        then, before = self._sample
+        self._sample = (now, counters)
+        if now - then <= 0:
+            return 0
+        return (counters["tx_bytes"] + counters["rx_bytes"] - before["tx_bytes"] - before["rx_bytes"]) * 8 / 1000 / (now - then)
+
+    def ready(self, connected: bool, wanted: bool = True) -> bool:
+        """ True if a scan should go out now. Call this every loop, wanted or not, it also samples the AP"""
+        now = time.time()
+        if self._was_connected and not connected:
+            # just lost the parent. Look straight away, and back off from there
+            self.misses = 0
+            self.next_scan = now
+        self._was_connected = connected
+        kbps = self.ap_kbps()
+
+        if not wanted:
+            self._deferred_since = None
+            return False
+        if not connected and now < self.next_scan:
+            return False
+        if kbps > self.busy_kbps:
+            if self._deferred_since is None:
+                self._deferred_since = now
+                self.totals["deferrals"] += 1
+            if now - self._deferred_since < (self.connected_max_defer if connected else self.max_defer):
+                return False
+        self._before_kbps = kbps
+        return True
+
+    def plan(self) -> dict:
+        """ {"kind": "directed"|"wildcard", "ssids": [bytes]}"""
+        if self.known_ssids and self.scans_since_full < self.full_scan_every:
+            return {"kind": "directed", "ssids": sorted(self.known_ssids)}
+        return {"kind": "wildcard", "ssids": []}
+
+    def begin(self, plan: dict) -> dict:
+        deferred = 0 if self._deferred_since is None else time.time() - self._deferred_since
+        self._deferred_since = None
+        self.totals["deferred_seconds"] += deferred
+        return dict(plan, start=time.time(), counters=iface_counters(self.watch_ifaces, self.sysfs_root),
+                    before_kbps=self._before_kbps, deferred=deferred)
+
+    def end(self, scan: dict, found: list, freq: int = None):
+        """ found: the candidate SSIDs the scan turned up"""
+        now = time.time()
+        counters = iface_counters(self.watch_ifaces, self.sysfs_root)
+        duration = max(now - scan["start"], 1e-3)
+        during = counters["tx_bytes"] + counters["rx_bytes"] - scan["counters"]["tx_bytes"] - scan["counters"]["rx_bytes"]
+        self._sample = (now, counters)  # don't let the scan itself count towards the next busy check
+
+        self.totals["scans"] += 1
+        self.totals[scan["kind"]] += 1
+        self.scans_since_full = 0 if scan["kind"] == "wildcard" else self.scans_since_full + 1
+        if scan["kind"] == "wildcard" and found:
+            self.known_ssids = set(found)  # a wildcard scan sees everyone. Drop parents that went away
+        else:
+            self.known_ssids |= set(found)
+        if found:
+            self.misses = 0
+        else:
+            self.misses += 1
+            if scan["kind"] == "directed":
+                self.scans_since_full = self.full_scan_every  # who we knew is gone. Look around properly next time
+        interval = min(self.base * 2 ** self.misses, self.backoff_max) if self.misses else self.base
+        self.next_scan = now + interval * self._rng.uniform(0.8, 1.2)
+
+        self.history.append({
+            "time": scan["start"],
+            "kind": scan["kind"],
+            "freq": freq,
+            "probed": len(scan["ssids"]),
+            "found": len(found),
+            "duration_ms": round(duration * 1000),
+            "deferred_s": round(scan["deferred"], 1),
+            "ap_kbps_before": round(scan["before_kbps"], 1),
+            "ap_kbps_during": round(during * 8 / 1000 / duration, 1),
+            "ap_tx_dropped": counters["tx_dropped"] - scan["counters"]["tx_dropped"],
+            "ap_tx_errors": counters["tx_errors"] - scan["counters"]["tx_errors"],
+            "next_in_s": round(self.next_scan - now),
+        })
+        self.save()
+
+    def stats(self) -> dict:
+        return {"iface": self.iface, "misses": self.misses, "next_scan": self.next_scan,
+                "known_ssids": [s.decode(errors="replace") for s in sorted(self.known_ssids)],
+                "totals": self.totals, "scans": list(self.history)}
+
+    def save(self):
+        try:
+            atomic_write(self.stats_path, json.dumps(self.stats(), indent=2).encode())
+        except OSError:
+            pass  # stats aren't worth failing a scan over
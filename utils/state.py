@@ -0,0 +1,38 @@
+"""
+Small helpers for files RETCON writes at runtime
+"""
+import os
+import tempfile
+
+
+def atomic_write(path: str, data: bytes, mode: int = 0o644):
+    """
+    Write data to path so that readers only ever see the old file or the new one.
+    We write to a temp file in the same directory, fsync it and then rename over the target.
+    A power cut halfway through leaves the old file untouched.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # don't leave half written temp files lying around
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    # make sure the rename itself hits the disk
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
@@ -0,0 +1,271 @@
+"""
+Compact admin status for slow links.
+
+The plain `status` command answers with rnstatus' text, kilobytes a LoRa hop takes minutes to
+move. `status <fields>` answers with a msgpack reply instead, small enough for one LXMF packet:
+
+    status iface,peers             just those fields, whole
+    status iface@12,peers@12       what changed since version 12, which the asker already has
+    status all
+
+Every distinct reading the console hands out gets a version. For a field asked for @v the reply
+carries only the keys that changed since v (or "same"), as long as the console still remembers v.
+If the reply would not fit in a packet, the fields that don't fit are listed as "more", to ask for
+in the next poll.
+
+    reply = {0: version, 1: {field: value}, 2: {field: [base, changed, removed]}, 3: [same fields], 4: [more fields]}
+
+Fields are small ints on the wire, see FIELDS. This also renders replies, keeping what it decoded
+per node in ~/.retcon/status_cache so the next query can ask for deltas:
+
+    python utils/status_codec.py query <console lxmf address> [iface,peers]
+    python utils/status_codec.py decode reply.bin
+"""
+import os
+import re
+import sys
+import time
+import socket
+import argparse
+from collections import OrderedDict
+
+from RNS.vendor import umsgpack
+
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
+
+STATUS_TITLE = "RETCON status"
+CACHE_DIR = os.path.expanduser("~/.retcon/status_cache")
+IDENTITY_PATH = os.path.expanduser("~/.retcon/status_identity")
+
+# field -> what's in it. Records are lists in this order, collections map a key to such a list
+FIELDS = OrderedDict([
+    ("node", ("name", "mode", "uptime_s", "time")),
+    ("sys", ("load1", "mem_available_mb", "temp_c")),
+    ("td", ("pid", "uptime_s", "clients")),
+    ("iface", ("online", "rx_bytes", "tx_bytes")),                    # rns interface name -> ...
+    ("peers", ("role", "label", "rtt_ms", "loss_pct", "kbps")),        # packed ipv4 -> ...
+    ("prop", ("messages", "destinations", "bytes", "limit", "hit_pct", "served", "evicted")),
+    ("config", ("version", "last_version", "last_status", "last_detail")),
+    ("rnsh", ("identity hashes",)),
+    ("thermal", ("state", "temp_c", "throttled", "governor", "load1")),  # new fields go last, the ids are on the wire
+])
+FIELD_IDS = {name: i for i, name in enumerate(FIELDS)}
+COLLECTIONS = ("iface", "peers")
+DEFAULT_FIELDS = ("node", "sys", "td", "iface", "peers")
+
+VERSION, FULL, DELTA, SAME, MORE = range(5)
+HISTORY = 8        # versions remembered for deltas
+MAX_BYTES = 270    # what's left of LXMF's 295 byte single packet content after the title
+
+
+def parse_request(text: str) -> dict:
+    """ "iface@12,peers" -> {"iface": 12, "peers": None}. Unknown fields are dropped"""
+    wanted = OrderedDict()
+    for part in re.split(r"[,\s]+", text.strip()):
+        name, _, base = part.partition("@")
+        if name == "all":
+            wanted.update((f, wanted.get(f)) for f in FIELDS)
+        elif name in FIELDS:
+            wanted[name] = int(base) if base.isdigit() else None
+    return wanted
+
+
+def format_request(fields: list, cache: dict = None) -> str:
+    cache = cache or {}
+    return "status " + ",".join(f"{f}@{cache[f][0]}" if f in cache else f for f in fields)
+
+
+def _diff(old: dict, new: dict) -> list:
+    changed = {k: v for k, v in new.items() if old.get(k) != v}
+    return [changed, [k for k in old if k not in new]]
+
+
+class StatusEncoder:
+    """ versions the readings it's given and encodes replies against them"""
+
+    def __init__(self, history: int = HISTORY, max_bytes: int = MAX_BYTES):
+        # from the clock, so a restarted console never reuses a version a client has cached
+        self.version = int(time.time())
+        self.snapshots = OrderedDict()  # version -> {field: value}, every field ever read
+        self.history = history
+        self.max_bytes = max_bytes
+
+    def update(self, readings: dict) -> int:
+        last = self.snapshots.get(self.version, {})
+        merged = dict(last, **readings)
+        if merged != last:
+            self.version += 1
+            self.snapshots[self.version] = merged
+            while len(self.snapshots) > self.history:
+                self.snapshots.popitem(last=False)
+        return self.version
+
+    def encode(self, wanted: dict) -> bytes:
+        """ wanted: {field: version the asker has, or None}, as from parse_request"""
+        current = self.snapshots.get(self.version, {})
+        parts = []  # (field, kind, payload) in the order asked
+        for field, base in wanted.items():
+            if field not in current:
+                continue
+            value = current[field]
+            old = self.snapshots.get(base, {}).get(field) if base is not None else None
+            if old is None:
+                parts.append((field, FULL, value))
+            elif old == value:
+                parts.append((field, SAME, None))
+            elif field in COLLECTIONS:
+                parts.append((field, DELTA, [base] + _diff(old, value)))
+            else:
+                parts.append((field, FULL, value))
+
+        more = []
+        while True:
+            reply = {VERSION: self.version, FULL: {}, DELTA: {}, SAME: [], MORE: [FIELD_IDS[f] for f in more]}
+            for field, kind, payload in parts:
+                if kind == SAME:
+                    reply[SAME].append(FIELD_IDS[field])
+                else:
+                    reply[kind][FIELD_IDS[field]] = payload
+            packed = umsgpack.packb({k: v for k, v in reply.items() if v or k == VERSION})
+            if len(packed) <= self.max_bytes or len(parts) <= 1:
+                return packed
+            more.insert(0, parts.pop()[0])  # the last field asked for waits for the next poll
+
+
+def decode(packed: bytes, cache: dict = None) -> dict:
+    """
+    {"version", "fields": {field: value}, "more": [fields], "missing": [fields]}. cache is {field: [version, value]}
+    from earlier replies and is updated in place. Deltas against a version we don't have end up in missing
+    """
+    names = list(FIELDS)
+    reply = umsgpack.unpackb(packed)
+    version = reply[VERSION]
+    cache = {} if cache is None else cache
+    fields, missing = {}, []
+    for fid, value in reply.get(FULL, {}).items():
+        fields[names[fid]] = value
+    for fid in reply.get(SAME, []):
+        if names[fid] in cache:
+            fields[names[fid]] = cache[names[fid]][1]
+        else:
+            missing.append(names[fid])
+    for fid, (base, changed, removed) in reply.get(DELTA, {}).items():
+        name = names[fid]
+        if name not in cache or cache[name][0] != base:
+            missing.append(name)
+            continue
+        value = dict(cache[name][1])
+        value.update(changed)
+        for key in removed:
+            value.pop(key, None)
+        fields[name] = value
+    for name, value in fields.items():
+        cache[name] = [version, value]
+    return {"version": version, "fields": fields, "more": [names[f] for f in reply.get(MORE, [])], "missing": missing}
+
+
+def _label(key) -> str:
+    if isinstance(key, bytes) and len(key) == 4:
+        return socket.inet_ntoa(key)
+    return key.hex() if isinstance(key, bytes) else str(key)
+
+
+def render(fields: dict) -> str:
+    lines = []
+    for name, value in fields.items():
+        layout = FIELDS[name]
+        lines.append(name.upper())
+        if name in COLLECTIONS:
+            for key, record in sorted(value.items(), key=lambda kv: _label(kv[0])):
+                lines.append(f"  {_label(key)}: " + ", ".join(f"{k} {v}" for k, v in zip(layout, record) if v is not None))
+        elif name == "rnsh":
+            lines.extend(f"  <{h.hex()}>" for h in value)
+        else:
+            lines.append("  " + ", ".join(f"{k} {v}" for k, v in zip(layout, value) if v is not None))
+    return "\n".join(lines)
+
+
+def load_cache(node: str) -> dict:
+    try:
+        with open(os.path.join(CACHE_DIR, node), "rb") as fin:
+            return umsgpack.unpackb(fin.read())
+    except (FileNotFoundError, umsgpack.UnpackException):
+        return {}
+
+
+def save_cache(node: str, cache: dict):
+    atomic_write(os.path.join(CACHE_DIR, node), umsgpack.packb(cache))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ask a RETCON admin console for its compact status")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_query = sub.add_parser("query", help="poll a console over LXMF and print its status")
+    p_query.add_argument("to", help="lxmf address of the admin console")
+    p_query.add_argument("fields", nargs="?", default=",".join(DEFAULT_FIELDS), help=f"any of {','.join(FIELDS)} or all")
+    p_query.add_argument("--identity", default=IDENTITY_PATH, help="identity file to ask as. Created if missing")
+    p_query.add_argument("--full", action="store_true", help="ignore the cache, ask for everything whole")
+    p_query.add_argument("--timeout", type=float, default=120)
+    p_decode = sub.add_parser("decode", help="print a saved reply")
+    p_decode.add_argument("file")
+    p_decode.add_argument("--node", default=None, help="apply deltas against this node's cache")
+    args = parser.parse_args()
+
+    if args.command == "decode":
+        with open(args.file, "rb") as fin:
+            result = decode(fin.read(), load_cache(args.node) if args.node else None)
+        print(f"v{result['version']}\n" + render(result["fields"]))
+        if result["missing"]:
+            print(f"deltas against versions we don't have: {','.join(result['missing'])}")
+        sys.exit(0)
+
+    import RNS
+    from LXMF import LXMRouter, LXMessage
+
+    fields = list(parse_request(args.fields))
+    if not fields:
+        parser.error(f"no known fields in {args.fields}")
+    cache = {} if args.full else load_cache(args.to)
+    reticulum = RNS.Reticulum()
+    if not os.path.exists(args.identity):
+        atomic_write(args.identity, RNS.Identity(create_keys=True).get_private_key(), mode=0o600)
+    identity = RNS.Identity.from_file(args.identity)
+    router = LXMRouter(storagepath=os.path.expanduser("~/.retcon/status_cli"))
+    source = router.register_delivery_identity(identity, display_name="RETCON status")
+    router.announce(source.hash)  # the console needs our key to answer
+    replies = []
+    router.register_delivery_callback(lambda m: replies.append(m.content) if m.title_as_string() == STATUS_TITLE else None)
+
+    to_hash = bytes.fromhex(args.to)
+    RNS.Transport.request_path(to_hash)
+    deadline = time.time() + args.timeout
+    while RNS.Identity.recall(to_hash) is None and time.time() < deadline:
+        time.sleep(1)
+    console = RNS.Identity.recall(to_hash)
+    if console is None:
+        sys.exit(f"no path to {args.to}")
+    destination = RNS.Destination(console, RNS.Destination.OUT, RNS.Destination.SINGLE, "lxmf", "delivery")
+
+    shown = {}
+    while fields and time.time() < deadline:
+        request = format_request(fields, cache)
+        router.handle_outbound(LXMessage(destination, source, request, "", desired_method=LXMessage.OPPORTUNISTIC))
+        sent = time.time()
+        while not replies and time.time() < deadline:
+            time.sleep(0.5)
+        if not replies:
+            break
+        packed = replies.pop(0)
+        result = decode(packed, cache)
+        print(f"{request!r}: v{result['version']}, {len(packed)} bytes in {time.time() - sent:.1f}s")
+        shown.update(result["fields"])
+        for name in result["missing"]:
+            cache.pop(name, None)  # ask for it whole next time round
+        fields = result["more"] + result["missing"]
+    save_cache(args.to, cache)
+    print(render(shown))
+    if fields:
+        sys.exit(f"no reply for {','.join(fields)}")
@@ -0,0 +1,27 @@
+"""
+What the thermal plugin last saw and did, for the admin status
+"""
+import os
+import json
+import time
+
+THERMAL_PATH = os.path.expanduser("~/.retcon/thermal.json")
+STALE_AFTER = 120  # the plugin writes every 15s. Older than this and it isn't running
+
+# firmware get_throttled bits. The low ones are "right now", the same +16 are "since boot"
+THROTTLE_BITS = {0: "under_voltage", 1: "freq_capped", 2: "throttled", 3: "soft_temp_limit"}
+
+
+def throttle_flags(value: int) -> dict:
+    return {"now": [name for bit, name in THROTTLE_BITS.items() if value & (1 << bit)],
+            "since_boot": [name for bit, name in THROTTLE_BITS.items() if value & (1 << (bit + 16))]}
+
+
+def load_thermal_state(path: str = THERMAL_PATH, max_age: float = STALE_AFTER) -> dict:
+    """ the plugin's last report, or {} if there's none or it's stale"""
+    try:
+        with open(path) as fin:
+            report = json.load(fin)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return report if time.time() - report.get("time", 0) <= max_age else {}
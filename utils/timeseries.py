@@ -0,0 +1,223 @@
+"""
+Small fixed-size time series store for node statistics.
+
+Every series keeps three rings of float32 slots:
+
+    10s  x 360   the last hour
+    1m   x 1440  the last day
+    15m  x 672   the last week
+
+Each sample goes into every tier's current bucket as a running mean, so the coarse tiers are
+downsampled as we go. Nothing grows: with max_series series the store never holds more than
+max_series * 2472 floats (~640KB for the default 64), whatever the uptime.
+
+The sampler plugin writes it to LIVE_PATH every sample for the UI to read, and to
+PERSIST_PATH now and then so a reboot doesn't lose the history.
+
+    python utils/timeseries.py [series prefix]   # dump what's stored, 1m tier
+"""
+import os
+import sys
+import json
+import math
+import time
+from array import array
+
+try:
+    from .state import atomic_write
+except ImportError:
+    from state import atomic_write
+
+TIERS = (("10s", 10, 360), ("1m", 60, 1440), ("15m", 900, 672))
+MAX_SERIES = 64
+PERSIST_PATH = os.path.expanduser("~/.retcon/timeseries.bin")
+# tmpfs, so the every-sample writes don't wear out the SD card
+LIVE_PATH = "/dev/shm/retcon_timeseries.bin" if os.path.isdir("/dev/shm") else PERSIST_PATH
+NAN = float("nan")
+
+
+class _Tier:
+
+    def __init__(self, name: str, step: int, capacity: int):
+        self.name = name
+        self.step = step
+        self.capacity = capacity
+        self.times = array("d", [0.0]) * capacity  # bucket start of each slot, 0 = empty
+        self.values = {}                            # series -> array("f")
+        self.acc = {}                               # series -> [sum, n] for the current bucket
+        self.bucket = None
+
+    def _slot(self, bucket: float) -> int:
+        return int(bucket // self.step) % self.capacity
+
+    def add(self, ts: float, samples: dict):
+        bucket = ts // self.step * self.step
+        i = self._slot(bucket)
+        if bucket != self.bucket:
+            # a new bucket overwrites whatever the ring held a full lap ago
+            self.bucket = bucket
+            self.acc = {}
+            self.times[i] = bucket
+            for values in self.values.values():
+                values[i] = NAN
+        for name, value in samples.items():
+            if name not in self.values:
+                self.values[name] = array("f", [NAN]) * self.capacity
+            acc = self.acc.setdefault(name, [0.0, 0])
+            acc[0] += value
+            acc[1] += 1
+            self.values[name][i] = acc[0] / acc[1]
+
+    def read(self, name: str, now: float = None) -> list:
+        """ [(bucket time, value)] oldest first, only buckets from the last lap"""
+        values = self.values.get(name)
+        if values is None:
+            return []
+        now = time.time() if now is None else now
+        oldest = now - self.step * self.capacity
+        points = []
+        for i in range(self.capacity):
+            t = self.times[i]
+            if t > oldest and not math.isnan(values[i]):
+                points.append((t, values[i]))
+        points.sort()
+        return points
+
+
+class TimeSeriesStore:
+
+    def __init__(self, tiers=TIERS, max_series: int = MAX_SERIES):
+        self.tiers = [_Tier(*t) for t in tiers]
+        self.max_series = max_series
+        self.dropped = set()  # series we had no room for
+        self.seen = {}        # series -> when it last got a sample
+
+    @property
+    def names(self) -> list:
+        return sorted(self.tiers[0].values)
+
+    @property
+    def memory_ceiling(self) -> int:
+        """ bytes the rings can ever take"""
+        return sum(t.capacity * (8 + 4 * self.max_series) for t in self.tiers)
+
+    def add(self, samples: dict, ts: float = None):
+        ts = time.time() if ts is None else ts
+        known = self.tiers[0].values
+        accepted = {}
+        new = 0
+        for name, value in samples.items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            if name not in known:
+                if len(known) + new >= self.max_series:
+                    self.dropped.add(name)
+                    continue
+                new += 1
+            accepted[name] = float(value)
+            self.seen[name] = ts
+        for tier in self.tiers:
+            tier.add(ts, accepted)
+
+    def expire(self, max_age: float, now: float = None) -> list:
+        """ forget series that haven't had a sample in max_age seconds, so they stop holding a slot"""
+        now = time.time() if now is None else now
+        gone = [n for n in self.names if now - self.seen.get(n, now) > max_age]
+        for name in gone:
+            for tier in self.tiers:
+                tier.values.pop(name, None)
+                tier.acc.pop(name, None)
+            self.seen.pop(name, None)
+            self.dropped.discard(name)
+        return gone
+
+    def tier(self, name: str) -> _Tier:
+        for tier in self.tiers:
+            if tier.name == name:
+                return tier
+        raise KeyError(f"no tier {name}. Have {[t.name for t in self.tiers]}")
+
+    def query(self, names: list = None, tier: str = "1m", now: float = None) -> dict:
+        """ JSON friendly {"tier", "step", "series": {name: [[t, v], ...]}}. names match as prefixes"""
+        t = self.tier(tier)
+        selected = [n for n in self.names if names is None or any(n.startswith(p) for p in names)]
+        return {"tier": t.name, "step": t.step,
+                "series": {n: [[p[0], round(p[1], 3)] for p in t.read(n, now)] for n in selected}}
+
+    # persistence: a json header line, then the raw arrays in header order
+
+    def dumps(self) -> bytes:
+        names = self.names
+        header = {"tiers": [[t.name, t.step, t.capacity] for t in self.tiers], "series": names,
+                  "buckets": [t.bucket for t in self.tiers]}
+        chunks = [json.dumps(header).encode(), b"\n"]
+        for t in self.tiers:
+            chunks.append(t.times.tobytes())
+            for name in names:
+                chunks.append(t.values[name].tobytes())
+        return b"".join(chunks)
+
+    def save(self, path: str = PERSIST_PATH):
+        atomic_write(path, self.dumps())
+
+    @classmethod
+    def load(cls, path: str = PERSIST_PATH, max_series: int = MAX_SERIES):
+        """ the stored history, or an empty store if there's none or its layout doesn't match ours"""
+        store = cls(max_series=max_series)
+        try:
+            with open(path, "rb") as fin:
+                header = json.loads(fin.readline())
+                if [tuple(t) for t in header["tiers"]] != [(t.name, t.step, t.capacity) for t in store.tiers]:
+                    return store
+                names = header["series"][:max_series]
+                for t, bucket in zip(store.tiers, header["buckets"]):
+                    t.times.frombytes(fin.read(8 * t.capacity))
+                    del t.times[:t.capacity]
+                    for name in header["series"]:
+                        values = array("f")
+                        values.frombytes(fin.read(4 * t.capacity))
+                        if name in names:
+                            t.values[name] = values
+                    t.bucket = bucket  # the running mean of that bucket is lost, it restarts from the next sample
+                store.seen = dict.fromkeys(names, time.time())  # a restored series gets a full max_age to report again
+        except (FileNotFoundError, ValueError, KeyError, EOFError):
+            return cls(max_series=max_series)
+        return store
+
+
+def sparkline_svg(points: list, width: int = 160, height: int = 28, color: str = "#000080") -> str:
+    """ [(t, v)] -> a small svg polyline. Gaps (missed buckets) break the line"""
+    if len(points) < 2:
+        return f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}"></svg>'
+    t0, t1 = points[0][0], points[-1][0]
+    lo = min(v for _, v in points)
+    hi = max(v for _, v in points)
+    span_v = (hi - lo) or 1
+    span_t = (t1 - t0) or 1
+    step = min(b[0] - a[0] for a, b in zip(points, points[1:])) or 1
+
+    lines, line, last_t = [], [], None
+    for t, v in points:
+        if last_t is not None and t - last_t > step * 1.5:
+            lines.append(line)
+            line = []
+        x = (t - t0) / span_t * (width - 2) + 1
+        y = height - 1 - (v - lo) / span_v * (height - 2)
+        line.append(f"{x:.1f},{y:.1f}")
+        last_t = t
+    lines.append(line)
+    polylines = "".join(f'<polyline fill="none" stroke="{color}" stroke-width="1" points="{" ".join(l)}"/>'
+                        for l in lines if len(l) > 1)
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">'
+            f'<title>{lo:.1f} .. {hi:.1f}</title>{polylines}</svg>')
+
+
+if __name__ == "__main__":
+    store = TimeSeriesStore.load(LIVE_PATH if os.path.exists(LIVE_PATH) else PERSIST_PATH)
+    prefixes = sys.argv[1:] or None
+    result = store.query(prefixes, "1m")
+    for name, points in result["series"].items():
+        values = [v for _, v in points]
+        if values:
+            print(f"{name:<40} {len(values):>5} pts  last {values[-1]:>10.1f}  min {min(values):>10.1f}  max {max(values):>10.1f}")
+    print(f"{len(store.names)} series, ceiling {store.memory_ceiling / 1024:.0f}KB")
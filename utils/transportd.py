@@ -0,0 +1,176 @@
+"""
+RETCON transport daemon. Owns the shared Reticulum instance and its interfaces.
+
+Everything else (the admin console, meshchat, rnsh) attaches to it as a shared instance client,
+so restarting any of them doesn't touch the interfaces, and reconfiguring interfaces doesn't
+kill them. retcon.py starts this first and talks to it over a unix socket:
+
+    {"cmd": "status"}     interfaces, traffic counters, connected clients
+    {"cmd": "reload"}     re-read the reticulum config. Re-execs if it changed, otherwise just
+                          kicks the TCP client interfaces so they re-resolve and reconnect
+    {"cmd": "reconnect"}  only the TCP client kick
+
+One JSON object per line each way.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import hashlib
+import threading
+import socketserver
+
+CONTROL_SOCKET = os.path.expanduser("~/.retcon/transportd.sock")
+RNS_CONFIG_DIR = os.path.expanduser("~/.reticulum")
+
+
+def _config_digest(configdir: str) -> str:
+    try:
+        with open(os.path.join(configdir, "config"), "rb") as fin:
+            return hashlib.sha256(fin.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class TransportDaemon:
+
+    def __init__(self, configdir: str = RNS_CONFIG_DIR, control_socket: str = CONTROL_SOCKET):
+        self.configdir = configdir
+        self.control_socket = control_socket
+        self.started = time.time()
+        self.digest = _config_digest(configdir)
+        # RNS is only imported by the daemon itself. retcon.py just uses the client helpers below
+        import RNS
+        self.reticulum = RNS.Reticulum(configdir=configdir)
+        if self.reticulum.is_connected_to_shared_instance:
+            # someone else already owns the interfaces. Two owners would fight over the radios
+            raise RuntimeError("Another shared Reticulum instance is already running")
+        self._server = None
+
+    def status(self) -> dict:
+        import RNS
+        interfaces = []
+        for iface in RNS.Transport.interfaces:
+            interfaces.append({
+                "name": str(iface),
+                "online": bool(getattr(iface, "online", False)),
+                "rxb": getattr(iface, "rxb", 0),
+                "txb": getattr(iface, "txb", 0),
+                # one spawned per connected client. Their traffic is counted on the parent too
+                "parent": str(iface.parent_interface) if getattr(iface, "parent_interface", None) is not None else None,
+            })
+        return {
+            "ok": True,
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "config_digest": self.digest,
+            "clients": len(RNS.Transport.local_client_interfaces),
+            "interfaces": interfaces,
+        }
+
+    def reconnect(self) -> int:
+        """
+        Drop the connection of every TCP client interface. RNS reconnects them on its own,
+        re-resolving the target host, which is what we want after the mesh switched parents
+        """
+        import RNS
+        kicked = 0
+        for iface in list(RNS.Transport.interfaces):
+            sock = getattr(iface, "socket", None)
+            if getattr(iface, "initiator", False) and sock is not None and hasattr(iface, "reconnect"):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                    kicked += 1
+                except OSError:
+                    pass
+        return kicked
+
+    def reload(self) -> dict:
+        digest = _config_digest(self.configdir)
+        if digest == self.digest:
+            return {"ok": True, "action": "reconnect", "interfaces": self.reconnect()}
+        # RNS can't swap interfaces in a running instance, so start over with the new config.
+        # Reply first, clients would see a dropped socket otherwise
+        threading.Timer(0.5, self._reexec).start()
+        return {"ok": True, "action": "restart"}
+
+    def _reexec(self):
+        print("transportd: config changed, re-executing")
+        import RNS
+        if self._server is not None:
+            self._server.server_close()
+        RNS.Reticulum.exit_handler()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def handle(self, request: dict) -> dict:
+        cmd = request.get("cmd")
+        if cmd == "status":
+            return self.status()
+        if cmd == "reload":
+            return self.reload()
+        if cmd == "reconnect":
+            return {"ok": True, "interfaces": self.reconnect()}
+        return {"ok": False, "error": f"unknown command {cmd}"}
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = daemon.handle(json.loads(line))
+                    except Exception as e:
+                        response = {"ok": False, "error": str(e)}
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        os.makedirs(os.path.dirname(self.control_socket), exist_ok=True)
+        if os.path.exists(self.control_socket):
+            os.unlink(self.control_socket)
+        self._server = socketserver.ThreadingUnixStreamServer(self.control_socket, Handler)
+        os.chmod(self.control_socket, 0o600)
+        print(f"transportd: up. control on {self.control_socket}")
+        self._server.serve_forever()
+
+
+def command(cmd: str, control_socket: str = CONTROL_SOCKET, timeout: float = 5) -> dict:
+    """ send one command to the daemon and return its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(control_socket)
+        sock.sendall(json.dumps({"cmd": cmd}).encode() + b"\n")
+        with sock.makefile("rb") as fin:
+            return json.loads(fin.readline())
+
+
+async def command_async(cmd: str, control_socket: str = CONTROL_SOCKET, timeout: float = 5) -> dict:
+    reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(control_socket), timeout)
+    try:
+        writer.write(json.dumps({"cmd": cmd}).encode() + b"\n")
+        await writer.drain()
+        return json.loads(await asyncio.wait_for(reader.readline(), timeout))
+    finally:
+        writer.close()
+
+
+async def wait_ready(control_socket: str = CONTROL_SOCKET, timeout: float = 60) -> bool:
+    """ wait until the daemon answers on its control socket"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if (await command_async("status", control_socket))["ok"]:
+                return True
+        except (OSError, ValueError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(0.5)
+    return False
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # little cli for poking at a running daemon. python utils/transportd.py status
+        print(json.dumps(command(sys.argv[1]), indent=2))
+    else:
+        TransportDaemon().serve_forever()
@@ -0,0 +1,113 @@
+"""
+Which wifi radio does what.
+
+By default RETCON uses the pi's onboard radio for everything: client_iface is the
+uplink STA and ap_iface is the AP (downlink mesh AP for transport nodes, the client AP
+for client nodes). Extra radios (e.g. USB wifi adapters) can be given their own role and
+channel in an optional [[[radios]]] section under [[wifi]]:
+
+    [[[radios]]]
+      # <iface> = <role>, <freq>
+      wlan1 = uplink, 2437
+      wlan2 = client_ap, 2412
+"""
+from base64 import a85encode
+
+ROLE_UPLINK = "uplink"        # STA that joins a parent node's mesh AP
+ROLE_DOWNLINK = "downlink"    # mesh AP that children join (transport nodes)
+ROLE_CLIENT_AP = "client_ap"  # AP for attendees in client mode
+ROLES = [ROLE_UPLINK, ROLE_DOWNLINK, ROLE_CLIENT_AP]
+
+wifi_channel_to_freq = {
+    1: 2412,
+    2: 2417,
+    3: 2422,
+    4: 2427,
+    5:2432,
+    6: 2437,
+    7: 2442,
+    8: 2447,
+    9: 2452,
+    10: 2457,
+    11:2462,
+    12: 2467,
+    13: 2472,
+    14: 2484
+}
+
+wifi_freq_to_channel = {f:c for c,f in wifi_channel_to_freq.items()}
+
+
+class WifiRadio:
+
+    def __init__(self, iface: str, role: str, freq: int, primary: bool = False):
+        if role not in ROLES:
+            raise ValueError(f"Unknown wifi radio role '{role}' for {iface}. Must be one of {ROLES}")
+        if freq not in wifi_freq_to_channel:
+            raise ValueError(f"{freq} is not a supported 2.4Ghz wifi freq for {iface}")
+        self.iface = iface
+        self.role = role
+        self.freq = freq
+        # primary radios are the ones from client_iface/ap_iface.
+        # They keep the original interface names and hostnames so single radio configs don't change
+        self.primary = primary
+
+    @property
+    def channel(self) -> int:
+        return wifi_freq_to_channel[self.freq]
+
+    def __repr__(self):
+        return f"WifiRadio({self.iface}, {self.role}, {self.freq})"
+
+
+def get_radios(retcon_config) -> list:
+    """ All the wifi radios we should manage and their roles, primary radios first"""
+    r_config = retcon_config["retcon"]
+    wifi = r_config["wifi"]
+    freq = int(wifi["freq"])
+    is_transport = r_config.get("mode", "client") == "transport"
+
+    radios = {
+        wifi["client_iface"]: WifiRadio(wifi["client_iface"], ROLE_UPLINK, freq, primary=True),
+        wifi["ap_iface"]: WifiRadio(wifi["ap_iface"], ROLE_DOWNLINK if is_transport else ROLE_CLIENT_AP, freq, primary=True),
+    }
+
+    for iface, value in wifi.get("radios", {}).items():
+        role, radio_freq = value if isinstance(value, list) else (value, freq)
+        radios[iface] = WifiRadio(iface, role.strip(), int(radio_freq), primary=iface in radios and radios[iface].primary)
+
+    return list(radios.values())
+
+
+def radios_with_role(radios: list, role: str) -> list:
+    return [r for r in radios if r.role == role]
+
+
+def gateway_host(radio: WifiRadio) -> str:
+    """ /etc/hosts name each uplink radio uses to reach its parent"""
+    return "retcon.gateway" if radio.primary else f"retcon-{radio.iface}.gateway"
+
+
+def main_ap_radio(radios: list, is_transport: bool):
+    """ The AP retcon.py brings up at boot. The mesh downlink for transports, the client AP otherwise"""
+    candidates = radios_with_role(radios, ROLE_DOWNLINK if is_transport else ROLE_CLIENT_AP)
+    return candidates[0] if len(candidates) > 0 else None
+
+
+def node_suffix(node_id: int) -> str:
+    """ the unique part of every SSID this node hosts"""
+    return a85encode(node_id.to_bytes(6, signed=False)).decode()
+
+
+def ap_subnet(node_id: int, radio_index: int = 0) -> str:
+    """
+    Subnet for a mesh AP hosted by this node.
+    We can't have collisions so use the last bits of the node_id to generate an ipv4 subnet range.
+    Extra AP radios shift the second octet so each radio gets its own /24
+    """
+    ip_subnet_bytes = list((node_id & 0xFFFF).to_bytes(2))
+    ip_subnet_bytes[0] = (ip_subnet_bytes[0] + 64 * radio_index) % 256
+    # avoid collisions with client AP. That will girnd things to a hault for them
+    if ip_subnet_bytes[0] == 42 and ip_subnet_bytes[1] in (0, 1):
+        ip_subnet_bytes = [42, 2]
+    return f"10.{ip_subnet_bytes[0]}.{ip_subnet_bytes[1]}.1/24"